@@ -0,0 +1,319 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from glob import glob
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from constants import ANALYTICS_DIR, ANALYTICS_INTERVAL_SECONDS, ANALYTICS_MAX_PARTS
+from exports import parse_timestamp
+from storage import atomic_write_bytes, atomic_write_json, file_lock, read_json, remove_file
+from tenants import list_tenants, tenant_paths
+from thread_store import list_thread_files, read_thread_file, thread_extension
+
+
+ANALYTICS_LOCK = "analytics_ingestion"
+STATE_PATH = os.path.join(ANALYTICS_DIR, "state.json")
+
+logger = logging.getLogger(__name__)
+
+# One row per user message and per model response. A thread is re-ingested whole when it changes,
+# the rows of its previous ingestions being dropped when reading, by their lower "version".
+# A deleted thread gets a "deleted" row with a higher version, dropping all its rows.
+MESSAGES_SCHEMA = pa.schema([("tenant", pa.string()),
+                             ("thread_id", pa.string()),
+                             ("version", pa.int64()),
+                             ("index", pa.int32()),
+                             ("timestamp", pa.timestamp("us")),
+                             ("role", pa.string()),
+                             ("mode", pa.string()),
+                             ("model", pa.string()),
+                             ("prompt_tokens", pa.int64()),
+                             ("cached_tokens", pa.int64()),
+                             ("completion_tokens", pa.int64()),
+                             ("latency", pa.float64()),
+                             ("first_token_latency", pa.float64()),
+                             ("failed", pa.bool_()),
+                             ("deleted", pa.bool_())])
+# One row per image generation or inpainting, re-ingested when the tiering rewrites it
+IMAGES_SCHEMA = pa.schema([("tenant", pa.string()),
+                           ("id", pa.string()),
+                           ("version", pa.int64()),
+                           ("kind", pa.string()),
+                           ("timestamp", pa.timestamp("us")),
+                           ("images", pa.int32()),
+                           ("thread_id", pa.string()),
+                           ("deleted", pa.bool_())])
+TABLES = {"messages": (MESSAGES_SCHEMA, ["tenant", "thread_id"]),
+          "images": (IMAGES_SCHEMA, ["tenant", "id"])}
+
+
+def _response_row(base: Dict[str, Any], model: Optional[str], result: Dict[str, Any]) -> Dict[str, Any]:
+    usage = result.get("usage") or {}
+    return {**base, "role": "assistant", "model": model,
+            "prompt_tokens": usage.get("prompt_tokens"),
+            "cached_tokens": usage.get("cached_tokens"),
+            "completion_tokens": usage.get("completion_tokens"),
+            "latency": result.get("latency"),
+            "first_token_latency": result.get("first_token_latency"),
+            "failed": bool(result.get("error")) or result.get("status") == "failed"}
+
+
+def thread_rows(tenant_id: str, thread_data: Dict[str, Any], version: int) -> Iterator[Dict[str, Any]]:
+    """
+    Flatten a thread into rows of the messages table.
+
+    Args:
+        tenant_id (str): The tenant of the thread
+        thread_data (Dict[str, Any]): The thread
+        version (int): The version of the ingestion
+
+    Yields:
+        Dict[str, Any]: A row per user message and per model response
+    """
+    for i, message in enumerate(thread_data["messages"]):
+        if message.get("status") == "streaming":  # Ingested once complete
+            continue
+        base = {"tenant": tenant_id, "thread_id": thread_data["id"], "version": version, "index": i,
+                "timestamp": parse_timestamp(message.get("timestamp"))}
+        if message["role"] == "user":
+            yield {**base, "role": "user", "mode": message.get("mode")}
+        elif "comparisons" in message:
+            for comparison in message["comparisons"]:
+                yield _response_row(base, comparison["model"], comparison)
+        else:
+            yield _response_row(base, message.get("model"), message)
+
+
+def image_rows(tenant_id: str, kind: str, record: Dict[str, Any], version: int) -> Iterator[Dict[str, Any]]:
+    """
+    Get the row of an image generation or inpainting in the images table.
+
+    Args:
+        tenant_id (str): The tenant of the record
+        kind (str): "generation" or "inpainting"
+        record (Dict[str, Any]): The generation or inpainting data
+        version (int): The version of the ingestion
+
+    Yields:
+        Dict[str, Any]: The row
+    """
+    if kind == "inpainting":
+        images = 1
+    elif record.get("archive"):  # The tiering empties the paths of the generations it archives
+        images = len(record["archive"]["images"])
+    else:
+        images = len(record["image_paths"])
+    yield {"tenant": tenant_id, "id": record["id"], "version": version, "kind": kind,
+           "timestamp": parse_timestamp(record.get("timestamp")), "images": images,
+           "thread_id": record.get("thread_id")}
+
+
+def _modified_files(pattern_files: List[str], watermark: float) -> Iterator[str]:
+    for file_path in pattern_files:
+        try:
+            if os.stat(file_path).st_mtime >= watermark:
+                yield file_path
+        except FileNotFoundError:  # Deleted meanwhile
+            pass
+
+
+def _write_part(table_name: str, rows: List[Dict[str, Any]], version: int) -> None:
+    schema, _ = TABLES[table_name]
+    directory = os.path.join(ANALYTICS_DIR, table_name)
+    os.makedirs(directory, exist_ok=True)
+    buffer = pa.BufferOutputStream()
+    pq.write_table(pa.Table.from_pylist(rows, schema=schema), buffer, compression="zstd")
+    atomic_write_bytes(os.path.join(directory, f"part-{version:020d}.parquet"), buffer.getvalue().to_pybytes())
+
+
+def _part_files(table_name: str) -> List[str]:
+    return sorted(glob(os.path.join(ANALYTICS_DIR, table_name, "part-*.parquet")))
+
+
+def read_table(table_name: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Read a table of the analytics store, keeping the last ingested version of each record not deleted.
+
+    Args:
+        table_name (str): "messages" or "images"
+        columns (Optional[List[str]]): The columns to read, all of them if None
+
+    Returns:
+        pd.DataFrame: The rows, with the columns of the table schema
+    """
+    schema, keys = TABLES[table_name]
+    columns = columns or schema.names
+    read_columns = list(dict.fromkeys(columns + keys + ["version", "deleted"]))
+    files = _part_files(table_name)
+    if not files:
+        return schema.empty_table().to_pandas()[columns]
+    frame = pq.ParquetDataset(files, schema=schema).read(columns=read_columns).to_pandas()
+    latest = frame.groupby(keys, sort=False)["version"].transform("max")
+    frame = frame[(frame["version"] == latest) & ~frame["deleted"].fillna(False).astype(bool)]
+    return frame[columns].reset_index(drop=True)
+
+
+def _tombstones(table_name: str, live_keys: Set[Tuple[str, str]], version: int) -> List[Dict[str, Any]]:
+    """Get the rows deleting the records of the store whose file was deleted."""
+    _, keys = TABLES[table_name]
+    stored = read_table(table_name, keys).drop_duplicates()
+    return [{keys[0]: tenant_id, keys[1]: record_id, "version": version, "deleted": True}
+            for tenant_id, record_id in stored.itertuples(index=False, name=None)
+            if (tenant_id, record_id) not in live_keys]
+
+
+def _compact(table_name: str, version: int) -> None:
+    """Merge the parts of a table into one, without the rows of the previous versions."""
+    files = _part_files(table_name)
+    if len(files) <= ANALYTICS_MAX_PARTS:
+        return
+    frame = read_table(table_name)
+    schema, _ = TABLES[table_name]
+    buffer = pa.BufferOutputStream()
+    pq.write_table(pa.Table.from_pandas(frame, schema=schema, preserve_index=False), buffer, compression="zstd")
+    atomic_write_bytes(os.path.join(ANALYTICS_DIR, table_name, f"part-{version:020d}.parquet"),
+                       buffer.getvalue().to_pybytes())
+    for file_path in files:
+        if not file_path.endswith(f"part-{version:020d}.parquet"):
+            remove_file(file_path)
+
+
+def run_ingestion_pass() -> Dict[str, int]:
+    """
+    Compile the threads, generations and inpaintings of every tenant modified since the last pass into
+    the analytics store, and delete those deleted since. Only one process runs a pass at a time.
+
+    Returns:
+        Dict[str, int]: The number of ingested threads and image records, of deleted records,
+        and of broken files skipped
+    """
+    stats = {"threads": 0, "images": 0, "deleted": 0, "skipped": 0}
+    os.makedirs(ANALYTICS_DIR, exist_ok=True)
+    with file_lock(ANALYTICS_LOCK, bucketed=False):
+        state = read_json(STATE_PATH) or {"watermark": 0.0, "version": 0}
+        # Files modified during the pass are ingested again by the next one
+        started = time.time()
+        version = state["version"] + 1
+
+        message_rows, record_rows = [], []
+        live_threads, live_records = set(), set()
+        for tenant_id in list_tenants():
+            paths = tenant_paths(tenant_id)
+            thread_files = list_thread_files(paths["threads"]) if os.path.isdir(paths["threads"]) else []
+            live_threads |= {(tenant_id, os.path.basename(file_path)[:-len(thread_extension(file_path))])
+                             for file_path in thread_files}
+            for file_path in _modified_files(thread_files, state["watermark"]):
+                # A broken file, e.g. truncated, is skipped until it is modified again, so it does not
+                # stop the ingestion of the others, nor the watermark from moving
+                try:
+                    thread_data = read_thread_file(file_path)
+                    if thread_data is not None:
+                        message_rows += thread_rows(tenant_id, thread_data, version)
+                        stats["threads"] += 1
+                except Exception:
+                    logger.exception("Analytics ingestion skipped %s", file_path)
+                    stats["skipped"] += 1
+            for kind, key in [("generation", "generated_images"), ("inpainting", "inpainting_images")]:
+                files = glob(os.path.join(paths[key], "*.json"))
+                live_records |= {(tenant_id, os.path.splitext(os.path.basename(file_path))[0]) for file_path in files}
+                for file_path in _modified_files(files, state["watermark"]):
+                    try:
+                        record = read_json(file_path)
+                        if record is not None:
+                            record_rows += image_rows(tenant_id, kind, record, version)
+                            stats["images"] += 1
+                    except Exception:
+                        logger.exception("Analytics ingestion skipped %s", file_path)
+                        stats["skipped"] += 1
+
+        # The records deleted since the last pass, all of them being listed above
+        message_rows += _tombstones("messages", live_threads, version)
+        record_rows += _tombstones("images", live_records, version)
+        stats["deleted"] = sum(1 for row in message_rows + record_rows if row.get("deleted"))
+
+        if message_rows:
+            _write_part("messages", message_rows, version)
+        if record_rows:
+            _write_part("images", record_rows, version)
+        for table_name in TABLES:
+            _compact(table_name, version + 1)
+        atomic_write_json(STATE_PATH, {"watermark": started, "version": version + 1,
+                                       "last_pass": datetime.now().isoformat()})
+    return stats
+
+
+def ingestion_state() -> Dict[str, Any]:
+    """
+    Get the state of the ingestion.
+
+    Returns:
+        Dict[str, Any]: The "last_pass" ISO timestamp, absent before the first pass
+    """
+    return read_json(STATE_PATH) or {}
+
+
+def compute_aggregates(messages: pd.DataFrame, images: pd.DataFrame, tenant_id: str,
+                       since: Optional[datetime] = None) -> Dict[str, pd.DataFrame]:
+    """
+    Compute the dashboard aggregates of a tenant with vectorized group-bys.
+
+    Args:
+        messages (pd.DataFrame): The messages table
+        images (pd.DataFrame): The images table
+        tenant_id (str): The tenant ID
+        since (Optional[datetime]): Only count the rows since this time, all of them if None
+
+    Returns:
+        Dict[str, pd.DataFrame]: The "chats_per_mode" and "images_per_day" by day, "tokens_per_day"
+        by day and model, and the response "latency" by model, of the responses that did not fail
+    """
+    messages = messages[messages["tenant"] == tenant_id]
+    images = images[images["tenant"] == tenant_id]
+    if since is not None:
+        # Rows without timestamp were saved before messages had one
+        messages = messages[messages["timestamp"] >= since]
+        images = images[images["timestamp"] >= since]
+    messages = messages.assign(day=messages["timestamp"].dt.floor("D"))
+    images = images.assign(day=images["timestamp"].dt.floor("D"))
+
+    chats = messages[messages["role"] == "user"]
+    responses = messages[messages["role"] == "assistant"]
+    responses = responses[~responses["failed"].astype(bool)]
+    return {
+        "chats_per_mode": (chats.assign(mode=chats["mode"].fillna("Unknown"))
+                           .pivot_table(index="day", columns="mode", values="index", aggfunc="count", fill_value=0)),
+        "tokens_per_day": (responses.groupby(["day", "model"])[["prompt_tokens", "cached_tokens", "completion_tokens"]]
+                           .sum().reset_index()),
+        "images_per_day": images.pivot_table(index="day", columns="kind", values="images", aggfunc="sum", fill_value=0),
+        "latency": (responses.groupby("model")
+                    .agg(responses=("latency", "size"), latency=("latency", "mean"),
+                         first_token_latency=("first_token_latency", "mean"))
+                    .reset_index()),
+    }
+
+
+def start_ingestion_worker() -> threading.Thread:
+    """
+    Start the background thread running an ingestion pass every ANALYTICS_INTERVAL_SECONDS.
+
+    Returns:
+        threading.Thread: The worker thread
+    """
+    def work():
+        while True:
+            try:
+                run_ingestion_pass()
+            except Exception:
+                # E.g. the lock or the store unavailable, the next pass retries
+                logger.exception("Analytics ingestion pass failed")
+            time.sleep(ANALYTICS_INTERVAL_SECONDS)
+
+    worker = threading.Thread(target=work, daemon=True)
+    worker.start()
+    return worker
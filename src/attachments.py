@@ -0,0 +1,243 @@
+import functools
+import hashlib
+import io
+import os
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from constants import ATTACHMENT_CHUNK_CHARS, ATTACHMENT_INDEX_CACHE_SIZE, ATTACHMENT_TOP_K, BM25_K1, BM25_B
+from storage import atomic_write_bytes, atomic_write_json, read_json, remove_file
+
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split a text into lowercase words.
+
+    Args:
+        text (str): The text
+
+    Returns:
+        List[str]: The words
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def chunk_text(text: str, chunk_chars: int = ATTACHMENT_CHUNK_CHARS) -> List[str]:
+    """
+    Split a text into chunks of about `chunk_chars` characters, on line boundaries when possible.
+
+    Args:
+        text (str): The text
+        chunk_chars (int): The maximum size of a chunk
+
+    Returns:
+        List[str]: The chunks
+    """
+    chunks, current, size = [], [], 0
+    for line in text.splitlines(keepends=True):
+        # Lines longer than a chunk are split, e.g. minified JSON
+        pieces = [line[i:i + chunk_chars] for i in range(0, len(line), chunk_chars)]
+        for piece in pieces:
+            if size + len(piece) > chunk_chars and current:
+                chunks.append("".join(current))
+                current, size = [], 0
+            current.append(piece)
+            size += len(piece)
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+
+class BM25Index:
+    """
+    BM25 index of the chunks of a document, stored as NumPy arrays.
+
+    The postings (chunk, BM25 term weight) are sorted by term, so the postings of a term are a
+    slice, and a query is scored with one vectorized addition per query term.
+    """
+
+    def __init__(self, vocabulary: List[str], offsets: np.ndarray, doc_ids: np.ndarray, weights: np.ndarray,
+                 idf: np.ndarray, n_docs: int):
+        """
+        Args:
+            vocabulary (List[str]): The terms, by term ID
+            offsets (np.ndarray): The start of the postings of each term, and the end of the last ones
+            doc_ids (np.ndarray): The chunk of each posting
+            weights (np.ndarray): The BM25 term frequency weight of each posting, without the IDF
+            idf (np.ndarray): The inverse document frequency of each term
+            n_docs (int): The number of chunks
+        """
+        self.vocabulary = vocabulary
+        self.term_ids = {term: term_id for term_id, term in enumerate(vocabulary)}
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.idf = idf
+        self.n_docs = n_docs
+
+    @classmethod
+    def build(cls, chunks: List[str], k1: float = BM25_K1, b: float = BM25_B) -> "BM25Index":
+        """
+        Index chunks.
+
+        Args:
+            chunks (List[str]): The chunks of the document
+            k1 (float): The BM25 term frequency saturation
+            b (float): The BM25 length normalization
+
+        Returns:
+            BM25Index: The index
+        """
+        term_ids = {}
+        tokens = []
+        lengths = np.zeros(len(chunks), dtype=np.int64)
+        for i, chunk in enumerate(chunks):
+            chunk_tokens = [term_ids.setdefault(token, len(term_ids)) for token in tokenize(chunk)]
+            tokens += chunk_tokens
+            lengths[i] = len(chunk_tokens)
+
+        n_docs, n_terms = len(chunks), max(len(term_ids), 1)
+        token_docs = np.repeat(np.arange(n_docs, dtype=np.int64), lengths)
+        # Term frequencies, as the counts of the unique (term, chunk) pairs, sorted by term
+        pairs, tf = np.unique(np.array(tokens, dtype=np.int64) * n_docs + token_docs, return_counts=True)
+        posting_terms, doc_ids = pairs // n_docs, pairs % n_docs
+
+        df = np.bincount(posting_terms, minlength=n_terms)
+        idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+        average_length = max(lengths.mean(), 1) if n_docs else 1
+        weights = tf * (k1 + 1) / (tf + k1 * (1 - b + b * lengths[doc_ids] / average_length))
+        offsets = np.searchsorted(posting_terms, np.arange(n_terms + 1))
+
+        vocabulary = [None] * len(term_ids)
+        for term, term_id in term_ids.items():
+            vocabulary[term_id] = term
+        return cls(vocabulary, offsets, doc_ids.astype(np.int32), weights.astype(np.float32),
+                   idf.astype(np.float32), n_docs)
+
+    def search(self, query: str, k: int = ATTACHMENT_TOP_K) -> List[Tuple[int, float]]:
+        """
+        Find the chunks most relevant to a query.
+
+        Args:
+            query (str): The query
+            k (int): The maximum number of chunks
+
+        Returns:
+            List[Tuple[int, float]]: The index and score of the matching chunks, best first
+        """
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            # A chunk appears once in the postings of a term, so the indexed addition is safe
+            scores[self.doc_ids[start:end]] += self.idf[term_id] * self.weights[start:end]
+
+        top = np.argsort(-scores)[:k]
+        return [(int(i), float(scores[i])) for i in top if scores[i] > 0]
+
+    def save(self, file_path: str) -> None:
+        """Save the arrays of the index, the vocabulary being saved with the chunks."""
+        buffer = io.BytesIO()
+        np.savez(buffer, offsets=self.offsets, doc_ids=self.doc_ids, weights=self.weights, idf=self.idf)
+        atomic_write_bytes(file_path, buffer.getvalue())
+
+    @classmethod
+    def load(cls, file_path: str, vocabulary: List[str], n_docs: int) -> "BM25Index":
+        """Load the arrays of an index saved with `save`."""
+        with np.load(file_path) as arrays:
+            return cls(vocabulary, arrays["offsets"], arrays["doc_ids"], arrays["weights"], arrays["idf"], n_docs)
+
+
+
+def _attachment_paths(directory: str, attachment_id: str) -> Tuple[str, str]:
+    return os.path.join(directory, f"{attachment_id}.json"), os.path.join(directory, f"{attachment_id}.npz")
+
+
+def save_attachment(directory: str, thread_id: str, name: str, text: str) -> Dict[str, Any]:
+    """
+    Chunk and index a large text attachment.
+
+    Args:
+        directory (str): The attachments directory
+        thread_id (str): The ID of the thread the attachment is sent to
+        name (str): The name of the attached file
+        text (str): The content of the attached file
+
+    Returns:
+        Dict[str, Any]: The attachment, stored in the message: its ID, name, size and number of chunks
+    """
+    attachment_id = f"{thread_id}_{hashlib.md5(text.encode('utf-8')).hexdigest()}"
+    chunks = chunk_text(text)
+    index = BM25Index.build(chunks)
+    json_path, index_path = _attachment_paths(directory, attachment_id)
+    index.save(index_path)
+    atomic_write_json(json_path, {"name": name, "chunks": chunks, "vocabulary": index.vocabulary})
+    return {"id": attachment_id, "name": name, "size": len(text), "chunks": len(chunks)}
+
+
+def delete_attachment(directory: str, attachment_id: str) -> None:
+    """
+    Delete the chunks and index of an attachment.
+
+    Args:
+        directory (str): The attachments directory
+        attachment_id (str): The ID of the attachment
+    """
+    for file_path in _attachment_paths(directory, attachment_id):
+        remove_file(file_path)
+
+
+@functools.lru_cache(maxsize=ATTACHMENT_INDEX_CACHE_SIZE)
+def load_attachment(directory: str, attachment_id: str) -> Optional[Tuple[List[str], BM25Index]]:
+    """
+    Load the chunks and index of an attachment, which never change once saved.
+
+    Args:
+        directory (str): The attachments directory
+        attachment_id (str): The ID of the attachment
+
+    Returns:
+        Optional[Tuple[List[str], BM25Index]]: The chunks and their index, None if the attachment was deleted
+    """
+    json_path, index_path = _attachment_paths(directory, attachment_id)
+    data = read_json(json_path)
+    if data is None or not os.path.exists(index_path):
+        return None
+    return data["chunks"], BM25Index.load(index_path, data["vocabulary"], len(data["chunks"]))
+
+
+def retrieve_excerpts(directory: str, attachments: List[Dict[str, Any]], query: str,
+                      k: int = ATTACHMENT_TOP_K) -> List[Tuple[str, int, str]]:
+    """
+    Find the chunks of the attachments most relevant to a query.
+
+    Args:
+        directory (str): The attachments directory
+        attachments (List[Dict[str, Any]]): The attachments, as stored in the messages
+        query (str): The query, e.g. the last user message
+        k (int): The maximum number of chunks, over all the attachments
+
+    Returns:
+        List[Tuple[str, int, str]]: The attachment name, chunk number and text of the excerpts,
+        in document order. The first chunk of each attachment if none matches the query.
+    """
+    matches, first_chunks = [], []
+    for attachment in attachments:
+        loaded = load_attachment(directory, attachment["id"])
+        if loaded is None:
+            continue
+        chunks, index = loaded
+        first_chunks.append((attachment["name"], 0, chunks[0]))
+        matches += [(score, attachment["name"], i, chunks[i]) for i, score in index.search(query, k)]
+
+    if not matches:
+        return first_chunks[:k]
+    best = sorted(matches, key=lambda match: -match[0])[:k]
+    return [(name, i, chunk) for _, name, i, chunk in sorted(best, key=lambda match: (match[1], match[2]))]
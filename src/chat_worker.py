@@ -0,0 +1,427 @@
+import concurrent.futures
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from openai import OpenAI
+
+from constants import CHAT_STREAM_FLUSH_SECONDS, CHAT_STREAM_HEARTBEAT_SECONDS, CHAT_STREAM_STALE_SECONDS
+from image_pipeline import ImagePipeline
+from scheduler import PRIORITY_INTERACTIVE, estimate_tokens, get_scheduler
+from storage import file_lock
+from thread_store import read_thread, write_thread
+
+
+STREAMING_KEYS = ["generation_id", "worker", "heartbeat"]  # Removed from a message once its worker completed it
+
+logger = logging.getLogger(__name__)
+
+_generations = {}
+_generations_lock = threading.Lock()
+_usage = {"responses": 0, "prompt_tokens": 0, "cached_tokens": 0}
+_open_streams = {"count": 0}  # Response streams being read, the scheduler only counts requests until their headers
+
+
+class ChatGeneration:
+    """
+    A chat response generated in the background, that the sessions of this process can stream from.
+    Comparisons generate one response per model, concurrently.
+    """
+
+    def __init__(self, threads_dir: str, thread_id: str, generation_id: str, models: List[str],
+                 pipeline: Optional[ImagePipeline] = None):
+        """
+        Args:
+            threads_dir (str): The thread directory of the tenant
+            thread_id (str): The ID of the thread the response is written to
+            generation_id (str): The ID of the generation, stored in the assistant message
+            models (List[str]): The models answering, the first one gives the content of the message
+            pipeline (Optional[ImagePipeline]): Generates the images of the prompts of the first model's response
+        """
+        self.threads_dir = threads_dir
+        self.thread_id = thread_id
+        self.generation_id = generation_id
+        self.models = models
+        self.pipeline = pipeline
+        self.texts = {model: "" for model in models}
+        self.results = {}
+        self.version = 0
+        self.done = False
+        self.last_flush = time.monotonic()
+        self.condition = threading.Condition()
+
+    def append(self, model: str, text: str) -> None:
+        """Add a chunk of the response of a model."""
+        with self.condition:
+            self.texts[model] += text
+            self.version += 1
+            self.condition.notify_all()
+
+    def finish_model(self, model: str, result: Dict[str, Any]) -> None:
+        """Record the latency, usage or error of the response of a model."""
+        with self.condition:
+            self.results[model] = result
+            self.version += 1
+            self.condition.notify_all()
+
+    def finish(self) -> None:
+        """Mark the generation as complete and written to the thread, ending the streams."""
+        with self.condition:
+            self.done = True
+            self.version += 1
+            self.condition.notify_all()
+
+    def claim_flush(self) -> bool:
+        """Check if the response is due to be written to the thread, in which case the caller writes it."""
+        with self.condition:
+            if time.monotonic() - self.last_flush < CHAT_STREAM_FLUSH_SECONDS:
+                return False
+            self.last_flush = time.monotonic()
+            return True
+
+    def wait_for_update(self, version: int, timeout: Optional[float] = None) -> Tuple[int, Dict[str, str], bool]:
+        """
+        Wait until the generation changed since a version.
+
+        Args:
+            version (int): The last version seen by the caller, 0 at first
+            timeout (Optional[float]): The maximum time to wait, in seconds
+
+        Returns:
+            Tuple[int, Dict[str, str], bool]: The new version, the text of each model, and whether the generation is complete
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version or self.done, timeout)
+            return self.version, dict(self.texts), self.done
+
+    def stream(self) -> Iterator[str]:
+        """
+        Stream the response of the first model from its beginning, so a session attaching late still shows all of it.
+
+        Returns:
+            Iterator[str]: The chunks of the response, until it is complete (its images may still be generating)
+        """
+        version, sent = 0, 0
+        while True:
+            version, texts, done = self.wait_for_update(version)
+            text = texts[self.models[0]]
+            if len(text) > sent:
+                yield text[sent:]
+                sent = len(text)
+            with self.condition:
+                if done or self.models[0] in self.results:
+                    return
+
+
+def get_generation(generation_id: str) -> Optional[ChatGeneration]:
+    """
+    Get a generation running in this process.
+
+    Args:
+        generation_id (str): The ID of the generation
+
+    Returns:
+        Optional[ChatGeneration]: The generation, or None if it ended or runs in another process
+    """
+    with _generations_lock:
+        return _generations.get(generation_id)
+
+
+def update_message(threads_dir: str, thread_id: str, generation_id: str, fields: Dict[str, Any],
+                   remove: List[str] = ()) -> bool:
+    """
+    Update the assistant message of a generation in its thread file.
+
+    Args:
+        threads_dir (str): The thread directory of the tenant
+        thread_id (str): The ID of the thread
+        generation_id (str): The ID of the generation
+        fields (Dict[str, Any]): The fields to set
+        remove (List[str]): The fields to remove
+
+    Returns:
+        bool: False if the thread or the message does not exist anymore. A message marked interrupted
+        is still updated, its generation being alive after all.
+    """
+    with file_lock(thread_id):
+        thread_data = read_thread(thread_id, threads_dir)
+        if thread_data is None:
+            return False
+        for message in thread_data["messages"]:
+            if message.get("generation_id") == generation_id:
+                message.update(fields)
+                for key in remove:
+                    message.pop(key, None)
+                thread_data["last_updated"] = datetime.now().isoformat()
+                write_thread(thread_data, threads_dir)
+                return True
+    return False
+
+
+def read_message(threads_dir: str, thread_id: str, generation_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Read the assistant message of a running generation from its thread file.
+
+    Args:
+        threads_dir (str): The thread directory of the tenant
+        thread_id (str): The ID of the thread
+        generation_id (str): The ID of the generation
+
+    Returns:
+        Optional[Dict[str, Any]]: The message, or None if the generation ended, was marked interrupted,
+        or the thread was deleted
+    """
+    thread_data = read_thread(thread_id, threads_dir)
+    if thread_data is None:
+        return None
+    for message in thread_data["messages"]:
+        if message.get("generation_id") == generation_id and message.get("status") == "streaming":
+            return message
+    return None
+
+
+def is_generation_alive(message: Dict[str, Any]) -> bool:
+    """
+    Check if the worker streaming an assistant message is still running.
+
+    Workers of this host are checked by process ID, those of other hosts by the age of their last write.
+
+    Args:
+        message (Dict[str, Any]): The assistant message, with a "streaming" status
+
+    Returns:
+        bool: False if the worker died, e.g. because its process was restarted
+    """
+    worker = message.get("worker", {})
+    if worker.get("host") == socket.gethostname():
+        if worker.get("pid") == os.getpid():
+            return get_generation(message["generation_id"]) is not None
+        try:
+            os.kill(worker["pid"], 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass  # Running, as another user
+        return True
+
+    heartbeat = datetime.fromisoformat(message["heartbeat"])
+    return (datetime.now() - heartbeat).total_seconds() < CHAT_STREAM_STALE_SECONDS
+
+
+def mark_interrupted(threads_dir: str, thread_id: str, generation_id: str) -> None:
+    """
+    Mark the assistant message of a dead worker as interrupted, keeping its partial content.
+
+    The streaming keys are kept, so a worker wrongly deemed dead, e.g. paused longer than
+    CHAT_STREAM_STALE_SECONDS, still finds its message and sets it back to streaming on its next write.
+
+    Args:
+        threads_dir (str): The thread directory of the tenant
+        thread_id (str): The ID of the thread
+        generation_id (str): The ID of the generation
+    """
+    with file_lock(thread_id):
+        # Check again under the lock, the worker may have completed the message meanwhile
+        message = read_message(threads_dir, thread_id, generation_id)
+        if message is not None and not is_generation_alive(message):
+            update_message(threads_dir, thread_id, generation_id, {"status": "interrupted"})
+
+
+def _record_usage(model: str, usage: Any) -> Dict[str, int]:
+    """Log the token usage of a response, including the prompt tokens served from the API prompt cache."""
+    details = usage.prompt_tokens_details
+    cached_tokens = (details.cached_tokens or 0) if details is not None else 0
+    logger.info("Chat response of %s: %d prompt tokens, %d cached, %d completion tokens",
+                model, usage.prompt_tokens, cached_tokens, usage.completion_tokens)
+    with _generations_lock:
+        _usage["responses"] += 1
+        _usage["prompt_tokens"] += usage.prompt_tokens
+        _usage["cached_tokens"] += cached_tokens
+    return {"prompt_tokens": usage.prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "completion_tokens": usage.completion_tokens,
+            "total_tokens": usage.total_tokens}
+
+
+def usage_stats() -> Dict[str, int]:
+    """
+    Get the token usage of the chat responses of this process.
+
+    Returns:
+        Dict[str, int]: The number of responses, of prompt tokens, and of prompt tokens served from the cache
+    """
+    with _generations_lock:
+        return dict(_usage)
+
+
+def open_streams() -> int:
+    """
+    Get the number of chat response streams of this process being read.
+
+    Returns:
+        int: The open streams, one per model of each running generation once its response started
+    """
+    with _generations_lock:
+        return _open_streams["count"]
+
+
+def _write_generation(generation: ChatGeneration, fields: Optional[Dict[str, Any]] = None, remove: List[str] = ()) -> bool:
+    """Write the current state of a generation to its assistant message."""
+    with generation.condition:
+        texts = dict(generation.texts)
+        results = dict(generation.results)
+
+    message_fields = {"content": texts[generation.models[0]], "status": "streaming", "heartbeat": datetime.now().isoformat(),
+                      **(fields or {})}
+    if generation.pipeline is not None:
+        images = generation.pipeline.results()
+        message_fields["image_generations"] = images["generation_ids"]
+        if images["errors"]:
+            message_fields["image_errors"] = images["errors"]
+    if len(generation.models) > 1:
+        message_fields["comparisons"] = [{"model": model, "content": texts[model], **results.get(model, {})}
+                                         for model in generation.models]
+    return update_message(generation.threads_dir, generation.thread_id, generation.generation_id, message_fields, remove)
+
+
+def _stream_model(generation: ChatGeneration, client: OpenAI, model: str, messages: List[Dict[str, Any]]) -> None:
+    """Consume the response stream of a model, writing the generation to the thread every CHAT_STREAM_FLUSH_SECONDS."""
+    started = time.monotonic()
+    result = {}
+    try:
+        stream = get_scheduler().call(
+            model,
+            lambda: client.chat.completions.with_raw_response.create(
+                model=model,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True}),
+            priority=PRIORITY_INTERACTIVE,
+            estimated_tokens=estimate_tokens(messages))
+        with _generations_lock:
+            _open_streams["count"] += 1
+        try:
+            with stream:
+                for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        result.setdefault("first_token_latency", round(time.monotonic() - started, 2))
+                        generation.append(model, chunk.choices[0].delta.content)
+                        if generation.pipeline is not None and model == generation.models[0]:
+                            generation.pipeline.feed(chunk.choices[0].delta.content)
+                    if chunk.usage is not None:
+                        result["usage"] = _record_usage(model, chunk.usage)
+
+                    if generation.claim_flush() and not _write_generation(generation):
+                        # The thread was deleted, closing the stream stops paying for tokens nobody will read
+                        return
+        finally:
+            with _generations_lock:
+                _open_streams["count"] -= 1
+    except Exception as e:
+        result["error"] = str(e)
+    finally:
+        result["latency"] = round(time.monotonic() - started, 2)
+        generation.finish_model(model, result)
+
+
+def _write_heartbeats(generation: ChatGeneration, stop: threading.Event) -> None:
+    """
+    Write the generation every CHAT_STREAM_HEARTBEAT_SECONDS until stopped, so the message is not deemed
+    interrupted while no chunk arrives: queued in the scheduler, backing off, or waiting for a first token.
+    """
+    while not stop.wait(CHAT_STREAM_HEARTBEAT_SECONDS):
+        if not _write_generation(generation):
+            return  # The thread was deleted
+
+
+def _run_generation(generation: ChatGeneration, client: OpenAI, messages: List[Dict[str, Any]]) -> None:
+    """Generate the response of every model concurrently, then write the complete message."""
+    stop_heartbeats = threading.Event()
+    heartbeats = threading.Thread(target=_write_heartbeats, args=(generation, stop_heartbeats), daemon=True)
+    heartbeats.start()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(generation.models)) as executor:
+            for model in generation.models:
+                executor.submit(_stream_model, generation, client, model, messages)
+        if generation.pipeline is not None:
+            generation.pipeline.close()
+    finally:
+        # The complete message is the last write
+        stop_heartbeats.set()
+        heartbeats.join()
+        errors = [generation.results.get(model, {}).get("error") for model in generation.models]
+        if all(errors):
+            fields, remove = {"status": "failed", "error": errors[0]}, STREAMING_KEYS
+        else:
+            fields, remove = {}, STREAMING_KEYS + ["status"]
+            if errors[0]:
+                # The first model failed, the message holds the response of the first one that succeeded
+                model = next(model for model, error in zip(generation.models, errors) if not error)
+                fields.update(content=generation.texts[model], model=model)
+        if len(generation.models) == 1:
+            # The usage and latency of a compared model are stored in its comparison
+            result = generation.results.get(generation.models[0], {})
+            fields.update({key: value for key, value in result.items() if key != "error"})
+        # The message is complete in the thread file before the sessions streaming it rerun
+        _write_generation(generation, fields, remove)
+        generation.finish()
+        with _generations_lock:
+            _generations.pop(generation.generation_id, None)
+
+
+def start_chat_generation(client: OpenAI, threads_dir: str, thread_id: str, models: List[str],
+                          messages: List[Dict[str, Any]], generate_image: Optional[Callable[[str], str]] = None) -> str:
+    """
+    Append a streaming assistant message to a thread and generate it in a background thread.
+
+    The response keeps being generated and written to the thread when the session that asked for it
+    reruns or disconnects. Any session can attach to it with `get_generation`, or follow the thread file.
+
+    With several models, the same messages are sent to all of them concurrently. The message content
+    is the response of the first model that succeeded, and its "comparisons" hold the response, latency and token
+    usage of each model.
+
+    With `generate_image`, each numbered prompt of the response is sent to it as soon as it is complete,
+    so the images are generated while the rest of the response streams. The message is complete once
+    the images are saved, and its "image_generations" hold their generation IDs.
+
+    Args:
+        client (OpenAI): The OpenAI client
+        threads_dir (str): The thread directory of the tenant
+        thread_id (str): The ID of the thread, already holding the user message
+        models (List[str]): The models to use
+        messages (List[Dict[str, Any]]): The messages sent to the API
+        generate_image (Optional[Callable[[str], str]]): Generates and saves the image of a prompt, returning the generation ID
+
+    Returns:
+        str: The ID of the generation
+    """
+    pipeline = ImagePipeline(generate_image) if generate_image is not None else None
+    generation = ChatGeneration(threads_dir, thread_id, str(uuid.uuid4()), models, pipeline)
+    # Registered before the message is written, so it is never mistaken for an interrupted one
+    with _generations_lock:
+        _generations[generation.generation_id] = generation
+
+    message = {"role": "assistant",
+               "content": "",
+               "timestamp": datetime.now().isoformat(),
+               "model": models[0],
+               "status": "streaming",
+               "generation_id": generation.generation_id,
+               "worker": {"host": socket.gethostname(), "pid": os.getpid()},
+               "heartbeat": datetime.now().isoformat()}
+    if len(models) > 1:
+        message["comparisons"] = [{"model": model, "content": ""} for model in models]
+    with file_lock(thread_id):
+        thread_data = read_thread(thread_id, threads_dir)
+        thread_data["messages"].append(message)
+        thread_data["last_updated"] = datetime.now().isoformat()
+        write_thread(thread_data, threads_dir)
+
+    threading.Thread(target=_run_generation, args=(generation, client, messages), daemon=True).start()
+    return generation.generation_id
@@ -6,12 +6,82 @@ THREADS_DIR = os.path.join(PROJECT_DIR, "data", "thread_history")
 UPLOADED_IMAGES_DIR = os.path.join(PROJECT_DIR, "data", "uploaded_images")
 GENERATED_IMAGES_DIR = os.path.join(PROJECT_DIR, "data", "generated_images")
 INPAINTING_IMAGES_DIR = os.path.join(PROJECT_DIR, "data", "inpainting_images")
+IMAGE_JOBS_DIR = os.path.join(PROJECT_DIR, "data", "image_jobs")
+LOCKS_DIR = os.path.join(PROJECT_DIR, "data", "locks")
+LOCK_BUCKETS = 64  # Number of lock files shared by all the locked resources
+ANALYTICS_DIR = os.path.join(PROJECT_DIR, "data", "analytics")
+ANALYTICS_INTERVAL_SECONDS = 300  # Interval between two ingestions of the history into the analytics store
+ANALYTICS_MAX_PARTS = 20  # The Parquet files of an analytics table are merged beyond this number
+ANALYTICS_PERIODS = {"Last 7 days": 7, "Last 30 days": 30, "Last 90 days": 90, "Last year": 365, "All time": None}
+METRICS_DIR = os.path.join(PROJECT_DIR, "data", "metrics")
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")  # Level of the app logs, e.g. the token usage of each response
+HEALTH_PORT = int(os.environ.get("HEALTH_PORT", 8502))  # Port of the health sidecar
+HEALTH_APP_URL = os.environ.get("HEALTH_APP_URL", "http://localhost:8501")  # Streamlit server checked by /livez
+# Checked by /readyz with the API key of the app. Point it to a stub for offline deployments, empty to skip.
+HEALTH_API_CHECK_URL = os.environ.get("HEALTH_API_CHECK_URL", "https://api.openai.com/v1/models")
+HEALTH_API_CHECK_TTL_SECONDS = 60  # Interval between two API checks, probes in between reuse the last result
+HEALTH_METRICS_INTERVAL_SECONDS = 5  # Interval at which each app process publishes its counters
+HEALTH_SESSION_TTL_SECONDS = 300  # A session is active if it reran in this interval
+
+# Each tenant has its own threads, uploads, generations and inpaintings under TENANTS_DIR.
+# The default tenant, used when the identity header is missing, keeps the directories above.
+TENANTS_DIR = os.path.join(PROJECT_DIR, "data", "tenants")
+TENANT_USAGE_DIR = os.path.join(PROJECT_DIR, "data", "tenant_usage")
+DEFAULT_TENANT = "default"
+TENANT_HEADER = os.environ.get("TENANT_HEADER", "X-Forwarded-User")  # Set by the authenticating reverse proxy
+TENANT_STORAGE_QUOTA_BYTES = int(os.environ.get("TENANT_STORAGE_QUOTA_BYTES", 2 * 1024 ** 3))  # 0 for no quota
+TENANT_DAILY_REQUEST_QUOTA = int(os.environ.get("TENANT_DAILY_REQUEST_QUOTA", 1000))  # OpenAI requests, 0 for no quota
+TENANT_USAGE_TTL_SECONDS = 60  # Interval at which the cached usage counters are refreshed from disk
+
+# "json" (indented, readable), "compact" (JSON without indentation, faster with orjson) or "msgpack"
+THREAD_STORAGE_FORMAT = os.environ.get("THREAD_STORAGE_FORMAT", "json")
+THREAD_COMPRESSION_THRESHOLD = 64 * 1024  # Bytes, larger compact/msgpack threads are zstd compressed if available
 
 MODEL = "gpt-5-mini"
+MODIFIER_SEARCH_LIMIT = 10  # Search results and suggestions shown in the prompt modifiers
+MODIFIER_STATS_TTL_SECONDS = 300  # Interval at which the modifiers used together are mined from the saved generations
+IMAGE_PIPELINE_MAX_PROMPTS = 5  # Images generated from the prompts of an "Image Generator" response
+COMPARE_MODELS = ["gpt-5-mini", "gpt-5", "gpt-4.1", "gpt-4o"]  # Models offered by the comparison chat mode
+
+CHAT_STREAM_FLUSH_SECONDS = 0.5  # Interval at which a streamed response is written to its thread
+CHAT_STREAM_RENDER_SECONDS = 0.1  # Interval at which compared responses are rendered while they stream
+CHAT_STREAM_REFRESH_SECONDS = 1  # Refresh interval of a response streamed by another process
+CHAT_STREAM_STALE_SECONDS = 120  # A response streamed on another host is interrupted if not written for this long
+CHAT_STREAM_HEARTBEAT_SECONDS = 15  # Interval at which a running generation is written, even before its first token
+
+ATTACHMENT_INLINE_CHARS = 20_000  # Larger text attachments are chunked, only their relevant chunks are sent
+ATTACHMENT_CHUNK_CHARS = 2_000  # Size of the chunks of a large text attachment
+ATTACHMENT_TOP_K = 5  # Chunks of the attachments of a thread sent with each message
+ATTACHMENT_INDEX_CACHE_SIZE = 16  # Number of attachment indexes kept in memory
+BM25_K1 = 1.5  # Term frequency saturation of the attachment search
+BM25_B = 0.75  # Length normalization of the attachment search
+
+EXPORT_FORMATS = ["txt", "json", "md", "csv", "parquet", "arrow"]  # Thread export formats
+
+IMAGE_CACHE_BYTES = 256 * 1024 * 1024  # Memory budget of the decoded images and masks shared by all sessions
+MASK_PREVIEW_SIZE = 700  # Max width/height of the mask preview, in pixels
+
+BATCH_INPAINTING_MAX_WORKERS = 4  # Concurrent requests of a batch inpainting
+BATCH_IMAGE_EXTENSIONS = ["jpg", "jpeg", "png"]
+API_MAX_CONCURRENCY = 8  # OpenAI requests waiting for their response headers at the same time
+API_MAX_RETRIES = 5  # Retries of a rate limited or failed OpenAI request
+API_BACKOFF_BASE = 1.0  # Seconds, doubled after each retry
+API_BACKOFF_MAX = 30.0  # Seconds
+
+IMAGE_JOB_MAX_WORKERS = 2  # Background workers generating the variation jobs
+IMAGE_JOBS_REFRESH_SECONDS = 3  # Refresh interval of the variation jobs progress
+IMAGE_JOB_POLL_SECONDS = 5  # Interval at which idle workers look for jobs submitted by other processes
+IMAGE_JOB_LEASE_SECONDS = 600  # A running task is requeued if its worker did not finish it in this time
+IMAGE_JOB_MAX_ATTEMPTS = 3  # A task is failed once this many workers stopped while running it
+
+TIERING_INTERVAL_SECONDS = 3600  # Interval between two passes of the image storage tiering
+TIERING_WEBP_AFTER_DAYS = 7  # Generated and inpainted images older than this are transcoded to lossless WebP
+TIERING_ARCHIVE_AFTER_DAYS = 90  # Generations older than this are moved into monthly archive packs
 
 INTERACTION_TYPES = {'chat': 'ChatGPT',
                      'image': 'DALL-E (Image Generation)',
-                     'inpainting': 'DALL-E (Inpainting) - Beta ⚠️'}
+                     'inpainting': 'DALL-E (Inpainting) - Beta ⚠️',
+                     'analytics': 'Analytics'}
 
 AVATARS = {"user": "🧑‍⚕️", "assistant": "🤖"}
 
@@ -86,12 +156,15 @@ SYSTEM_PROMPTS = {
     "Image Generator": f"""<SYSTEM PROMPT>
         DALLE-3 is an AI art generation model.
         Below are lists of words describing different aspects of an image, that can be used to generate images with DALLE-3:
-        CATEGORIES: {CATEGORIES}
-        STYLES: {STYLES}
-        LIGHTING: {LIGHTING}
-        CAMERA_ANGLES: {CAMERA_ANGLES}
-        COLORS: {COLORS}
-        TEXTURES: {TEXTURES}
-        I want you to write me 5 detailed prompts using several of the above categories. Use as many words from the lists as you find relevant. In the prompt, describe the scene, and follow by adding only relevant modifiers words from the lists that are relevant to the user's scene description and can enhance the image, divided by commas, to alter the mood, style, lighting, and more.
+        CATEGORIES: {', '.join(CATEGORIES)}
+        STYLES: {', '.join(STYLES)}
+        LIGHTING: {', '.join(LIGHTING)}
+        CAMERA_ANGLES: {', '.join(CAMERA_ANGLES)}
+        COLORS: {', '.join(COLORS)}
+        TEXTURES: {', '.join(TEXTURES)}
+        I want you to write me 5 detailed prompts using several of the above categories, as a numbered list with one paragraph per prompt. Use as many words from the lists as you find relevant. In the prompt, describe the scene, and follow by adding only relevant modifiers words from the lists that are relevant to the user's scene description and can enhance the image, divided by commas, to alter the mood, style, lighting, and more.
         Here is the idea you have to work on:
-        </END OF SYSTEM PROMPT>"""}
\ No newline at end of file
+        </END OF SYSTEM PROMPT>"""}
+
+# Without the indentation of the source code, which only costs tokens
+SYSTEM_PROMPTS = {mode: "\n".join(line.strip() for line in prompt.splitlines()) for mode, prompt in SYSTEM_PROMPTS.items()}
@@ -0,0 +1,115 @@
+import csv
+import io
+from datetime import datetime
+from typing import Any, Dict, IO, Iterable, Iterator, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+# One row per message, so the exports of many threads can be concatenated and loaded together
+EXPORT_COLUMNS = ["thread_id", "index", "timestamp", "role", "model", "content"]
+EXPORT_SCHEMA = pa.schema([("thread_id", pa.string()),
+                           ("index", pa.int32()),
+                           ("timestamp", pa.timestamp("us")),
+                           ("role", pa.string()),
+                           ("model", pa.string()),
+                           ("content", pa.string())])
+
+
+def content_text(content: Any) -> str:
+    """
+    Get the text of a message content, images being replaced by their name.
+
+    Args:
+        content (Any): The message content, a string or a list of text and image items
+
+    Returns:
+        str: The text
+    """
+    if not isinstance(content, list):
+        return content
+    return " ".join(item["text"] if item["type"] == "text"
+                    else f"[Image: {item.get('original_name', 'uploaded_image')}]"
+                    for item in content)
+
+
+def parse_timestamp(timestamp: Optional[str]) -> Optional[datetime]:
+    """Parse an ISO timestamp, None for the messages saved before they had one."""
+    return datetime.fromisoformat(timestamp) if timestamp else None
+
+
+def message_rows(threads: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """
+    Flatten threads into one row per message.
+
+    Args:
+        threads (Iterable[Dict[str, Any]]): The thread data
+
+    Yields:
+        Dict[str, Any]: The EXPORT_COLUMNS of a message
+    """
+    for thread_data in threads:
+        for i, message in enumerate(thread_data["messages"]):
+            yield {"thread_id": thread_data["id"],
+                   "index": i,
+                   "timestamp": parse_timestamp(message.get("timestamp")),
+                   "role": message["role"],
+                   "model": message.get("model"),
+                   "content": content_text(message["content"])}
+
+
+def write_csv(threads: Iterable[Dict[str, Any]], file: IO[str]) -> None:
+    """
+    Write the messages of threads as CSV, one row at a time.
+
+    Args:
+        threads (Iterable[Dict[str, Any]]): The thread data
+        file (IO[str]): The text file to write to, opened with newline=""
+    """
+    writer = csv.DictWriter(file, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+    for row in message_rows(threads):
+        row["timestamp"] = row["timestamp"].isoformat() if row["timestamp"] else ""
+        writer.writerow(row)
+
+
+def messages_table(threads: Iterable[Dict[str, Any]]) -> pa.Table:
+    """
+    Get the messages of threads as an Arrow table.
+
+    Args:
+        threads (Iterable[Dict[str, Any]]): The thread data
+
+    Returns:
+        pa.Table: The messages, with the EXPORT_SCHEMA
+    """
+    return pa.Table.from_pylist(list(message_rows(threads)), schema=EXPORT_SCHEMA)
+
+
+def export_bytes(threads: Iterable[Dict[str, Any]], format: str) -> bytes:
+    """
+    Export the messages of threads in a tabular format.
+
+    Args:
+        threads (Iterable[Dict[str, Any]]): The thread data
+        format (str): "csv", "parquet" or "arrow" (Arrow IPC file, also readable as Feather)
+
+    Returns:
+        bytes: The exported file
+    """
+    if format == "csv":
+        buffer = io.StringIO(newline="")
+        write_csv(threads, buffer)
+        return buffer.getvalue().encode("utf-8")
+
+    buffer = io.BytesIO()
+    table = messages_table(threads)
+    if format == "parquet":
+        pq.write_table(table, buffer, compression="zstd")
+    elif format == "arrow":
+        with pa.ipc.new_file(buffer, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        raise ValueError(f"Unsupported export format: {format}")
+    return buffer.getvalue()
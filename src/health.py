@@ -0,0 +1,273 @@
+"""
+Liveness, readiness and Prometheus metrics endpoints, served by a sidecar process next to the app.
+
+The app processes publish their counters (reruns, active sessions, in-flight API calls) to snapshot
+files, which the sidecar reads, so the endpoints answer before the first session and without loading the UI.
+
+Usage:
+    python src/health.py --port 8502
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+import tomllib
+from glob import glob
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Tuple
+
+import requests
+
+from constants import (PROJECT_DIR, IMAGE_JOBS_DIR, LOCKS_DIR, ANALYTICS_DIR, METRICS_DIR, DEFAULT_TENANT, HEALTH_PORT,
+                       HEALTH_APP_URL, HEALTH_API_CHECK_URL, HEALTH_API_CHECK_TTL_SECONDS,
+                       HEALTH_METRICS_INTERVAL_SECONDS, HEALTH_SESSION_TTL_SECONDS)
+from storage import atomic_write_json, read_json, remove_file
+from tenants import get_tenant_usage, list_tenants, tenant_paths
+from thread_store import list_thread_files, read_thread_file
+
+
+logger = logging.getLogger(__name__)
+
+_sessions = {}  # Session ID -> time of its last rerun
+_counters = {"reruns": 0}
+_counters_lock = threading.Lock()
+_api_check = {"checked": float("-inf"), "result": (False, "not checked")}
+_api_check_lock = threading.Lock()
+
+
+def record_rerun(session_id: str) -> None:
+    """
+    Count a rerun of the app script.
+
+    Args:
+        session_id (str): The ID of the session rerunning, to count the active sessions
+    """
+    with _counters_lock:
+        _counters["reruns"] += 1
+        _sessions[session_id] = time.monotonic()
+
+
+def process_snapshot() -> Dict[str, Any]:
+    """
+    Get the counters of this app process.
+
+    Returns:
+        Dict[str, Any]: The reruns, the sessions rerun in the last HEALTH_SESSION_TTL_SECONDS,
+        the queued and in-flight OpenAI requests, and the open response streams
+    """
+    from chat_worker import open_streams  # Only used in the app processes
+    from scheduler import get_scheduler
+    scheduler_metrics = get_scheduler().metrics()
+    streams = open_streams()
+    now = time.monotonic()
+    with _counters_lock:
+        for session_id in [s for s, seen in _sessions.items() if now - seen > HEALTH_SESSION_TTL_SECONDS]:
+            del _sessions[session_id]
+        return {"process": f"{socket.gethostname()}_{os.getpid()}",
+                "updated": time.time(),
+                "reruns": _counters["reruns"],
+                "active_sessions": len(_sessions),
+                # The scheduler releases a request when its headers arrive, its stream is counted from then on
+                "api_in_flight": scheduler_metrics["in_flight"] + streams,
+                "api_streams": streams,
+                "api_queue_depth": scheduler_metrics["queue_depth"]}
+
+
+def start_metrics_publisher() -> threading.Thread:
+    """
+    Start the background thread writing the counters of this process every HEALTH_METRICS_INTERVAL_SECONDS.
+
+    Returns:
+        threading.Thread: The publisher thread
+    """
+    def work():
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        while True:
+            try:
+                snapshot = process_snapshot()
+                atomic_write_json(os.path.join(METRICS_DIR, f"{snapshot['process']}.json"), snapshot)
+            except Exception:
+                logger.exception("Metrics publication failed")
+            time.sleep(HEALTH_METRICS_INTERVAL_SECONDS)
+
+    publisher = threading.Thread(target=work, daemon=True)
+    publisher.start()
+    return publisher
+
+
+def read_snapshots() -> List[Dict[str, Any]]:
+    """
+    Read the counters published by the running app processes, deleting those of the stopped ones.
+
+    Returns:
+        List[Dict[str, Any]]: The snapshots updated in the last 3 publication intervals
+    """
+    snapshots = []
+    for file_path in glob(os.path.join(METRICS_DIR, "*.json")):
+        snapshot = read_json(file_path)
+        if snapshot is None:
+            continue
+        age = time.time() - snapshot["updated"]
+        if age <= 3 * HEALTH_METRICS_INTERVAL_SECONDS:
+            snapshots.append(snapshot)
+        elif age > HEALTH_SESSION_TTL_SECONDS:
+            remove_file(file_path)
+    return snapshots
+
+
+def check_liveness() -> Tuple[bool, str]:
+    """
+    Check that the Streamlit server answers its own health endpoint.
+
+    Returns:
+        Tuple[bool, str]: Whether the app is alive, and the reason if not
+    """
+    try:
+        response = requests.get(f"{HEALTH_APP_URL}/_stcore/health", timeout=5)
+    except requests.RequestException as e:
+        return False, str(e)
+    return response.ok, f"HTTP {response.status_code}"
+
+
+def check_data_dirs() -> Tuple[bool, str]:
+    """Check that the shared data directories and those of the default tenant are writable."""
+    directories = list(tenant_paths(DEFAULT_TENANT).values()) + [IMAGE_JOBS_DIR, LOCKS_DIR, ANALYTICS_DIR, METRICS_DIR]
+    try:
+        for directory in directories:
+            os.makedirs(directory, exist_ok=True)
+            with tempfile.TemporaryFile(dir=directory):
+                pass
+    except OSError as e:
+        return False, str(e)
+    return True, f"{len(directories)} directories writable"
+
+
+def check_thread_index() -> Tuple[bool, str]:
+    """Check that the thread directories of every tenant can be listed, and the last updated thread decoded."""
+    try:
+        files = []
+        for tenant_id in list_tenants():
+            threads_dir = tenant_paths(tenant_id)["threads"]
+            if os.path.isdir(threads_dir):
+                files += list_thread_files(threads_dir)
+        if files:
+            read_thread_file(max(files, key=os.path.getmtime))
+    except Exception as e:
+        return False, f"{type(e).__name__}: {e}"
+    return True, f"{len(files)} threads"
+
+
+def _api_key() -> str:
+    """Get the OpenAI API key from the environment, or the Streamlit secrets of the app."""
+    if os.environ.get("OPENAI_API_KEY"):
+        return os.environ["OPENAI_API_KEY"]
+    try:
+        with open(os.path.join(PROJECT_DIR, ".streamlit", "secrets.toml"), "rb") as f:
+            return tomllib.load(f).get("openai_api_key", "")
+    except (OSError, tomllib.TOMLDecodeError):
+        return ""
+
+
+def check_api() -> Tuple[bool, str]:
+    """
+    Check that the API answers HEALTH_API_CHECK_URL with the credentials of the app, at most once per
+    HEALTH_API_CHECK_TTL_SECONDS. Point it to a stub for offline deployments, or set it empty to skip the check.
+    """
+    if not HEALTH_API_CHECK_URL:
+        return True, "skipped"
+    with _api_check_lock:
+        if time.monotonic() - _api_check["checked"] < HEALTH_API_CHECK_TTL_SECONDS:
+            return _api_check["result"]
+        try:
+            response = requests.get(HEALTH_API_CHECK_URL, headers={"Authorization": f"Bearer {_api_key()}"}, timeout=5)
+            result = (response.ok, f"HTTP {response.status_code}")
+        except requests.RequestException as e:
+            result = (False, str(e))
+        _api_check.update(checked=time.monotonic(), result=result)
+        return result
+
+
+def check_readiness() -> Tuple[bool, Dict[str, Dict[str, Any]]]:
+    """
+    Run the readiness checks.
+
+    Returns:
+        Tuple[bool, Dict[str, Dict[str, Any]]]: Whether all the checks passed, and the result of each one
+    """
+    checks = {"data_dirs": check_data_dirs(), "thread_index": check_thread_index(), "api": check_api()}
+    results = {name: {"ok": ok, "detail": detail} for name, (ok, detail) in checks.items()}
+    return all(ok for ok, _ in checks.values()), results
+
+
+def render_metrics() -> str:
+    """
+    Render the metrics in the Prometheus text format.
+
+    Returns:
+        str: The metrics of the running app processes and the storage of each tenant
+    """
+    snapshots = read_snapshots()
+    families = [("llm_chat_reruns_total", "counter", "Reruns of the app script", "reruns"),
+                ("llm_chat_active_sessions", "gauge", f"Sessions rerun in the last {HEALTH_SESSION_TTL_SECONDS}s", "active_sessions"),
+                ("llm_chat_api_in_flight", "gauge", "OpenAI requests in flight, including the open response streams", "api_in_flight"),
+                ("llm_chat_api_streams", "gauge", "Chat response streams open", "api_streams"),
+                ("llm_chat_api_queue_depth", "gauge", "OpenAI requests waiting for the scheduler", "api_queue_depth")]
+    lines = []
+    for name, kind, help_text, key in families:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        # Snapshots of processes started before a metric was added lack it
+        lines += [f'{name}{{process="{snapshot["process"]}"}} {snapshot.get(key, 0)}' for snapshot in snapshots]
+
+    lines += ["# HELP llm_chat_storage_bytes Storage used by the data of a tenant",
+              "# TYPE llm_chat_storage_bytes gauge"]
+    for tenant_id in list_tenants():
+        storage_bytes = get_tenant_usage(tenant_id).stats()["storage_bytes"]
+        lines.append(f'llm_chat_storage_bytes{{tenant="{tenant_id}"}} {storage_bytes}')
+    return "\n".join(lines) + "\n"
+
+
+class HealthHandler(BaseHTTPRequestHandler):
+    """Serves /livez, /readyz and /metrics."""
+
+    def _send(self, status: int, body: str, content_type: str) -> None:
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        path = self.path.split("?")[0]
+        if path == "/livez":
+            ok, detail = check_liveness()
+            self._send(200 if ok else 503, json.dumps({"ok": ok, "detail": detail}), "application/json")
+        elif path == "/readyz":
+            ok, checks = check_readiness()
+            self._send(200 if ok else 503, json.dumps({"ok": ok, "checks": checks}), "application/json")
+        elif path == "/metrics":
+            self._send(200, render_metrics(), "text/plain; version=0.0.4; charset=utf-8")
+        else:
+            self._send(404, "Not found\n", "text/plain; charset=utf-8")
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass  # Probes would flood the logs
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=HEALTH_PORT)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), HealthHandler)
+    print(f"Health endpoints listening on {args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
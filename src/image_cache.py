@@ -0,0 +1,118 @@
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable
+
+from PIL import Image
+
+from constants import IMAGE_CACHE_BYTES
+
+
+_image_cache = None
+_image_cache_lock = threading.Lock()
+
+
+def image_size_in_bytes(image: Image.Image) -> int:
+    """
+    Estimate the memory used by a decoded image.
+
+    Args:
+        image (Image.Image): The image
+
+    Returns:
+        int: The size of its pixel data in bytes
+    """
+    return image.width * image.height * len(image.getbands())
+
+
+def estimate_size(value: Any) -> int:
+    """
+    Roughly estimate the memory used by a session state value, including decoded images and bytes.
+
+    Args:
+        value (Any): The value
+
+    Returns:
+        int: The estimated size in bytes
+    """
+    if isinstance(value, Image.Image):
+        return image_size_in_bytes(value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return sys.getsizeof(value) + sum(estimate_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class ImageCache:
+    """LRU cache of decoded images, bounded by the total size of their pixel data, shared by all sessions."""
+
+    def __init__(self, max_bytes: int):
+        """
+        Args:
+            max_bytes (int): The memory budget of the cached images
+        """
+        self.max_bytes = max_bytes
+        self.images = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_or_load(self, key: Hashable, load: Callable[[], Image.Image]) -> Image.Image:
+        """
+        Get a decoded image, loading it on a miss and evicting the least recently used images over budget.
+        The returned image is shared, so it must not be modified.
+
+        Args:
+            key (Hashable): The cache key, e.g. a content hash
+            load (Callable[[], Image.Image]): Decodes the image
+
+        Returns:
+            Image.Image: The decoded image
+        """
+        with self.lock:
+            if key in self.images:
+                self.images.move_to_end(key)
+                self.hits += 1
+                return self.images[key]
+            self.misses += 1
+
+        image = load()
+        image.load()
+        size = image_size_in_bytes(image)
+
+        with self.lock:
+            if key not in self.images:
+                self.images[key] = image
+                self.bytes += size
+            # Keep the new image even if it is over budget on its own, it is about to be displayed
+            while self.bytes > self.max_bytes and len(self.images) > 1:
+                _, evicted = self.images.popitem(last=False)
+                self.bytes -= image_size_in_bytes(evicted)
+        return image
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the cache usage.
+
+        Returns:
+            Dict[str, int]: The number of images, their size, the budget, hits and misses
+        """
+        with self.lock:
+            return {"images": len(self.images), "bytes": self.bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses}
+
+
+def get_image_cache() -> ImageCache:
+    """
+    Get the image cache of the process.
+
+    Returns:
+        ImageCache: The image cache
+    """
+    global _image_cache
+    with _image_cache_lock:
+        if _image_cache is None:
+            _image_cache = ImageCache(IMAGE_CACHE_BYTES)
+        return _image_cache
@@ -0,0 +1,111 @@
+import concurrent.futures
+import re
+import threading
+from typing import Callable, Dict, List
+
+from constants import IMAGE_PIPELINE_MAX_PROMPTS
+
+
+# The start of a numbered prompt, e.g. "1. ", "**2.** " or "### Prompt 3:"
+PROMPT_START = re.compile(r"^[ \t>#*_]*(?:prompt[ \t]*)?(\d+)[ \t]*[.):][ \t*_]*", re.IGNORECASE | re.MULTILINE)
+
+
+def clean_prompt(text: str) -> str:
+    """
+    Clean a prompt parsed from a chat response.
+
+    Args:
+        text (str): The text of a numbered list item
+
+    Returns:
+        str: The prompt, without markdown, quotes nor the text following its paragraph
+    """
+    text = text.strip().split("\n\n")[0]
+    text = text.replace("**", "").replace("`", "")
+    return " ".join(text.split()).strip("\"'“”")
+
+
+class PromptStreamParser:
+    """Parses the numbered prompts of a streamed response, each one as soon as the next one starts."""
+
+    def __init__(self):
+        self.buffer = ""
+        self.emitted = 0
+
+    def _prompts(self, complete: bool) -> List[str]:
+        starts = list(PROMPT_START.finditer(self.buffer))
+        ends = [start.start() for start in starts[1:]] + ([len(self.buffer)] if complete else [])
+        prompts = []
+        for start, end in list(zip(starts, ends))[self.emitted:]:
+            prompt = clean_prompt(self.buffer[start.end():end])
+            if prompt:
+                prompts.append(prompt)
+            self.emitted += 1
+        return prompts
+
+    def feed(self, text: str) -> List[str]:
+        """
+        Add a chunk of the response.
+
+        Args:
+            text (str): The chunk
+
+        Returns:
+            List[str]: The prompts completed by this chunk
+        """
+        self.buffer += text
+        return self._prompts(complete=False)
+
+    def close(self) -> List[str]:
+        """
+        End the response.
+
+        Returns:
+            List[str]: The last prompt, if any
+        """
+        return self._prompts(complete=True)
+
+
+class ImagePipeline:
+    """
+    Generates the images of the prompts of a streamed response while the rest of it is still streaming.
+    At most IMAGE_PIPELINE_MAX_PROMPTS prompts are generated.
+    """
+
+    def __init__(self, generate_image: Callable[[str], str]):
+        """
+        Args:
+            generate_image (Callable[[str], str]): Generates and saves the image of a prompt, returning the generation ID
+        """
+        self.generate_image = generate_image
+        self.parser = PromptStreamParser()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=IMAGE_PIPELINE_MAX_PROMPTS)
+        self.futures = []
+        self.lock = threading.Lock()
+
+    def _submit(self, prompts: List[str]) -> None:
+        with self.lock:
+            for prompt in prompts[:IMAGE_PIPELINE_MAX_PROMPTS - len(self.futures)]:
+                self.futures.append(self.executor.submit(self.generate_image, prompt))
+
+    def feed(self, text: str) -> None:
+        """Add a chunk of the response, starting the generation of the prompts it completes."""
+        self._submit(self.parser.feed(text))
+
+    def close(self) -> None:
+        """End the response and wait for its images."""
+        self._submit(self.parser.close())
+        self.executor.shutdown(wait=True)
+
+    def results(self) -> Dict[str, List[str]]:
+        """
+        Get the images generated so far.
+
+        Returns:
+            Dict[str, List[str]]: The IDs of the saved generations, and the errors of the failed ones, in prompt order
+        """
+        with self.lock:
+            futures = list(self.futures)
+        done = [future for future in futures if future.done()]
+        return {"generation_ids": [future.result() for future in done if future.exception() is None],
+                "errors": [str(future.exception()) for future in done if future.exception() is not None]}
@@ -0,0 +1,228 @@
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+from glob import glob
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from constants import IMAGE_JOB_LEASE_SECONDS, IMAGE_JOB_MAX_ATTEMPTS, IMAGE_JOB_POLL_SECONDS
+from storage import atomic_write_json, file_lock, read_json, remove_file
+
+
+JOBS_LOCK = "image_jobs"
+
+
+class JobQueue:
+    """
+    Persistent queue of image generation jobs, processed by a pool of background workers.
+
+    Each job is a list of tasks (one image each) stored as a JSON file in `jobs_dir`, so jobs
+    keep running across Streamlit reruns and browser disconnects, and resume after a restart.
+    The files are the only state: several processes can share the directory, tasks being
+    claimed under a file lock and leased, so a task is requeued only if its worker died.
+    """
+
+    def __init__(self, jobs_dir: str, run_task: Callable[[Dict[str, Any], Dict[str, Any], Optional[str]], str],
+                 max_workers: int):
+        """
+        Args:
+            jobs_dir (str): The directory where jobs are stored
+            run_task (Callable): Generates the image of a task for the owner of its job, and returns the ID of the saved generation
+            max_workers (int): The number of worker threads
+        """
+        self.jobs_dir = jobs_dir
+        self.run_task = run_task
+        self.max_workers = max_workers
+        self.tasks_available = threading.Condition()
+        self.workers = []
+        os.makedirs(self.jobs_dir, exist_ok=True)
+
+    def _job_path(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, f"{job_id}.json")
+
+    def _read_jobs(self) -> List[Dict[str, Any]]:
+        """Read every job, oldest first."""
+        jobs = []
+        for file_path in glob(os.path.join(self.jobs_dir, "*.json")):
+            job = read_json(file_path)
+            if job is not None:
+                jobs.append(job)
+        return sorted(jobs, key=lambda x: x["created"])
+
+    def _save_job(self, job: Dict[str, Any]) -> None:
+        """Write a job to disk. Must be called with the jobs lock held."""
+        job["updated"] = datetime.now().isoformat()
+        atomic_write_json(self._job_path(job["id"]), job)
+
+    def start(self) -> None:
+        """Start the worker threads."""
+        for _ in range(self.max_workers):
+            worker = threading.Thread(target=self._work, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, prompts: List[str], dalle_options: Dict[str, Any], owner: Optional[str] = None) -> str:
+        """
+        Queue a job generating images for each prompt, one task per image, so a failed image is
+        retried without paying again for the images of the same prompt that succeeded.
+
+        Args:
+            prompts (List[str]): The prompts to generate
+            dalle_options (Dict[str, Any]): Options for DALL-E image generation
+            owner (Optional[str]): The tenant the job belongs to
+
+        Returns:
+            str: The ID of the job
+        """
+        job = {
+            "id": str(uuid.uuid4()),
+            "created": datetime.now().isoformat(),
+            "dalle_options": dalle_options,
+            "owner": owner,
+            "tasks": [{"prompt": prompt,
+                       "status": "queued",
+                       "attempts": 0,
+                       "leased_until": None,
+                       "generation_id": None,
+                       "error": None} for prompt in prompts for _ in range(dalle_options["n"])]
+        }
+        with file_lock(JOBS_LOCK, bucketed=False):
+            self._save_job(job)
+        with self.tasks_available:
+            self.tasks_available.notify_all()
+        return job["id"]
+
+    def cancel(self, job_id: str) -> None:
+        """
+        Cancel the queued tasks of a job. Running tasks are completed.
+
+        Args:
+            job_id (str): The ID of the job
+        """
+        with file_lock(JOBS_LOCK, bucketed=False):
+            job = read_json(self._job_path(job_id))
+            if job is None:
+                return
+            for task in job["tasks"]:
+                if task["status"] == "queued":
+                    task["status"] = "cancelled"
+            self._save_job(job)
+
+    def delete(self, job_id: str) -> None:
+        """
+        Delete a job, cancelling its queued tasks. The generations already saved are kept.
+
+        Args:
+            job_id (str): The ID of the job
+        """
+        with file_lock(JOBS_LOCK, bucketed=False):
+            remove_file(self._job_path(job_id))
+
+    def list_jobs(self, owner: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        List the jobs of an owner, most recent first, with their progress.
+
+        Args:
+            owner (Optional[str]): The tenant the jobs belong to
+
+        Returns:
+            List[Dict[str, Any]]: Each job, with `done`, `failed` and `total` task counts
+        """
+        jobs = [job for job in self._read_jobs() if job.get("owner") == owner]
+        for job in jobs:
+            statuses = [task["status"] for task in job["tasks"]]
+            job["total"] = len(statuses)
+            job["done"] = statuses.count("done")
+            job["failed"] = statuses.count("failed")
+            job["active"] = "queued" in statuses or "running" in statuses
+        return jobs[::-1]
+
+    def _claim_task(self) -> Optional[Tuple[Dict[str, Any], int]]:
+        """
+        Pick the oldest queued task, or a running task whose worker died, and lease it.
+
+        Returns:
+            Optional[Tuple[Dict[str, Any], int]]: The job and the index of the task, or None if there is nothing to do
+        """
+        now = datetime.now()
+        with file_lock(JOBS_LOCK, bucketed=False):
+            for job in self._read_jobs():
+                for index, task in enumerate(job["tasks"]):
+                    leased_until = task.get("leased_until")
+                    expired = task["status"] == "running" and (not leased_until or datetime.fromisoformat(leased_until) < now)
+                    if expired and task["attempts"] >= IMAGE_JOB_MAX_ATTEMPTS:
+                        task["status"] = "failed"
+                        task["error"] = "The worker stopped while generating this image"
+                        self._save_job(job)
+                        continue
+                    if task["status"] == "queued" or expired:
+                        task["status"] = "running"
+                        task["attempts"] += 1
+                        task["leased_until"] = (now + timedelta(seconds=IMAGE_JOB_LEASE_SECONDS)).isoformat()
+                        self._save_job(job)
+                        return job, index
+        return None
+
+    def _leased_task(self, job_id: str, index: int, attempt: int) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        """Read a job, and its task if still leased by the worker of this attempt. Must be called with the jobs lock held."""
+        job = read_json(self._job_path(job_id))
+        if job is None:
+            return None, None
+        task = job["tasks"][index]
+        if task["status"] != "running" or task["attempts"] != attempt:
+            return job, None
+        return job, task
+
+    def _renew_lease(self, job_id: str, index: int, attempt: int, stop: threading.Event) -> None:
+        """
+        Extend the lease of a task every third of IMAGE_JOB_LEASE_SECONDS until stopped, so a task waiting in
+        the scheduler queue or backing off is not claimed by another worker, which would pay for the image twice.
+        """
+        while not stop.wait(IMAGE_JOB_LEASE_SECONDS / 3):
+            with file_lock(JOBS_LOCK, bucketed=False):
+                job, task = self._leased_task(job_id, index, attempt)
+                if task is None:
+                    return  # The job was deleted, or the lease lost after this process stalled
+                task["leased_until"] = (datetime.now() + timedelta(seconds=IMAGE_JOB_LEASE_SECONDS)).isoformat()
+                self._save_job(job)
+
+    def _finish_task(self, job_id: str, index: int, attempt: int, status: str, error: Optional[str],
+                     generation_id: Optional[str]) -> None:
+        """Record the outcome of a task, unless its job was deleted or its lease taken by another worker meanwhile."""
+        with file_lock(JOBS_LOCK, bucketed=False):
+            job, task = self._leased_task(job_id, index, attempt)
+            if task is None:
+                return
+            task["status"] = status
+            task["error"] = error
+            task["generation_id"] = generation_id
+            task["leased_until"] = None
+            self._save_job(job)
+
+    def _work(self) -> None:
+        """Worker loop: run queued tasks. Rate limits and retries are handled by the request scheduler."""
+        while True:
+            claimed = self._claim_task()
+            if claimed is None:
+                # Woken up by submissions of this process, polls for the ones of other processes
+                with self.tasks_available:
+                    self.tasks_available.wait(timeout=IMAGE_JOB_POLL_SECONDS)
+                continue
+            job, index = claimed
+            task = job["tasks"][index]
+
+            stop_renewal = threading.Event()
+            renewal = threading.Thread(target=self._renew_lease, args=(job["id"], index, task["attempts"], stop_renewal),
+                                       daemon=True)
+            renewal.start()
+            try:
+                generation_id = self.run_task(task, job["dalle_options"], job.get("owner"))
+                status, error = "done", None
+            except Exception as e:
+                # Either not retryable (e.g. content policy), or the scheduler already retried it
+                status, error, generation_id = "failed", str(e), None
+            finally:
+                stop_renewal.set()
+                renewal.join()
+
+            self._finish_task(job["id"], index, task["attempts"], status, error, generation_id)
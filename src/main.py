@@ -2,30 +2,81 @@ from openai import OpenAI
 import streamlit as st
 import base64
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 import uuid
 import hashlib
 from PIL import Image
 import io
-from typing import Dict, List, Union, Any, Tuple
+from typing import Dict, List, Union, Any, Tuple, Iterator, Optional, Callable
 import fitz
 from glob import glob
 import os
 import requests
-import shutil
 import concurrent.futures
-from PIL import Image, ImageDraw
+import functools
+import itertools
+import logging
+import mimetypes
+import threading
+import time
+import openai
+import pandas as pd
 from streamlit_cropper import st_cropper
 
 from constants import *
+from chat_worker import ChatGeneration, get_generation, usage_stats, is_generation_alive, mark_interrupted, read_message, start_chat_generation
+from tenants import TENANT_DATA_DIRS, QuotaExceededError, get_tenant_usage, tenant_id_from_headers, tenant_paths, tenant_root
+from jobs import JobQueue
+from storage import atomic_write_bytes, atomic_write_json, file_lock, read_json, remove_file, remove_tree
+from thread_store import delete_thread_files, list_thread_files, read_thread, read_thread_file, write_thread
+from tiering import read_archived_image, remove_from_archive, start_tiering_worker
+from image_cache import estimate_size, get_image_cache
+from scheduler import PRIORITY_BATCH, PRIORITY_INTERACTIVE, get_scheduler
+from analytics import compute_aggregates, ingestion_state, read_table, run_ingestion_pass, start_ingestion_worker
+from attachments import delete_attachment, retrieve_excerpts, save_attachment
+from exports import export_bytes
+from health import record_rerun, start_metrics_publisher
+from modifiers import MODIFIER_GROUPS, ModifierIndex, system_prompt_tokens
+from masks import build_mask, mask_preview, rectangle_from_box, scale_shapes
 
 
 def init_directories() -> None:
     """Initialize necessary directories for storing thread history and images."""
-    os.makedirs(THREADS_DIR, exist_ok=True)
-    os.makedirs(UPLOADED_IMAGES_DIR, exist_ok=True)
-    os.makedirs(GENERATED_IMAGES_DIR, exist_ok=True)
-    os.makedirs(INPAINTING_IMAGES_DIR, exist_ok=True)
+    for directory in tenant_paths(st.session_state.tenant_id).values():
+        os.makedirs(directory, exist_ok=True)
+    os.makedirs(IMAGE_JOBS_DIR, exist_ok=True)
+    os.makedirs(LOCKS_DIR, exist_ok=True)
+
+
+def get_data_dir(name: str) -> str:
+    """
+    Get a data directory of the tenant of the session.
+
+    Args:
+        name (str): "threads", "uploaded_images", "generated_images", "inpainting_images", "attachments" or "image_archive"
+
+    Returns:
+        str: The directory
+    """
+    return tenant_paths(st.session_state.tenant_id)[name]
+
+
+def consume_quota(requests: int) -> bool:
+    """
+    Check the quotas of the tenant of the session before sending requests to the API, and record them.
+
+    Args:
+        requests (int): The number of requests about to be sent
+
+    Returns:
+        bool: False if a quota is exceeded, in which case an error is displayed
+    """
+    try:
+        get_tenant_usage(st.session_state.tenant_id).consume(requests)
+        return True
+    except QuotaExceededError as e:
+        st.error(str(e), icon="🚫")
+        return False
 
 
 def load_threads() -> Dict[str, Dict[str, Any]]:
@@ -36,26 +87,43 @@ def load_threads() -> Dict[str, Dict[str, Any]]:
         Dict[str, Dict[str, Any]]: A dictionary of thread IDs to thread data
     """
     threads = {}
-    current_time = datetime.now()
-    for file_path in glob(os.path.join(THREADS_DIR, "*.json")):
-        with open(file_path, 'r') as f:
-            thread_data = json.load(f)
-            thread_id = thread_data["id"]
-            last_updated = datetime.fromisoformat(thread_data["last_updated"])
-            
-            # Check if the thread is empty and older than 2 minutes
-            if not thread_data["messages"] and (current_time - last_updated).total_seconds() > 120:
-                # Delete the empty thread
-                os.remove(file_path)
-            else:
-                threads[thread_id] = thread_data
+    for file_path in list_thread_files(get_data_dir("threads")):
+        thread_data = read_thread_file(file_path)
+        if thread_data is None:  # Deleted by another process
+            continue
+
+        if is_expired_empty_thread(thread_data):
+            # Check again under the lock, another process may have written to the thread meanwhile
+            with file_lock(thread_data["id"]):
+                thread_data = read_thread_file(file_path)
+                if thread_data is not None and is_expired_empty_thread(thread_data):
+                    remove_file(file_path)
+                    continue
+            if thread_data is None:
+                continue
+
+        threads[thread_data["id"]] = thread_data
     
     return threads
 
 
+def is_expired_empty_thread(thread_data: Dict[str, Any]) -> bool:
+    """
+    Check if a thread is empty and older than 2 minutes, in which case it is deleted.
+
+    Args:
+        thread_data (Dict[str, Any]): The thread data
+
+    Returns:
+        bool: True if the thread should be deleted
+    """
+    last_updated = datetime.fromisoformat(thread_data["last_updated"])
+    return not thread_data["messages"] and (datetime.now() - last_updated).total_seconds() > 120
+
+
 def save_thread(thread_id: str, messages: List[Dict[str, Any]]) -> None:
     """
-    Save a conversation thread to disk.
+    Save a conversation thread to disk, in the configured storage format.
 
     Args:
         thread_id (str): The unique identifier for the thread
@@ -66,9 +134,31 @@ def save_thread(thread_id: str, messages: List[Dict[str, Any]]) -> None:
         "last_updated": datetime.now().isoformat(),
         "messages": messages
     }
-    file_path = os.path.join(THREADS_DIR, f"{thread_id}.json")
-    with open(file_path, 'w', encoding='utf-8') as f:
-        json.dump(thread_data, f, indent=4, ensure_ascii=False)
+    with file_lock(thread_id):
+        write_thread(thread_data, get_data_dir("threads"))
+
+
+def append_user_message(thread_id: str, message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Append a user message to a thread, re-read under its lock, so the messages written meanwhile by other
+    sessions or by a generation worker are kept.
+
+    Args:
+        thread_id (str): The ID of the thread
+        message (Dict[str, Any]): The user message
+
+    Returns:
+        Optional[Dict[str, Any]]: The updated thread data, or None if the thread was deleted or a response
+        is already being generated in it
+    """
+    with file_lock(thread_id):
+        thread_data = read_thread(thread_id, get_data_dir("threads"))
+        if thread_data is None or is_streaming(thread_data):
+            return None
+        thread_data["messages"].append(message)
+        thread_data["last_updated"] = datetime.now().isoformat()
+        write_thread(thread_data, get_data_dir("threads"))
+    return thread_data
 
 
 def create_new_thread() -> Tuple[str, Dict[str, Any]]:
@@ -102,22 +192,21 @@ def delete_thread(thread_id: str, threads: Dict[str, Dict[str, Any]]) -> Dict[st
     if thread_id in threads:
         thread_data = threads[thread_id]
         
-        # Delete associated files
-        for message in thread_data["messages"]:
-            if isinstance(message["content"], list):
-                for content in message["content"]:
-                    if content["type"] == "image_url" and "filename" in content:
-                        image_path = os.path.join(UPLOADED_IMAGES_DIR, content["filename"])
-                        if os.path.exists(image_path):
-                            os.remove(image_path)
+        with file_lock(thread_id):
+            # Delete associated files
+            for message in thread_data["messages"]:
+                if isinstance(message["content"], list):
+                    for content in message["content"]:
+                        if content["type"] == "image_url" and "filename" in content:
+                            remove_file(os.path.join(get_data_dir("uploaded_images"), content["filename"]))
+                for attachment in message.get("attachments", []):
+                    delete_attachment(get_data_dir("attachments"), attachment["id"])
+
+            # Delete the thread file
+            delete_thread_files(thread_id, get_data_dir("threads"))
 
         # Delete the thread data
         del threads[thread_id]
-        
-        # Delete the thread JSON file
-        file_path = os.path.join(THREADS_DIR, f"{thread_id}.json")
-        if os.path.exists(file_path):
-            os.remove(file_path)
 
     return threads
 
@@ -137,10 +226,11 @@ def save_uploaded_image(image_file, thread_id: str) -> str:
     image_hash = hashlib.md5(image_bytes).hexdigest()
     image_ext = image_file.type.split('/')[-1]
     image_filename = f"{thread_id}_{image_hash}.{image_ext}"
-    image_path = os.path.join(UPLOADED_IMAGES_DIR, image_filename)
+    image_path = os.path.join(get_data_dir("uploaded_images"), image_filename)
 
     if not os.path.exists(image_path):
-        Image.open(io.BytesIO(image_bytes)).save(image_path)
+        Image.open(io.BytesIO(image_bytes)).verify()
+        atomic_write_bytes(image_path, image_bytes)
 
     return image_filename
 
@@ -152,17 +242,144 @@ def display_message(message: Dict[str, Any]) -> None:
     Args:
         message (Dict[str, Any]): The message to display
     """
-    if isinstance(message["content"], list):
+    if "comparisons" in message:
+        display_comparisons(message["comparisons"])
+    elif isinstance(message["content"], list):
         for content in message["content"]:
             if content["type"] == "text":
                 st.markdown(content["text"])
             elif content["type"] == "image_url" and "filename" in content:
-                image_path = os.path.join(UPLOADED_IMAGES_DIR, content["filename"])
+                image_path = os.path.join(get_data_dir("uploaded_images"), content["filename"])
                 if os.path.exists(image_path):
                     st.image(image_path)
     else:
         st.markdown(message["content"])
 
+    if message.get("image_generations"):
+        display_linked_generations(message["image_generations"])
+    for error in message.get("image_errors", []):
+        st.error(f"Error generating an image: {error}")
+
+    if message.get("status") == "interrupted":
+        st.warning("The response was interrupted before it was complete.", icon="⚠️")
+    elif message.get("status") == "failed":
+        st.error(f"Error generating the response: {message.get('error')}")
+
+
+def display_linked_generations(generation_ids: List[str]) -> None:
+    """
+    Display the images generated from the prompts of a chat message.
+
+    Args:
+        generation_ids (List[str]): The IDs of the generations
+    """
+    generations = [generation for generation in map(load_image_generation, generation_ids) if generation is not None]
+    for column, generation in zip(st.columns(max(len(generations), 1)), generations):
+        with column:
+            for _, image in load_generation_images(generation):
+                st.image(image, caption=generation["prompt"][:60] + "...", use_column_width=True)
+
+
+def display_comparisons(comparisons: List[Dict[str, Any]]) -> None:
+    """
+    Display the responses of several models side by side, with their latency and token usage.
+
+    Args:
+        comparisons (List[Dict[str, Any]]): The response of each model
+    """
+    for column, comparison in zip(st.columns(len(comparisons)), comparisons):
+        with column:
+            details = [f"**{comparison['model']}**"]
+            if "latency" in comparison:
+                details.append(f"{comparison['latency']:.1f}s")
+            if "first_token_latency" in comparison:
+                details.append(f"first token {comparison['first_token_latency']:.1f}s")
+            if "usage" in comparison:
+                details.append(f"{comparison['usage']['prompt_tokens']} → {comparison['usage']['completion_tokens']} tokens")
+            st.caption(" · ".join(details))
+            st.markdown(comparison["content"])
+            if "error" in comparison:
+                st.error(comparison["error"])
+
+
+def stream_comparisons(generation: ChatGeneration) -> None:
+    """
+    Stream the responses of a comparison into parallel columns until all of them are complete.
+
+    Args:
+        generation (ChatGeneration): The comparison generation
+    """
+    placeholders = [column.empty() for column in st.columns(len(generation.models))]
+    version, done = 0, False
+    while not done:
+        version, texts, done = generation.wait_for_update(version)
+        for model, placeholder in zip(generation.models, placeholders):
+            with placeholder.container():
+                st.caption(f"**{model}**")
+                st.markdown(texts[model])
+        time.sleep(CHAT_STREAM_RENDER_SECONDS)  # Render the chunks received meanwhile at once
+
+
+def display_streaming_message(thread_id: str, message: Dict[str, Any]) -> None:
+    """
+    Display an assistant message still being generated, attaching to its generation.
+
+    Args:
+        thread_id (str): The ID of the thread
+        message (Dict[str, Any]): The assistant message, with a "streaming" status
+    """
+    generation = get_generation(message["generation_id"])
+    if generation is not None:
+        if len(generation.models) > 1:
+            stream_comparisons(generation)
+        else:
+            st.write_stream(generation.stream())
+        if generation.pipeline is not None:
+            with st.spinner("Generating the images of the prompts ..."):
+                version, done = 0, False
+                while not done:
+                    version, _, done = generation.wait_for_update(version)
+        st.rerun()  # Display the complete message and enable the chat input
+    elif is_generation_alive(message):
+        follow_streaming_message(thread_id, message["generation_id"])
+    else:
+        mark_interrupted(get_data_dir("threads"), thread_id, message["generation_id"])
+        st.rerun()
+
+
+@st.fragment(run_every=CHAT_STREAM_REFRESH_SECONDS)
+def follow_streaming_message(thread_id: str, generation_id: str) -> None:
+    """
+    Display an assistant message generated by another process, as it is written to the thread file.
+
+    Args:
+        thread_id (str): The ID of the thread
+        generation_id (str): The ID of the generation
+    """
+    message = read_message(get_data_dir("threads"), thread_id, generation_id)
+    if message is None:
+        st.rerun()  # The generation ended
+    if not is_generation_alive(message):
+        mark_interrupted(get_data_dir("threads"), thread_id, generation_id)
+        st.rerun()
+    if "comparisons" in message:
+        display_comparisons(message["comparisons"])
+    else:
+        st.markdown(message["content"])
+
+
+def is_streaming(thread: Dict[str, Any]) -> bool:
+    """
+    Check if a response is being generated in a thread.
+
+    Args:
+        thread (Dict[str, Any]): The thread
+
+    Returns:
+        bool: True if the last message is still streaming
+    """
+    return bool(thread["messages"]) and thread["messages"][-1].get("status") == "streaming"
+
 
 def prepare_message_content(content: Union[str, List[Dict[str, Any]]]) -> Union[str, List[Dict[str, Any]]]:
     """
@@ -182,22 +399,54 @@ def prepare_message_content(content: Union[str, List[Dict[str, Any]]]) -> Union[
         if item["type"] == "text":
             api_content.append({"type": "text", "text": item["text"]})
         elif item["type"] == "image_url" and "filename" in item:
-            image_path = os.path.join(UPLOADED_IMAGES_DIR, item["filename"])
+            image_path = os.path.join(get_data_dir("uploaded_images"), item["filename"])
             if os.path.exists(image_path):
-                with open(image_path, "rb") as img_file:
-                    image_bytes = img_file.read()
-                    image_base64 = base64.b64encode(image_bytes).decode('utf-8')
                 api_content.append({
                     "type": "image_url",
-                    "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}
+                    "image_url": {"url": encode_uploaded_image(image_path)}
                 })
     return api_content
 
 
+def encode_uploaded_image(image_path: str) -> str:
+    """
+    Encode an uploaded image as a data URL. Uploaded images are named after the hash of their content,
+    so an image is sent with the same bytes on every turn. The data URLs are not kept in memory, they can
+    weigh several MB and reading the file again is cheap next to the request.
+
+    Args:
+        image_path (str): The path of the uploaded image
+
+    Returns:
+        str: The data URL of the image
+    """
+    with open(image_path, "rb") as img_file:
+        image_base64 = base64.b64encode(img_file.read()).decode('utf-8')
+    return f"data:{image_mime_type(image_path)};base64,{image_base64}"
+
+
+def message_text(message: Dict[str, Any]) -> str:
+    """
+    Get the text of a message, without its images.
+
+    Args:
+        message (Dict[str, Any]): The message
+
+    Returns:
+        str: The text
+    """
+    if isinstance(message["content"], list):
+        return "\n".join(item["text"] for item in message["content"] if item["type"] == "text")
+    return message["content"]
+
+
 def prepare_messages(thread_messages: List[Dict[str, Any]], mode: str) -> List[Dict[str, Any]]:
     """
     Prepare messages for the API request.
 
+    The messages only depend on the thread content, and earlier messages never change, so each request
+    starts with the same bytes as the previous one and benefits from the API prompt caching.
+
     Args:
         thread_messages (List[Dict[str, Any]]): The messages in the thread
         mode (str): The current chat mode
@@ -211,10 +460,25 @@ def prepare_messages(thread_messages: List[Dict[str, Any]], mode: str) -> List[D
         messages.append({"role": "system", "content": system_prompt})
 
     for msg in thread_messages:
+        if not msg["content"]:  # Failed response
+            continue
         api_message = {"role": msg["role"]}
         api_message["content"] = prepare_message_content(msg["content"])
         messages.append(api_message)
 
+    # Only the excerpts of the large attachments relevant to the last message are sent, with it,
+    # so the earlier messages are unchanged
+    attachments = [attachment for msg in thread_messages for attachment in msg.get("attachments", [])]
+    if attachments and messages[-1]["role"] == "user":
+        excerpts = retrieve_excerpts(get_data_dir("attachments"), attachments, message_text(thread_messages[-1]))
+        if excerpts:
+            context = "\n\nRelevant excerpts of the attached files:" + "".join(
+                f"\n\n--- '{name}', part {i + 1} ---\n{chunk}" for name, i, chunk in excerpts)
+            if isinstance(messages[-1]["content"], list):
+                messages[-1]["content"] = messages[-1]["content"] + [{"type": "text", "text": context}]
+            else:
+                messages[-1]["content"] = messages[-1]["content"] + context
+
     return messages
 
 
@@ -253,6 +517,16 @@ def setup_sidebar(threads: Dict[str, Dict[str, Any]]) -> Tuple[str, Dict[str, Di
                              "Specialized in Python, data science and code review",
                              "Specialized in reformulating audit notes into formal reports",
                              "Specialized in generating detailed DALL-E prompts"])
+                if SYSTEM_PROMPTS[mode]:
+                    st.caption(f"System prompt : {system_prompt_tokens(mode)} tokens")
+
+                if mode == "Image Generator":
+                    st.toggle("🎨 Generate the images of the prompts", key="image_pipeline",
+                              help="Generate an image with DALL-E 3 for each prompt of the response, as soon as the prompt is written")
+
+                st.multiselect("⚖️ Compare models", COMPARE_MODELS, key="compare_models",
+                               help="Send each message to all the selected models at once and display their answers side by side. "
+                                    "The conversation continues with the answer of the first model.")
 
                 st.divider()
 
@@ -284,7 +558,7 @@ def setup_sidebar(threads: Dict[str, Dict[str, Any]]) -> Tuple[str, Dict[str, Di
                 st.divider()
 
                 st.title("🎨 Image Generation History")
-                generations = load_image_generations()
+                generations = load_image_generations(st.session_state.tenant_id)
                 display_image_generation_history(generations)
 
         elif interaction_type == INTERACTION_TYPES["inpainting"]:
@@ -300,6 +574,10 @@ def setup_sidebar(threads: Dict[str, Dict[str, Any]]) -> Tuple[str, Dict[str, Di
 
         st.write("")
 
+        display_scheduler_metrics()
+        display_memory_usage()
+        display_tenant_usage()
+
         with st.container(border=True):
             st.caption(f'By Timmothy Dangeon, PharmD & Healthcare Data Scientist')
             st.caption(f'Linkedin : linkedin.com/in/timdangeon')
@@ -340,10 +618,12 @@ def display_thread_button(thread_id: str, thread_data: Dict[str, Any], threads:
             st.session_state.current_thread_id = thread_id
     with col2:
         with st.popover("⬇️"):
-            download_thread_export(thread_data, "txt")
-            download_thread_export(thread_data, "json")
-            download_thread_export(thread_data, "md")
-            download_thread_export(thread_data, "csv")
+            # Popovers run on every rerun, so only the selected format of this thread is exported
+            format_key = f"export_format_{thread_id}"
+            format = st.selectbox("Export format", EXPORT_FORMATS, index=None, key=format_key,
+                                  placeholder="Choose a format")
+            if format is not None:
+                download_thread_export(thread_data, format, on_click=functools.partial(st.session_state.pop, format_key))
     with col3:
         if st.button("❌", key=f"delete_{thread_id}"):
             threads = delete_thread(thread_id, threads)
@@ -369,7 +649,31 @@ def get_thread_preview(thread_data: Dict[str, Any]) -> str:
     return "Image thread"
 
 
-def process_files(prompt: str, uploaded_files, thread_id: str) -> Tuple[str, List[Dict[str, str]]]:
+def attach_text(display_prompt: str, name: str, kind: str, text: str, thread_id: str,
+                attachments: List[Dict[str, Any]]) -> str:
+    """
+    Attach a text to the prompt, or chunk and index it if it is large.
+
+    Args:
+        display_prompt (str): The prompt
+        name (str): The name of the attached file
+        kind (str): The kind of file, e.g. "text" or "PDF"
+        text (str): The content of the file
+        thread_id (str): The ID of the current thread
+        attachments (List[Dict[str, Any]]): The large attachments of the message, appended to
+
+    Returns:
+        str: The prompt with the attached text, or a reference to the indexed attachment
+    """
+    if len(text) <= ATTACHMENT_INLINE_CHARS:
+        return display_prompt + f"\nAttached {kind} file '{name}':\n{text}"
+    attachment = save_attachment(get_data_dir("attachments"), thread_id, name, text)
+    attachments.append(attachment)
+    return display_prompt + (f"\nAttached {kind} file '{name}' ({attachment['size']} characters): "
+                             f"its parts relevant to each message are retrieved and sent with it.")
+
+
+def process_files(prompt: str, uploaded_files, thread_id: str) -> Tuple[str, List[Dict[str, str]], List[Dict[str, Any]]]:
     """
     Process uploaded files of all types.
 
@@ -379,10 +683,11 @@ def process_files(prompt: str, uploaded_files, thread_id: str) -> Tuple[str, Lis
         thread_id (str): The ID of the current thread
 
     Returns:
-        Tuple[str, List[Dict[str, str]]]: The processed prompt and image data
+        Tuple[str, List[Dict[str, str]], List[Dict[str, Any]]]: The processed prompt, image data and large attachments
     """
     display_prompt = prompt
     image_data_list = []
+    attachments = []
 
     for uploaded_file in uploaded_files:
         if uploaded_file.type == "application/pdf":
@@ -392,7 +697,7 @@ def process_files(prompt: str, uploaded_files, thread_id: str) -> Tuple[str, Lis
             for page in pdf_document:
                 pdf_text += page.get_text()
             pdf_document.close()
-            display_prompt += f"\nAttached PDF file '{uploaded_file.name}':\n{pdf_text}"
+            display_prompt = attach_text(display_prompt, uploaded_file.name, "PDF", pdf_text, thread_id, attachments)
 
         elif uploaded_file.type.startswith("image/"):
             # Process image files
@@ -406,11 +711,13 @@ def process_files(prompt: str, uploaded_files, thread_id: str) -> Tuple[str, Lis
             file_content = uploaded_file.read()
             try:
                 decoded_content = file_content.decode('utf-8')
-                display_prompt += f"\nAttached text file '{uploaded_file.name}':\n{decoded_content}"
+                display_prompt = attach_text(display_prompt, uploaded_file.name, "text", decoded_content,
+                                             thread_id, attachments)
             except UnicodeDecodeError:
-                display_prompt += f"\nAttached binary file '{uploaded_file.name}':\n[Binary content encoded in base64]"
+                display_prompt += (f"\nAttached file '{uploaded_file.name}' ({len(file_content)} bytes): "
+                                   f"not valid UTF-8 text, its content was not sent.")
 
-    return display_prompt, image_data_list
+    return display_prompt, image_data_list, attachments
 
 
 def create_message_content(prompt: str, image_data_list: List[Dict[str, str]]) -> Union[str, List[Dict[str, Any]]]:
@@ -436,7 +743,7 @@ def create_message_content(prompt: str, image_data_list: List[Dict[str, str]]) -
     return message_content
 
 
-def handle_chat_input(client: OpenAI, thread: Dict[str, Any], uploaded_files, mode: str) -> None:
+def handle_chat_input(client: OpenAI, thread: Dict[str, Any], uploaded_files, mode: str, dalle_options: Dict[str, Any]) -> None:
     """
     Handle the chat input and generate a response.
 
@@ -445,32 +752,80 @@ def handle_chat_input(client: OpenAI, thread: Dict[str, Any], uploaded_files, mo
         thread (Dict[str, Any]): The current thread
         uploaded_files: Uploaded files
         mode (str): The current chat mode
+        dalle_options (Dict[str, Any]): Options for DALL-E image generation, used by the image pipeline
     """
-    if prompt := st.chat_input("What's on your mind ? 🤔"):
+    if prompt := st.chat_input("What's on your mind ? 🤔", disabled=is_streaming(thread)):
 
         st.session_state["file_uploader_key"] += 1  # To remove the files items after rerun
 
-        display_prompt, image_data_list = process_files(prompt, uploaded_files, thread["id"])
+        display_prompt, image_data_list, attachments = process_files(prompt, uploaded_files, thread["id"])
         message_content = create_message_content(display_prompt, image_data_list)
 
-        thread["messages"].append({"role": "user", "content": message_content})
-
-        with st.chat_message("user", avatar=AVATARS["user"]):
-            display_message({"content": message_content})
-
+        models = st.session_state.get("compare_models") or [st.session_state.openai_model]
+        pipeline = mode == "Image Generator" and st.session_state.get("image_pipeline")
+        if not consume_quota(len(models) + (IMAGE_PIPELINE_MAX_PROMPTS if pipeline else 0)):
+            return
+
+        user_message = {"role": "user", "content": message_content, "timestamp": datetime.now().isoformat(), "mode": mode}
+        if attachments:
+            user_message["attachments"] = attachments
+        thread_data = append_user_message(thread["id"], user_message)
+        if thread_data is None:
+            st.warning("This thread was deleted or is answering a message sent from another tab.")
+            return
+        thread["messages"] = thread_data["messages"]
+
+        # The response is generated in the background and written to the thread as it streams,
+        # so it survives reruns and disconnections. The rerun attaches to it.
         messages = prepare_messages(thread["messages"], mode)
+        generate_image = None
+        if pipeline:
+            generate_image = functools.partial(generate_pipeline_image, client, dalle_options,
+                                               get_data_dir("generated_images"), thread["id"])
+        start_chat_generation(client, get_data_dir("threads"), thread["id"], models, messages, generate_image)
+        st.rerun()  # Rerun to remove the files items
 
-        with st.chat_message("assistant", avatar=AVATARS["assistant"]):
-            stream = client.chat.completions.create(
-                model=st.session_state.openai_model,
-                messages=messages,
-                stream=True)
-            response = st.write_stream(stream)
 
-        thread["messages"].append({"role": "assistant", "content": response})
-        thread["last_updated"] = datetime.now().isoformat()
-        save_thread(thread["id"], thread["messages"])
-        st.rerun()  # Rerun to remove the files items
+def display_scheduler_metrics() -> None:
+    """Display the queue depth and wait times of the OpenAI requests in the sidebar."""
+    metrics = get_scheduler().metrics()
+    with st.expander("📊 API queue"):
+        col1, col2 = st.columns(2)
+        col1.metric("Queued", metrics["queue_depth"],
+                    help=f"{metrics['queue_depth_interactive']} interactive, {metrics['queue_depth_batch']} batch")
+        col2.metric("In flight", metrics["in_flight"])
+        col1.metric("Average wait", f"{metrics['average_wait']:.1f}s")
+        col2.metric("Max wait", f"{metrics['max_wait']:.1f}s")
+        col1.metric("Retries", metrics["retries"], help=f"{metrics['rate_limited']} rate limited")
+        col2.metric("Failures", metrics["failures"])
+        usage = usage_stats()
+        if usage["prompt_tokens"]:
+            st.metric("Prompt cache", f"{usage['cached_tokens'] / usage['prompt_tokens']:.0%}",
+                      help=f"{usage['cached_tokens']} of the {usage['prompt_tokens']} prompt tokens of "
+                           f"{usage['responses']} chat responses were served from the API prompt cache")
+        for model, budget in metrics["budgets"].items():
+            st.caption(f"**{model}** : {budget['remaining_requests']} requests, "
+                       f"{budget['remaining_tokens']} tokens left, paused for {budget['paused_for']}s")
+
+
+def display_tenant_usage() -> None:
+    """Display the tenant of the session and its usage of the quotas in the sidebar."""
+    usage = get_tenant_usage(st.session_state.tenant_id).stats()
+    text = f"👤 {st.session_state.tenant_id} · {usage['storage_bytes'] / 1e6:.0f} MB"
+    if usage["storage_quota"]:
+        text += f"/{usage['storage_quota'] / 1e6:.0f} MB"
+    text += f" · {usage['requests']}"
+    if usage["request_quota"]:
+        text += f"/{usage['request_quota']}"
+    st.caption(text + " requests today")
+
+
+def display_memory_usage() -> None:
+    """Display the memory used by the session state and by the shared image cache in the sidebar."""
+    session_bytes = sum(estimate_size(value) for value in st.session_state.to_dict().values())
+    cache = get_image_cache().stats()
+    st.caption(f"🧠 Session: {session_bytes / 1024:.0f} KB · "
+               f"Image cache: {cache['bytes'] / 1e6:.0f}/{cache['max_bytes'] / 1e6:.0f} MB ({cache['images']} images)")
 
 
 def initialize_session_state(model: str) -> None:
@@ -480,6 +835,10 @@ def initialize_session_state(model: str) -> None:
     Args:
         model (str): The OpenAI model to use
     """
+    if "tenant_id" not in st.session_state:
+        st.session_state.tenant_id = tenant_id_from_headers(st.context.headers)
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = str(uuid.uuid4())  # To count the active sessions
     if "current_thread_id" not in st.session_state:
         st.session_state.current_thread_id = None
     if "openai_model" not in st.session_state:
@@ -488,7 +847,7 @@ def initialize_session_state(model: str) -> None:
         st.session_state["file_uploader_key"] = 0  # To remove the files items after rerun
 
 
-def generate_images(client: OpenAI, dalle_options: Dict[str, Any], final_prompt: str) -> None:
+def generate_images(client: OpenAI, dalle_options: Dict[str, Any], final_prompt: str) -> List[str]:
     """
     Generate images using DALL-E in parallel.
 
@@ -496,31 +855,40 @@ def generate_images(client: OpenAI, dalle_options: Dict[str, Any], final_prompt:
         client (OpenAI): The OpenAI client
         dalle_options (Dict[str, Any]): Options for DALL-E image generation
         final_prompt (str): The final prompt including selected categories
+
+    Returns:
+        List[str]: The URLs of the generated images, empty if the generation failed
     """
     def generate_single_image(prompt):
-        response = client.images.generate(model="dall-e-3",
-                                          prompt=prompt,
-                                          size=dalle_options['size'],
-                                          quality=dalle_options['quality'])
+        response = get_scheduler().call(
+            "dall-e-3",
+            lambda: client.images.with_raw_response.generate(model="dall-e-3",
+                                                             prompt=prompt,
+                                                             size=dalle_options['size'],
+                                                             quality=dalle_options['quality']),
+            priority=PRIORITY_INTERACTIVE)
         return response.data[0].url
 
     try:
         with concurrent.futures.ThreadPoolExecutor() as executor:
             futures = [executor.submit(generate_single_image, final_prompt) for _ in range(dalle_options['n'])]
-            image_urls = [future.result() for future in concurrent.futures.as_completed(futures)]
-        st.session_state["image_urls"] = image_urls
+            return [future.result() for future in concurrent.futures.as_completed(futures)]
 
     except Exception as e:
         st.error(f"Error generating images: {str(e)}")
+        return []
 
 
-def save_image_generation(final_prompt: str, image_urls: List[str]) -> str:
+def save_image_generation(final_prompt: str, image_urls: List[str], generated_images_dir: str,
+                          thread_id: Optional[str] = None) -> str:
     """
-    Save an image generation to the history.
+    Save an image generation to the history. May run in a background worker, so it must not use Streamlit.
 
     Args:
         final_prompt (str): The final prompt including selected categories
         image_urls (List[str]): List of generated image URLs
+        generated_images_dir (str): The generation directory of the tenant
+        thread_id (Optional[str]): The ID of the chat thread whose response gave the prompt, if any
 
     Returns:
         str: The ID of the saved generation
@@ -528,7 +896,7 @@ def save_image_generation(final_prompt: str, image_urls: List[str]) -> str:
     generation_id = str(uuid.uuid4())
     
     # Create a folder for the images
-    image_folder = os.path.join(GENERATED_IMAGES_DIR, generation_id)
+    image_folder = os.path.join(generated_images_dir, generation_id)
     os.makedirs(image_folder, exist_ok=True)
     
     # Download and save the images
@@ -546,25 +914,318 @@ def save_image_generation(final_prompt: str, image_urls: List[str]) -> str:
         "image_paths": image_paths,  # Save local image paths instead of URLs
         "timestamp": datetime.now().isoformat()
     }
-    file_path = os.path.join(GENERATED_IMAGES_DIR, f"{generation_id}.json")
-
-    with open(file_path, 'w', encoding='utf-8') as f:
-        json.dump(generation_data, f, indent=4, ensure_ascii=False)
+    if thread_id is not None:
+        generation_data["thread_id"] = thread_id
+    # Written last, so other processes only list generations whose images are complete
+    file_path = os.path.join(generated_images_dir, f"{generation_id}.json")
+    atomic_write_json(file_path, generation_data)
         
     return generation_id
 
 
-def load_image_generations() -> List[Dict[str, Any]]:
+def generate_pipeline_image(client: OpenAI, dalle_options: Dict[str, Any], generated_images_dir: str, thread_id: str,
+                            prompt: str) -> str:
+    """
+    Generate and save the image of a prompt parsed from an "Image Generator" chat response.
+    Called from the chat worker, while the response is still streaming.
+
+    Args:
+        client (OpenAI): The OpenAI client
+        dalle_options (Dict[str, Any]): Options for DALL-E image generation
+        generated_images_dir (str): The generation directory of the tenant
+        thread_id (str): The ID of the chat thread
+        prompt (str): The prompt
+
+    Returns:
+        str: The ID of the saved generation
+    """
+    response = get_scheduler().call(
+        "dall-e-3",
+        lambda: client.images.with_raw_response.generate(model="dall-e-3",
+                                                         prompt=prompt,
+                                                         size=dalle_options['size'],
+                                                         quality=dalle_options['quality']),
+        priority=PRIORITY_INTERACTIVE)
+    return save_image_generation(prompt, [response.data[0].url], generated_images_dir, thread_id=thread_id)
+
+
+@st.cache_resource(ttl=MODIFIER_STATS_TTL_SECONDS)
+def get_modifier_index(tenant_id: str) -> ModifierIndex:
+    """
+    Build the prompt modifier index, with the modifiers used together in the saved generations of a tenant.
+
+    Args:
+        tenant_id (str): The tenant ID
+
+    Returns:
+        ModifierIndex: The modifier index
+    """
+    index = ModifierIndex(MODIFIER_GROUPS)
+    index.mine_cooccurrences(generation["prompt"] for generation in load_image_generations(tenant_id))
+    return index
+
+
+def add_modifier(group: str, modifier: str) -> None:
+    """
+    Add a modifier to the selection of its group, as a button callback.
+
+    Args:
+        group (str): The group of the modifier, e.g. "styles"
+        modifier (str): The modifier
+    """
+    selection = st.session_state.get(f"modifiers_{group}", [])
+    if modifier not in selection:
+        st.session_state[f"modifiers_{group}"] = selection + [modifier]
+
+
+def display_modifier_buttons(modifiers: List[Tuple[str, str]], key: str) -> None:
+    """
+    Display a button per modifier, adding it to the selection when clicked.
+
+    Args:
+        modifiers (List[Tuple[str, str]]): The group and modifier of each button
+        key (str): The prefix of the button keys
+    """
+    columns = st.columns(5)
+    for i, (group, modifier) in enumerate(modifiers):
+        columns[i % len(columns)].button(modifier, key=f"{key}_{group}_{modifier}", help=group.replace("_", " ").capitalize(),
+                                         on_click=add_modifier, args=(group, modifier), use_container_width=True)
+
+
+def display_modifier_search() -> None:
+    """Display the modifier search, and the modifiers most often used with the selected ones."""
+    index = get_modifier_index(st.session_state.tenant_id)
+    query = st.text_input("🔎 Search modifiers", placeholder="e.g. neon, watercolour, golden hour")
+    if query:
+        results = index.search(query)
+        if results:
+            display_modifier_buttons(results, "search")
+        else:
+            st.caption("No matching modifier")
+
+    selected = itertools.chain.from_iterable(st.session_state.get(f"modifiers_{group}", []) for group in MODIFIER_GROUPS)
+    suggestions = index.suggest(selected)
+    if suggestions:
+        st.caption("💡 Often used with your selection")
+        display_modifier_buttons(suggestions, "suggestion")
+
+
+def build_prompt_variations(prompt: str, selected_categories: Dict[str, List[str]]) -> List[str]:
+    """
+    Build one prompt per combination of the selected styles, lighting and camera angles.
+    The other selected modifiers are added to every prompt.
+
+    Args:
+        prompt (str): The base prompt
+        selected_categories (Dict[str, List[str]]): The selected modifiers of each category
+
+    Returns:
+        List[str]: The prompt variations
+    """
+    grid_categories = ["styles", "lighting", "camera_angles"]
+    common_modifiers = [modifier
+                        for category, selections in selected_categories.items() if category not in grid_categories
+                        for modifier in selections]
+    grid = [selected_categories[category] or [None] for category in grid_categories]
+
+    variations = []
+    for combination in itertools.product(*grid):
+        modifiers = [modifier for modifier in combination if modifier] + common_modifiers
+        variations.append(", ".join([prompt] + modifiers))
+    return variations
+
+
+def generate_job_task(client: OpenAI, task: Dict[str, Any], dalle_options: Dict[str, Any], owner: Optional[str]) -> str:
+    """
+    Generate the image of a variation job task and save it to the history.
+    Runs in a background worker, so it must not use Streamlit.
+
+    Args:
+        client (OpenAI): The OpenAI client
+        task (Dict[str, Any]): The task, holding the prompt to generate
+        dalle_options (Dict[str, Any]): Options for DALL-E image generation
+        owner (Optional[str]): The tenant of the job, None for the jobs queued before tenants existed
+
+    Returns:
+        str: The ID of the saved generation
+    """
+    response = get_scheduler().call(
+        "dall-e-3",
+        lambda: client.images.with_raw_response.generate(model="dall-e-3",
+                                                         prompt=task["prompt"],
+                                                         size=dalle_options['size'],
+                                                         quality=dalle_options['quality']),
+        priority=PRIORITY_BATCH)
+    return save_image_generation(task["prompt"], [response.data[0].url],
+                                 tenant_paths(owner or DEFAULT_TENANT)["generated_images"])
+
+
+@st.cache_resource
+def get_tiering_worker() -> threading.Thread:
+    """
+    Start the image storage tiering worker, once per process.
+
+    Returns:
+        threading.Thread: The worker thread
+    """
+    return start_tiering_worker()
+
+
+@st.cache_resource
+def get_analytics_worker() -> threading.Thread:
+    """
+    Start the analytics ingestion worker, once per process.
+
+    Returns:
+        threading.Thread: The worker thread
+    """
+    return start_ingestion_worker()
+
+
+@st.cache_resource
+def get_metrics_publisher() -> threading.Thread:
+    """
+    Start publishing the counters of this process to the health sidecar, once per process.
+
+    Returns:
+        threading.Thread: The publisher thread
+    """
+    return start_metrics_publisher()
+
+
+@st.cache_data(ttl=ANALYTICS_INTERVAL_SECONDS, max_entries=1)
+def load_analytics_tables(last_pass: Optional[str]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Load the analytics store, once per ingestion pass for all sessions.
+
+    Args:
+        last_pass (Optional[str]): The time of the last ingestion pass, to reload the tables after each one
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]: The messages and images tables
+    """
+    return read_table("messages"), read_table("images")
+
+
+def display_analytics() -> None:
+    """Display the usage dashboards of the tenant of the session, computed from the analytics store."""
+    col1, col2 = st.columns([0.7, 0.3])
+    period = col1.selectbox("Period", list(ANALYTICS_PERIODS.keys()), index=1)
+    if col2.button("Refresh now", help="Ingest the history changed since the last refresh"):
+        with st.spinner("Ingesting ..."):
+            run_ingestion_pass()
+
+    state = ingestion_state()
+    if "last_pass" not in state:
+        st.info("The history has not been ingested yet.")
+        return
+    st.caption(f"Last ingestion : {datetime.fromisoformat(state['last_pass']).strftime('%Y-%m-%d %H:%M')}")
+
+    messages, images = load_analytics_tables(state["last_pass"])
+    days = ANALYTICS_PERIODS[period]
+    since = datetime.now() - timedelta(days=days) if days else None
+    aggregates = compute_aggregates(messages, images, st.session_state.tenant_id, since)
+
+    latency = aggregates["latency"]
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Chats", int(aggregates["chats_per_mode"].to_numpy().sum()))
+    col2.metric("Tokens", int(aggregates["tokens_per_day"][["prompt_tokens", "completion_tokens"]].to_numpy().sum()))
+    col3.metric("Images", int(aggregates["images_per_day"].to_numpy().sum()))
+    if latency["responses"].sum():
+        average = (latency["latency"] * latency["responses"]).sum() / latency["responses"].sum()
+        col4.metric("Average latency", f"{average:.1f}s")
+
+    st.subheader("Chats per mode")
+    st.bar_chart(aggregates["chats_per_mode"])
+    st.subheader("Tokens per day")
+    st.bar_chart(aggregates["tokens_per_day"], x="day", y=["prompt_tokens", "completion_tokens"])
+    st.subheader("Images per day")
+    st.bar_chart(aggregates["images_per_day"])
+    st.subheader("Latency per model")
+    st.dataframe(latency, hide_index=True, use_container_width=True,
+                 column_config={"latency": st.column_config.NumberColumn("Average latency (s)", format="%.2f"),
+                                "first_token_latency": st.column_config.NumberColumn("Average first token latency (s)",
+                                                                                     format="%.2f")})
+
+
+@st.cache_resource
+def get_job_queue(api_key: str) -> JobQueue:
+    """
+    Get the variation job queue, shared by all sessions and started once per process.
+
+    Args:
+        api_key (str): The OpenAI API key used by the workers
+
+    Returns:
+        JobQueue: The running job queue
+    """
+    client = OpenAI(api_key=api_key, max_retries=0)  # Retries are handled by the scheduler
+    job_queue = JobQueue(IMAGE_JOBS_DIR,
+                         functools.partial(generate_job_task, client),
+                         max_workers=IMAGE_JOB_MAX_WORKERS)
+    job_queue.start()
+    return job_queue
+
+
+@st.fragment(run_every=IMAGE_JOBS_REFRESH_SECONDS)
+def display_image_jobs(job_queue: JobQueue) -> None:
+    """
+    Display the progress of the variation jobs, refreshed periodically.
+
+    Args:
+        job_queue (JobQueue): The variation job queue
+    """
+    jobs = job_queue.list_jobs(owner=st.session_state.tenant_id)
+    if not jobs:
+        return
+
+    st.markdown("##### 🧮 Variation jobs")
+    for job in jobs:
+        created = datetime.fromisoformat(job["created"]).strftime("%Y-%m-%d %H:%M")
+        text = f"{created} : {job['done']}/{job['total']} images generated"
+        if job["failed"]:
+            text += f", {job['failed']} failed"
+
+        col1, col2 = st.columns([0.9, 0.1])
+        with col1:
+            st.progress((job["done"] + job["failed"]) / job["total"], text=text)
+        with col2:
+            if job["active"]:
+                if st.button("⏹️", key=f"cancel_job_{job['id']}", help="Cancel the remaining images"):
+                    job_queue.cancel(job["id"])
+                    st.rerun()
+            elif st.button("❌", key=f"delete_job_{job['id']}"):
+                job_queue.delete(job["id"])
+                st.rerun()
+
+
+def load_image_generation(generation_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Load an image generation from the history.
+
+    Args:
+        generation_id (str): The ID of the generation
+
+    Returns:
+        Optional[Dict[str, Any]]: The generation data, or None if it was deleted
+    """
+    return read_json(os.path.join(get_data_dir("generated_images"), f"{generation_id}.json"))
+
+
+def load_image_generations(tenant_id: str) -> List[Dict[str, Any]]:
     """
-    Load all image generations from the history directory.
+    Load all image generations of a tenant from the history directory.
+
+    Args:
+        tenant_id (str): The tenant ID
 
     Returns:
         List[Dict[str, Any]]: A list of image generation data
     """
     generations = []
-    for file_path in glob(os.path.join(GENERATED_IMAGES_DIR, "*.json")):
-        with open(file_path, 'r') as f:
-            generation_data = json.load(f)
+    for file_path in glob(os.path.join(tenant_paths(tenant_id)["generated_images"], "*.json")):
+        generation_data = read_json(file_path)
+        if generation_data is not None:
             generations.append(generation_data)
     return sorted(generations, key=lambda x: x["timestamp"], reverse=True)
 
@@ -576,14 +1237,60 @@ def delete_image_generation(generation_id: str) -> None:
     Args:
         generation_id (str): The ID of the generation to delete
     """
-    file_path = os.path.join(GENERATED_IMAGES_DIR, f"{generation_id}.json")
-    if os.path.exists(file_path):
-        os.remove(file_path)
-        
-    # Delete the image folder
-    image_folder = os.path.join(GENERATED_IMAGES_DIR, generation_id)
-    if os.path.exists(image_folder):
-        shutil.rmtree(image_folder)
+    with file_lock(generation_id):
+        file_path = os.path.join(get_data_dir("generated_images"), f"{generation_id}.json")
+        generation = read_json(file_path)
+        if generation is not None and generation.get("archive"):
+            remove_from_archive(generation_id, generation["archive"])
+        remove_file(file_path)
+
+        # Delete the image folder
+        remove_tree(os.path.join(get_data_dir("generated_images"), generation_id))
+
+
+def load_generation_images(generation: Dict[str, Any]) -> List[Tuple[str, Union[str, bytes]]]:
+    """
+    Get the images of a generation, reading them from their archive pack if the generation was archived.
+
+    Args:
+        generation (Dict[str, Any]): The generation data
+
+    Returns:
+        List[Tuple[str, Union[str, bytes]]]: The file name and the path or bytes of each image
+    """
+    if generation.get("archive"):
+        return [(image["name"], read_archived_image(generation["archive"], i))
+                for i, image in enumerate(generation["archive"]["images"])]
+    return [(os.path.basename(image_path), image_path) for image_path in generation["image_paths"]]
+
+
+def read_image_bytes(image: Union[str, bytes]) -> bytes:
+    """
+    Read an image given as a path, or return it if it is already bytes.
+
+    Args:
+        image (Union[str, bytes]): The path or bytes of the image
+
+    Returns:
+        bytes: The image bytes
+    """
+    if isinstance(image, bytes):
+        return image
+    with open(image, "rb") as file:
+        return file.read()
+
+
+def image_mime_type(file_name: str) -> str:
+    """
+    Get the MIME type of a stored image from its file name (e.g. PNG, or WebP once transcoded).
+
+    Args:
+        file_name (str): The file name of the image
+
+    Returns:
+        str: The MIME type
+    """
+    return mimetypes.guess_type(file_name)[0] or "image/png"
 
 
 def display_image_generation_history(generations: List[Dict[str, Any]]) -> None:
@@ -596,46 +1303,45 @@ def display_image_generation_history(generations: List[Dict[str, Any]]) -> None:
     for generation in generations:
         timestamp = datetime.fromisoformat(generation["timestamp"]).strftime("%Y-%m-%d %H:%M")
         preview = generation["prompt"][:30] + "..."
+        images = load_generation_images(generation)
 
         col1, col2, col3 = st.columns([3, 1, 0.5])
         with col1:
             with st.popover(f"{timestamp}: {preview}"):
                 st.markdown(f"**Prompt**: {generation['prompt']}")
 
-                st.markdown(f"##### {len(generation['image_paths'])} images generated :" if len(generation['image_paths']) > 1 else "##### 1 image generated :")
-                captions_list = [f"Image {i+1}" for i in range(len(generation['image_paths']))]
-                st.image(generation["image_paths"], caption=captions_list, width=300)
+                st.markdown(f"##### {len(images)} images generated :" if len(images) > 1 else "##### 1 image generated :")
+                captions_list = [f"Image {i+1}" for i in range(len(images))]
+                st.image([image for _, image in images], caption=captions_list, width=300)
                 
                 # Boutons de téléchargement en dessous des images
-                for i, image_path in enumerate(generation["image_paths"]):
-                    with open(image_path, "rb") as file:
-                        image_bytes = file.read()
-                        st.download_button(
-                            label=f"Download image ({i+1}/{len(generation['image_paths'])})",
-                            icon="💾",
-                            data=image_bytes,
-                            file_name=f"{generation['id']}_image_{i}.png",
-                            mime="image/png",
-                            key=f"export_{generation['id']}_{i}")
+                for i, (file_name, image) in enumerate(images):
+                    st.download_button(
+                        label=f"Download image ({i+1}/{len(images)})",
+                        icon="💾",
+                        data=read_image_bytes(image),
+                        file_name=f"{generation['id']}_image_{i}{os.path.splitext(file_name)[1]}",
+                        mime=image_mime_type(file_name),
+                        key=f"export_{generation['id']}_{i}")
                 st.markdown("#")
         with col2:
-            st.image(generation["image_paths"][0], width=75)
+            st.image(images[0][1], width=75)
         with col3:
             if st.button("❌", key=f"delete_{generation['id']}"):
                 delete_image_generation(generation['id'])
                 st.rerun()
 
 
-def export_thread(thread_data: Dict[str, Any], format: str = "txt") -> Tuple[str, str]:
+def export_thread(thread_data: Dict[str, Any], format: str = "txt") -> Tuple[Union[str, bytes], str]:
     """
     Export thread data to various formats.
     
     Args:
         thread_data (Dict[str, Any]): The thread data to export
-        format (str): Export format ('txt', 'json', 'md', or 'csv')
+        format (str): Export format ('txt', 'json', 'md', 'csv', 'parquet' or 'arrow')
     
     Returns:
-        Tuple[str, str]: (content, filename)
+        Tuple[Union[str, bytes], str]: (content, filename), the content of the tabular formats being bytes
     """
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     filename = f"chat_export_{timestamp}.{format}"
@@ -675,33 +1381,23 @@ def export_thread(thread_data: Dict[str, Any], format: str = "txt") -> Tuple[str
                 content += f"{msg['content']}\n\n"
             content += "---\n\n"
     
-    elif format == "csv":
-        content = "Timestamp,Role,Content\n"
-        for msg in thread_data["messages"]:
-            if isinstance(msg['content'], list):
-                msg_content = " ".join(
-                    item['text'] if item['type'] == 'text' 
-                    else f"[Image: {item.get('original_name', 'uploaded_image')}]"
-                    for item in msg['content']
-                )
-            else:
-                msg_content = msg['content']
-            # Escape quotes and newlines for CSV
-            msg_content = msg_content.replace('"', '""').replace('\n', ' ')
-            content += f"{thread_data['last_updated']},{msg['role']},\"{msg_content}\"\n"
+    elif format in ("csv", "parquet", "arrow"):
+        # One row per message with its own timestamp, loadable with pandas.read_csv/read_parquet
+        content = export_bytes([thread_data], format)
     
     else:
         raise ValueError(f"Unsupported export format: {format}")
         
     return content, filename
 
-def download_thread_export(thread_data: Dict[str, Any], format: str) -> None:
+def download_thread_export(thread_data: Dict[str, Any], format: str, on_click: Optional[Callable[[], None]] = None) -> None:
     """
     Create a download button for thread export.
     
     Args:
         thread_data (Dict[str, Any]): The thread data to export
         format (str): Export format
+        on_click (Optional[Callable[[], None]]): Called when the export is downloaded
     """
     content, filename = export_thread(thread_data, format)
     
@@ -710,8 +1406,14 @@ def download_thread_export(thread_data: Dict[str, Any], format: str) -> None:
         bytes_data = content.encode('utf-8')
         mime = "application/json"
     elif format == "csv":
-        bytes_data = content.encode('utf-8')
+        bytes_data = content
         mime = "text/csv"
+    elif format == "parquet":
+        bytes_data = content
+        mime = "application/vnd.apache.parquet"
+    elif format == "arrow":
+        bytes_data = content
+        mime = "application/vnd.apache.arrow.file"
     elif format == "md":
         bytes_data = content.encode('utf-8')
         mime = "text/markdown"
@@ -727,20 +1429,78 @@ def download_thread_export(thread_data: Dict[str, Any], format: str) -> None:
         data=bytes_data,
         file_name=filename,
         mime=mime,
-        key=button_key  # Add the unique key here
+        key=button_key,  # Add the unique key here
+        on_click=on_click
     )
 
-def create_mask(image: Image.Image) -> Image.Image:
+def decode_image(image_hash: str, image_bytes: bytes) -> Image.Image:
     """
-    Create a mask by allowing the user to crop a rectangle on the image using st_cropper.
-    The mask will be black (0) in the selected area and white (255) elsewhere.
-    
+    Decode an uploaded image once per content hash, keeping it in the shared image cache.
+    The returned image is shared between reruns and sessions, so it must not be modified.
+
     Args:
-        image (Image.Image): The original image
-    
+        image_hash (str): The hash of the image content, used as cache key
+        image_bytes (bytes): The raw image bytes
+
+    Returns:
+        Image.Image: The decoded image
+    """
+    return get_image_cache().get_or_load(("upload", image_hash), lambda: Image.open(io.BytesIO(image_bytes)))
+
+
+def load_uploaded_image(uploaded_image) -> Tuple[Image.Image, str]:
+    """
+    Load the uploaded image to inpaint, hashing and decoding it only once per upload.
+
+    Args:
+        uploaded_image: The uploaded image file
+
     Returns:
-        Image.Image: The inverted mask image
+        Tuple[Image.Image, str]: The decoded image and its content hash
+    """
+    if st.session_state.get("inpainting_upload_id") != uploaded_image.file_id:
+        st.session_state.inpainting_upload_id = uploaded_image.file_id
+        st.session_state.inpainting_image_hash = hashlib.md5(uploaded_image.getvalue()).hexdigest()
+
+    image_hash = st.session_state.inpainting_image_hash
+    return decode_image(image_hash, uploaded_image.getvalue()), image_hash
+
+
+def preview_thumbnail(image_hash: str, image: Image.Image) -> Image.Image:
+    """
+    Downscale an image once per content hash, so the mask preview stays cheap to redraw.
+
+    Args:
+        image_hash (str): The hash of the image content, used as cache key
+        image (Image.Image): The full size image
+
+    Returns:
+        Image.Image: The downscaled RGB image
+    """
+    def downscale():
+        thumbnail = image.convert("RGB")
+        thumbnail.thumbnail((MASK_PREVIEW_SIZE, MASK_PREVIEW_SIZE))
+        return thumbnail
+
+    return get_image_cache().get_or_load(("thumbnail", image_hash), downscale)
+
+
+@st.fragment
+def edit_mask(image: Image.Image, image_hash: str) -> None:
+    """
+    Let the user select one or more rectangles on the image using st_cropper.
+    Runs as a fragment, so dragging the selection only reruns the editor and its mask preview.
+    The current selection is stored in the session state, and "Add region" commits it while another one is drawn.
+
+    Args:
+        image (Image.Image): The original image
+        image_hash (str): The hash of the uploaded image, used to cache the mask
     """
+    # Forget the regions of a previously uploaded image
+    if st.session_state.get("mask_image_hash") != image_hash:
+        st.session_state.mask_image_hash = image_hash
+        st.session_state.mask_shapes = []
+
     # Display the image and allow the user to crop a rectangle
     crop_coordinates = st_cropper(
         image, 
@@ -749,23 +1509,39 @@ def create_mask(image: Image.Image) -> Image.Image:
         aspect_ratio=None,
         return_type="box"
     )
-    
-    # Create a white mask (255 everywhere)
-    mask = Image.new("L", image.size, 255)
-    draw = ImageDraw.Draw(mask)
-    
-    # Convert width/height to right/bottom coordinates and convert to integers
-    left = int(crop_coordinates['left'])
-    top = int(crop_coordinates['top'])
-    right = int(crop_coordinates['left'] + crop_coordinates['width'])
-    bottom = int(crop_coordinates['top'] + crop_coordinates['height'])
-    
-    # Draw black rectangle (0) on the selected area
-    draw.rectangle([left, top, right, bottom], fill=0)
-    
-    return mask
+    st.session_state.mask_current_shape = rectangle_from_box(crop_coordinates)
 
-def generate_inpainting(client: OpenAI, original_image: Image.Image, mask: Image.Image, prompt: str, dalle_options: Dict[str, Any]) -> Image.Image:
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("➕ Add region"):
+            st.session_state.mask_shapes.append(st.session_state.mask_current_shape)
+    with col2:
+        if st.button("🧹 Clear regions"):
+            st.session_state.mask_shapes = []
+
+    shapes = get_mask_shapes()
+    mask = build_mask(image_hash, image.size, shapes)
+    preview_image = preview_thumbnail(image_hash, image)
+    st.image(mask_preview(preview_image, mask.resize(preview_image.size, Image.NEAREST)),
+             caption=f"Mask preview ({len(shapes)} regions)",
+             use_column_width=True)
+
+
+def get_mask_shapes() -> List[Dict[str, Any]]:
+    """
+    Get the regions selected in the mask editor: the committed ones plus the current selection.
+
+    Returns:
+        List[Dict[str, Any]]: The mask shapes
+    """
+    shapes = list(st.session_state.get("mask_shapes", []))
+    current_shape = st.session_state.get("mask_current_shape")
+    if current_shape is not None and current_shape not in shapes:
+        shapes.append(current_shape)
+    return shapes
+
+def generate_inpainting(client: OpenAI, original_image: Image.Image, mask: Image.Image, prompt: str, dalle_options: Dict[str, Any],
+                        priority: int = PRIORITY_INTERACTIVE) -> Image.Image:
     """
     Generate an inpainting using DALL-E.
     
@@ -775,6 +1551,7 @@ def generate_inpainting(client: OpenAI, original_image: Image.Image, mask: Image
         mask (Image.Image): The mask image
         prompt (str): The prompt for inpainting
         dalle_options (Dict[str, Any]): Options for DALL-E image generation
+        priority (int): The scheduling priority of the request
     
     Returns:
         Image.Image: The inpainted image
@@ -787,12 +1564,15 @@ def generate_inpainting(client: OpenAI, original_image: Image.Image, mask: Image
     mask.save(mask_bytes, format="PNG")
     mask_bytes = mask_bytes.getvalue()
     
-    response = client.images.edit(
-        model="dall-e-2",
-        image=original_image_bytes,
-        mask=mask_bytes,
-        prompt=prompt,
-        size=dalle_options['size']
+    response = get_scheduler().call(
+        "dall-e-2",
+        lambda: client.images.with_raw_response.edit(
+            model="dall-e-2",
+            image=original_image_bytes,
+            mask=mask_bytes,
+            prompt=prompt,
+            size=dalle_options['size']),
+        priority=priority
     )
     
     inpainted_image_url = response.data[0].url
@@ -801,18 +1581,171 @@ def generate_inpainting(client: OpenAI, original_image: Image.Image, mask: Image
     
     return inpainted_image
 
-def save_inpainting(original_image: Image.Image, prompt: str, inpainted_image: Image.Image) -> None:
+def resolve_batch_folder(folder: str) -> Optional[str]:
+    """
+    Resolve a batch inpainting folder, which must be inside a data directory of the tenant of the session.
+
+    Args:
+        folder (str): The folder, relative to the tenant data root (e.g. "uploaded_images") or absolute
+
+    Returns:
+        Optional[str]: The resolved folder, or None if it is outside the data directories of the tenant
+    """
+    # The data root of the default tenant also holds the directories of the other tenants,
+    # so the folder must be inside one of the tenant data directories, links resolved
+    folder = os.path.realpath(os.path.join(tenant_root(st.session_state.tenant_id), folder))
+    for directory in tenant_paths(st.session_state.tenant_id).values():
+        directory = os.path.realpath(directory)
+        if folder == directory or folder.startswith(directory + os.sep):
+            return folder
+    return None
+
+
+def list_batch_sources(uploaded_files, folder: str) -> List[Dict[str, Any]]:
+    """
+    List the images of a batch inpainting, from uploads and/or a data folder of the tenant.
+
+    Args:
+        uploaded_files: Uploaded image files
+        folder (str): A folder containing images, relative to the tenant data root, or an empty string
+
+    Returns:
+        List[Dict[str, Any]]: The image sources, each with a name and either its bytes or its path
+    """
+    sources = [{"name": f.name, "bytes": f.getvalue()} for f in uploaded_files or []]
+
+    if folder:
+        resolved_folder = resolve_batch_folder(folder)
+        if resolved_folder is None:
+            st.warning(f"Only your data folders can be inpainted: {', '.join(TENANT_DATA_DIRS.values())}")
+        elif not os.path.isdir(resolved_folder):
+            st.warning(f"Folder not found: {folder}")
+        else:
+            for file_path in sorted(os.listdir(resolved_folder)):
+                if file_path.rsplit(".", 1)[-1].lower() in BATCH_IMAGE_EXTENSIONS:
+                    sources.append({"name": file_path, "path": os.path.join(resolved_folder, file_path)})
+
+    return sources
+
+
+def read_batch_source(source: Dict[str, Any]) -> bytes:
+    """
+    Read the bytes of a batch inpainting image.
+
+    Args:
+        source (Dict[str, Any]): The image source returned by list_batch_sources
+
+    Returns:
+        bytes: The image bytes
+    """
+    if "bytes" in source:
+        return source["bytes"]
+    with open(source["path"], "rb") as f:
+        return f.read()
+
+
+def generate_inpainting_batch(client: OpenAI, sources: List[Dict[str, Any]], shapes: List[Dict[str, Any]],
+                              reference_size: Tuple[int, int], prompt: str,
+                              dalle_options: Dict[str, Any], inpainting_images_dir: str) -> Iterator[Tuple[str, Optional[Image.Image], Optional[Exception]]]:
+    """
+    Inpaint many images with the same mask and prompt, with bounded concurrency.
+    The mask is scaled from the reference image to each image.
+
+    Each inpainting is saved to the history by its worker, so the images are kept when the session
+    reruns or disconnects before the batch is done.
+
+    Args:
+        client (OpenAI): The OpenAI client
+        sources (List[Dict[str, Any]]): The images to inpaint
+        shapes (List[Dict[str, Any]]): The mask shapes, drawn on the reference image
+        reference_size (Tuple[int, int]): The (width, height) of the reference image
+        prompt (str): The prompt for inpainting
+        dalle_options (Dict[str, Any]): Options for DALL-E image generation
+        inpainting_images_dir (str): The inpainting directory of the tenant
+
+    Yields:
+        Tuple[str, Optional[Image.Image], Optional[Exception]]:
+        The image name, inpainted image and error, as soon as each image is done and saved
+    """
+    def inpaint_single_image(source):
+        original_image = Image.open(io.BytesIO(read_batch_source(source)))
+        mask = build_mask("batch", original_image.size, scale_shapes(shapes, reference_size, original_image.size))
+        inpainted_image = generate_inpainting(client, original_image, mask, prompt, dalle_options, priority=PRIORITY_BATCH)
+        save_inpainting(original_image, prompt, inpainted_image, inpainting_images_dir)
+        return inpainted_image
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=BATCH_INPAINTING_MAX_WORKERS)
+    try:
+        futures = {executor.submit(inpaint_single_image, source): source["name"] for source in sources}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                inpainted_image = future.result()
+                yield futures[future], inpainted_image, None
+            except Exception as e:
+                yield futures[future], None, e
+    finally:
+        # Does not wait nor cancel, a rerun is not blocked by the remaining images, which are still saved
+        executor.shutdown(wait=False)
+
+
+def display_batch_inpainting(client: OpenAI, dalle_options: Dict[str, Any]) -> None:
     """
-    Save an inpainting to the history.
+    Display the batch inpainting interface: one mask and prompt applied to many images.
+
+    Args:
+        client (OpenAI): The OpenAI client
+        dalle_options (Dict[str, Any]): Options for DALL-E image generation
+    """
+    uploaded_images = st.file_uploader("Upload the images to inpaint",
+                                       type=BATCH_IMAGE_EXTENSIONS,
+                                       accept_multiple_files=True)
+    folder = st.text_input("Or inpaint a folder of your data", placeholder="uploaded_images")
+
+    sources = list_batch_sources(uploaded_images, folder.strip())
+    if not sources:
+        return
+
+    st.caption(f"{len(sources)} images. Draw the mask on the first one, it will be scaled to each image.")
+    reference_bytes = read_batch_source(sources[0])
+    reference_hash = hashlib.md5(reference_bytes).hexdigest()
+    reference_image = decode_image(reference_hash, reference_bytes)
+
+    edit_mask(reference_image, reference_hash)
+    shapes = get_mask_shapes()
+    prompt = st.text_input("Enter a prompt for inpainting")
+
+    if st.button(f"Inpaint {len(sources)} images") and prompt and consume_quota(len(sources)):
+        progress_bar = st.progress(0.0, text=f"0/{len(sources)} images")
+        results = st.container()
+
+        done = 0
+        for name, inpainted_image, error in generate_inpainting_batch(
+                client, sources, shapes, reference_image.size, prompt, dalle_options, get_data_dir("inpainting_images")):
+            done += 1
+            progress_bar.progress(done / len(sources), text=f"{done}/{len(sources)} images")
+            if error is not None:
+                results.error(f"Error inpainting {name}: {str(error)}")
+                continue
+            results.image(inpainted_image, caption=name, width=300)
+
+
+def save_inpainting(original_image: Image.Image, prompt: str, inpainted_image: Image.Image,
+                    inpainting_images_dir: str) -> str:
+    """
+    Save an inpainting to the history. May run in a background worker, so it must not use Streamlit.
     
     Args:
         original_image (Image.Image): The original image
         prompt (str): The prompt used for inpainting
         inpainted_image (Image.Image): The inpainted image
+        inpainting_images_dir (str): The inpainting directory of the tenant
+
+    Returns:
+        str: The ID of the saved inpainting
     """
     inpainting_id = str(uuid.uuid4())
     
-    inpainting_folder = os.path.join(INPAINTING_IMAGES_DIR, inpainting_id)
+    inpainting_folder = os.path.join(inpainting_images_dir, inpainting_id)
     os.makedirs(inpainting_folder, exist_ok=True)
 
     original_image_path = os.path.join(inpainting_folder, "original.png")
@@ -828,10 +1761,24 @@ def save_inpainting(original_image: Image.Image, prompt: str, inpainted_image: I
         "inpainted_image_path": inpainted_image_path,
         "timestamp": datetime.now().isoformat()
     }
-    file_path = os.path.join(INPAINTING_IMAGES_DIR, f"{inpainting_id}.json")
-    
-    with open(file_path, 'w', encoding='utf-8') as f:
-        json.dump(inpainting_data, f, indent=4, ensure_ascii=False)
+    # Written last, so other processes only list inpaintings whose images are complete
+    file_path = os.path.join(inpainting_images_dir, f"{inpainting_id}.json")
+    atomic_write_json(file_path, inpainting_data)
+
+    return inpainting_id
+
+def load_inpainting(inpainting_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Load an inpainting from the history.
+
+    Args:
+        inpainting_id (str): The ID of the inpainting
+
+    Returns:
+        Optional[Dict[str, Any]]: The inpainting data, or None if it was deleted
+    """
+    return read_json(os.path.join(get_data_dir("inpainting_images"), f"{inpainting_id}.json"))
+
 
 def load_inpainting_history() -> List[Dict[str, Any]]:
     """
@@ -841,9 +1788,9 @@ def load_inpainting_history() -> List[Dict[str, Any]]:
         List[Dict[str, Any]]: A list of inpainting data
     """
     inpaintings = []
-    for file_path in glob(os.path.join(INPAINTING_IMAGES_DIR, "*.json")):
-        with open(file_path, 'r') as f:
-            inpainting_data = json.load(f)
+    for file_path in glob(os.path.join(get_data_dir("inpainting_images"), "*.json")):
+        inpainting_data = read_json(file_path)
+        if inpainting_data is not None:
             inpaintings.append(inpainting_data)
     return sorted(inpaintings, key=lambda x: x["timestamp"], reverse=True)
 
@@ -867,14 +1814,13 @@ def display_inpainting_history(inpaintings: List[Dict[str, Any]]) -> None:
                          caption=["Original Image", "Inpainted Image"],
                          width=300)
                 
-                with open(inpainting["inpainted_image_path"], "rb") as file:
-                    image_bytes = file.read()
-                    st.download_button(
-                        label="Download Inpainted Image",
-                        icon="💾",
-                        data=image_bytes,
-                        file_name=f"inpainted_image_{inpainting['id']}.png",
-                        mime="image/png")
+                inpainted_image_path = inpainting["inpainted_image_path"]
+                st.download_button(
+                    label="Download Inpainted Image",
+                    icon="💾",
+                    data=read_image_bytes(inpainted_image_path),
+                    file_name=f"inpainted_image_{inpainting['id']}{os.path.splitext(inpainted_image_path)[1]}",
+                    mime=image_mime_type(inpainted_image_path))
         
         with col2:
             st.image(inpainting["inpainted_image_path"], width=75)
@@ -891,23 +1837,25 @@ def delete_inpainting(inpainting_id: str) -> None:
     Args:
         inpainting_id (str): The ID of the inpainting to delete
     """
-    file_path = os.path.join(INPAINTING_IMAGES_DIR, f"{inpainting_id}.json")
-    if os.path.exists(file_path):
-        os.remove(file_path)
-    
-    inpainting_folder = os.path.join(INPAINTING_IMAGES_DIR, inpainting_id)
-    if os.path.exists(inpainting_folder):
-        shutil.rmtree(inpainting_folder)
+    with file_lock(inpainting_id):
+        remove_file(os.path.join(get_data_dir("inpainting_images"), f"{inpainting_id}.json"))
+        remove_tree(os.path.join(get_data_dir("inpainting_images"), inpainting_id))
 
 def main() -> None:
     """Main function to run the Streamlit app."""
     st.set_page_config(page_title="LLM Chat", page_icon="✨")
     api_key = st.secrets["openai_api_key"]
+    # Only the first call configures the root logger, so the logs of the workers are printed once per process
+    logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
 
-    init_directories()
     initialize_session_state(MODEL)
+    init_directories()
+    get_tiering_worker()
+    get_analytics_worker()
+    get_metrics_publisher()
+    record_rerun(st.session_state.session_id)
 
-    client = OpenAI(api_key=api_key)
+    client = OpenAI(api_key=api_key, max_retries=0)  # Retries are handled by the scheduler
     threads = load_threads()
 
     mode, threads, uploaded_files, interaction_type, dalle_options = setup_sidebar(threads)
@@ -925,10 +1873,13 @@ def main() -> None:
         # Display current thread messages
         for message in current_thread["messages"]:
             with st.chat_message(message["role"], avatar=AVATARS[message["role"]]):
-                display_message(message)
+                if message.get("status") == "streaming":
+                    display_streaming_message(current_thread["id"], message)
+                else:
+                    display_message(message)
 
         # Handle chat input
-        handle_chat_input(client, current_thread, uploaded_files, mode)
+        handle_chat_input(client, current_thread, uploaded_files, mode, dalle_options)
 
     elif interaction_type == INTERACTION_TYPES["image"]:
         st.title(f"🎨 {interaction_type}")
@@ -936,15 +1887,16 @@ def main() -> None:
         st.session_state['prompt'] = st.text_area("What do you want to create ?", height=150, key="new_prompt")
 
         with st.expander("Advanced prompt modifiers", icon="🚀"):
+            display_modifier_search()
             selected_categories = {
-                "categories": st.multiselect("Select categories to add to the prompt", CATEGORIES),
-                "styles": st.multiselect("Select styles to add to the prompt", STYLES),
-                "lighting": st.multiselect("Select lighting to add to the prompt", LIGHTING),
-                "camera_angles": st.multiselect("Select camera angles to add to the prompt", CAMERA_ANGLES),
-                "colors": st.multiselect("Select colors to add to the prompt", COLORS),
-                "textures": st.multiselect("Select textures to add to the prompt", TEXTURES)}
-
-        if st.button("Let's go ✨") and st.session_state.prompt:
+                "categories": st.multiselect("Select categories to add to the prompt", CATEGORIES, key="modifiers_categories"),
+                "styles": st.multiselect("Select styles to add to the prompt", STYLES, key="modifiers_styles"),
+                "lighting": st.multiselect("Select lighting to add to the prompt", LIGHTING, key="modifiers_lighting"),
+                "camera_angles": st.multiselect("Select camera angles to add to the prompt", CAMERA_ANGLES, key="modifiers_camera_angles"),
+                "colors": st.multiselect("Select colors to add to the prompt", COLORS, key="modifiers_colors"),
+                "textures": st.multiselect("Select textures to add to the prompt", TEXTURES, key="modifiers_textures")}
+
+        if st.button("Let's go ✨") and st.session_state.prompt and consume_quota(dalle_options['n']):
             with st.spinner("Generating ..."):
                 st.session_state.final_prompt = st.session_state.prompt
                 
@@ -952,69 +1904,91 @@ def main() -> None:
                     if selections:
                         st.session_state.final_prompt += ", " + ", ".join(selections)
                 
-                generate_images(client, dalle_options, st.session_state.final_prompt)
+                image_urls = generate_images(client, dalle_options, st.session_state.final_prompt)
             
-            if "image_urls" in st.session_state:
-                save_image_generation(st.session_state.final_prompt, st.session_state.image_urls)
+            if image_urls:
+                # Only the ID is kept in the session, the images are read from the history
+                st.session_state.generation_id = save_image_generation(st.session_state.final_prompt, image_urls,
+                                                                       get_data_dir("generated_images"))
                 st.rerun()  # Rerun to update the history immediately
 
-        if "image_urls" in st.session_state:
+        job_queue = get_job_queue(api_key)
+        variations = build_prompt_variations(st.session_state.prompt, selected_categories)
+        if len(variations) > 1 and st.session_state.prompt:
+            if (st.button(f"Queue {len(variations)} variations 🧮",
+                          help="Generate one prompt per combination of the selected styles, lighting and camera angles, in the background")
+                    and consume_quota(len(variations) * dalle_options['n'])):
+                job_queue.submit(variations, dalle_options, owner=st.session_state.tenant_id)
+                st.toast(f"{len(variations)} variations queued")
+
+        display_image_jobs(job_queue)
+
+        generation = load_image_generation(st.session_state.generation_id) if "generation_id" in st.session_state else None
+        if generation is not None:
             st.markdown("###")
 
-            for i, url in enumerate(st.session_state.image_urls):
-                st.image(url, use_column_width=True)
-                response = requests.get(url)
-                image_bytes = response.content
+            images = load_generation_images(generation)
+            for i, (file_name, image) in enumerate(images):
+                st.image(image, use_column_width=True)
                 st.download_button(
-                    label=f"Download image ({i+1}/{len(st.session_state.image_urls)})",
+                    label=f"Download image ({i+1}/{len(images)})",
                     icon="💾",
-                    data=image_bytes,
-                    file_name=f"generated_image_{i}.png",
-                    mime="image/png",
+                    data=read_image_bytes(image),
+                    file_name=f"generated_image_{i}{os.path.splitext(file_name)[1]}",
+                    mime=image_mime_type(file_name),
                     key=f"download_{i}")
                 st.markdown("###")
 
     elif interaction_type == INTERACTION_TYPES["inpainting"]:
         st.title(f"🖌️ {interaction_type}")
         
-        uploaded_image = st.file_uploader("Upload an image to inpaint", type=["jpg", "jpeg", "png"])
+        batch_mode = st.toggle("Batch mode", help="Apply the same mask and prompt to many images")
+
+        if batch_mode:
+            display_batch_inpainting(client, dalle_options)
+        else:
+            uploaded_image = st.file_uploader("Upload an image to inpaint", type=["jpg", "jpeg", "png"])
         
-        if uploaded_image is not None:
-            original_image = Image.open(uploaded_image)
+            if uploaded_image is not None:
+                original_image, image_hash = load_uploaded_image(uploaded_image)
             
-            mask = create_mask(original_image)
+                edit_mask(original_image, image_hash)
+                shapes = get_mask_shapes()
             
-            if mask is not None:
-                prompt = st.text_input("Enter a prompt for inpainting")
-                
-                if "inpainted_result" not in st.session_state:
-                    st.session_state.inpainted_result = None
+                if shapes:
+                    prompt = st.text_input("Enter a prompt for inpainting")
                 
-                if st.button("Generate Inpainting"):
-                    with st.spinner("Generating inpainting..."):
-                        inpainted_image = generate_inpainting(client, original_image, mask, prompt, dalle_options)
-                        st.session_state.inpainted_result = inpainted_image
-                        save_inpainting(original_image, prompt, inpainted_image)
-                        st.rerun()
+                    if st.button("Generate Inpainting") and consume_quota(1):
+                        with st.spinner("Generating inpainting..."):
+                            mask = build_mask(image_hash, original_image.size, shapes)
+                            try:
+                                inpainted_image = generate_inpainting(client, original_image, mask, prompt, dalle_options)
+                            except openai.OpenAIError as e:
+                                st.error(f"Error generating inpainting: {str(e)}")
+                            else:
+                                # Only the ID is kept in the session, the image is read from the history
+                                st.session_state.inpainting_id = save_inpainting(original_image, prompt, inpainted_image,
+                                                                                 get_data_dir("inpainting_images"))
+                                st.rerun()
                 
-                if st.session_state.inpainted_result is not None:
-                    st.markdown("###")
-                    st.image(st.session_state.inpainted_result, caption="Inpainted Image", use_column_width=True)
+                    inpainting = load_inpainting(st.session_state.inpainting_id) if "inpainting_id" in st.session_state else None
+                    if inpainting is not None:
+                        inpainted_image_path = inpainting["inpainted_image_path"]
+                        st.markdown("###")
+                        st.image(inpainted_image_path, caption="Inpainted Image", use_column_width=True)
                     
-                    # Convert image to bytes only once and store in session state
-                    if "download_bytes" not in st.session_state:
-                        buffered = io.BytesIO()
-                        st.session_state.inpainted_result.save(buffered, format="PNG")
-                        st.session_state.download_bytes = buffered.getvalue()
-                    
-                    st.download_button(
-                        label="Download Inpainted Image",
-                        icon="💾",
-                        data=st.session_state.download_bytes,
-                        file_name="inpainted_image.png",
-                        mime="image/png",
-                        key="inpaint_download"  # Add a unique key
-                    )
+                        st.download_button(
+                            label="Download Inpainted Image",
+                            icon="💾",
+                            data=read_image_bytes(inpainted_image_path),
+                            file_name=f"inpainted_image{os.path.splitext(inpainted_image_path)[1]}",
+                            mime=image_mime_type(inpainted_image_path),
+                            key="inpaint_download"  # Add a unique key
+                        )
+
+    elif interaction_type == INTERACTION_TYPES["analytics"]:
+        st.title(f"📈 {interaction_type}")
+        display_analytics()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,220 @@
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from image_cache import get_image_cache
+
+
+Shape = Dict[str, Any]
+ShapeKey = Tuple[Any, ...]
+
+
+def rectangle_from_box(box: Dict[str, Any]) -> Shape:
+    """
+    Convert a st_cropper box into a rectangle shape.
+
+    Args:
+        box (Dict[str, Any]): The box returned by st_cropper (left, top, width, height)
+
+    Returns:
+        Shape: The rectangle shape
+    """
+    return {"type": "rectangle",
+            "left": int(box["left"]),
+            "top": int(box["top"]),
+            "width": int(box["width"]),
+            "height": int(box["height"])}
+
+
+def shapes_key(shapes: List[Shape]) -> ShapeKey:
+    """
+    Normalize a list of shapes into a hashable key.
+
+    Args:
+        shapes (List[Shape]): The shapes composing the mask
+
+    Returns:
+        ShapeKey: A hashable representation of the shapes
+    """
+    key = []
+    for shape in shapes:
+        if shape["type"] == "rectangle":
+            key.append(("rectangle", int(shape["left"]), int(shape["top"]),
+                        int(shape["width"]), int(shape["height"])))
+        elif shape["type"] == "polygon":
+            key.append(("polygon", tuple((float(x), float(y)) for x, y in shape["points"])))
+        elif shape["type"] == "brush":
+            key.append(("brush", tuple((float(x), float(y)) for x, y in shape["points"]),
+                        float(shape.get("radius", 10))))
+        else:
+            raise ValueError(f"Unsupported mask shape: {shape['type']}")
+    return tuple(key)
+
+
+def _fill_rectangle(selected: np.ndarray, left: int, top: int, width: int, height: int) -> None:
+    """Mark a rectangle (right and bottom edges included) as selected."""
+    h, w = selected.shape
+    x0, y0 = max(left, 0), max(top, 0)
+    x1, y1 = min(left + width + 1, w), min(top + height + 1, h)
+    if x0 < x1 and y0 < y1:
+        selected[y0:y1, x0:x1] = True
+
+
+def _bounding_window(selected: np.ndarray, xs: np.ndarray, ys: np.ndarray, pad: float = 0) -> Tuple[int, int, int, int]:
+    """Clip the bounding box of a set of points (plus padding) to the mask."""
+    h, w = selected.shape
+    x0 = max(int(np.floor(xs.min() - pad)), 0)
+    y0 = max(int(np.floor(ys.min() - pad)), 0)
+    x1 = min(int(np.ceil(xs.max() + pad)) + 1, w)
+    y1 = min(int(np.ceil(ys.max() + pad)) + 1, h)
+    return x0, y0, x1, y1
+
+
+def _fill_polygon(selected: np.ndarray, points: Tuple[Tuple[float, float], ...]) -> None:
+    """Mark the inside of a polygon as selected, using the even-odd rule on pixel centers."""
+    if len(points) < 3:
+        return
+    px = np.array([p[0] for p in points])
+    py = np.array([p[1] for p in points])
+    x0, y0, x1, y1 = _bounding_window(selected, px, py)
+    if x0 >= x1 or y0 >= y1:
+        return
+
+    gy, gx = np.mgrid[y0:y1, x0:x1].astype(np.float64) + 0.5
+    inside = np.zeros(gx.shape, dtype=bool)
+    for xa, ya, xb, yb in zip(px, py, np.roll(px, -1), np.roll(py, -1)):
+        if ya == yb:
+            continue
+        crosses = (ya > gy) != (yb > gy)
+        x_cross = xa + (gy - ya) * (xb - xa) / (yb - ya)
+        inside ^= crosses & (gx < x_cross)
+    selected[y0:y1, x0:x1] |= inside
+
+
+def _fill_brush(selected: np.ndarray, points: Tuple[Tuple[float, float], ...], radius: float) -> None:
+    """Mark every pixel within `radius` of the stroke polyline as selected."""
+    if not points:
+        return
+    px = np.array([p[0] for p in points])
+    py = np.array([p[1] for p in points])
+    x0, y0, x1, y1 = _bounding_window(selected, px, py, pad=radius)
+    if x0 >= x1 or y0 >= y1:
+        return
+
+    gy, gx = np.mgrid[y0:y1, x0:x1].astype(np.float64)
+    # A single point is a degenerate segment, which draws a dot
+    segments = list(zip(points[:-1], points[1:])) if len(points) > 1 else [(points[0], points[0])]
+
+    stroke = np.zeros(gx.shape, dtype=bool)
+    for (sx, sy), (ex, ey) in segments:
+        dx, dy = ex - sx, ey - sy
+        length_sq = dx * dx + dy * dy
+        if length_sq == 0:
+            t = 0.0
+        else:
+            t = np.clip(((gx - sx) * dx + (gy - sy) * dy) / length_sq, 0.0, 1.0)
+        dist_sq = (gx - (sx + t * dx)) ** 2 + (gy - (sy + t * dy)) ** 2
+        stroke |= dist_sq <= radius * radius
+    selected[y0:y1, x0:x1] |= stroke
+
+
+def _build_alpha(size: Tuple[int, int], key: ShapeKey) -> Image.Image:
+    """
+    Rasterize the shapes into the alpha plane of the mask.
+
+    Args:
+        size (Tuple[int, int]): The (width, height) of the image
+        key (ShapeKey): The normalized shapes
+
+    Returns:
+        Image.Image: The "L" alpha plane
+    """
+    width, height = size
+    selected = np.zeros((height, width), dtype=bool)
+
+    for shape in key:
+        if shape[0] == "rectangle":
+            _fill_rectangle(selected, *shape[1:])
+        elif shape[0] == "polygon":
+            _fill_polygon(selected, shape[1])
+        elif shape[0] == "brush":
+            _fill_brush(selected, shape[1], shape[2])
+
+    # Transparent (alpha 0) where the image should be edited, opaque elsewhere
+    return Image.fromarray(np.where(selected, 0, 255).astype(np.uint8), "L")
+
+
+def build_mask(image_hash: str, size: Tuple[int, int], shapes: List[Shape]) -> Image.Image:
+    """
+    Build an RGBA inpainting mask from rectangles, polygons and brush strokes.
+
+    The selected regions are fully transparent, which is what the DALL-E edit endpoint expects.
+
+    Args:
+        image_hash (str): The hash of the image the mask belongs to
+        size (Tuple[int, int]): The (width, height) of the image
+        shapes (List[Shape]): The shapes composing the mask
+
+    Returns:
+        Image.Image: The RGBA mask image
+    """
+    size, key = tuple(size), shapes_key(shapes)
+    # Only the alpha plane is cached, a quarter of the mask, within the memory budget of the image cache
+    alpha = get_image_cache().get_or_load(("mask", image_hash, size, key), lambda: _build_alpha(size, key))
+    mask = Image.new("RGBA", size, (0, 0, 0, 0))
+    mask.putalpha(alpha)
+    return mask
+
+
+def mask_preview(image: Image.Image, mask: Image.Image) -> Image.Image:
+    """
+    Render the mask over the image, highlighting the selected regions.
+
+    Args:
+        image (Image.Image): The original image
+        mask (Image.Image): The RGBA mask built by build_mask
+
+    Returns:
+        Image.Image: The preview image
+    """
+    base = np.asarray(image.convert("RGB"), dtype=np.float32)
+    selected = (np.asarray(mask.getchannel("A")) == 0)[..., None]
+    highlight = np.array([0, 255, 0], dtype=np.float32)
+    preview = np.where(selected, base * 0.5 + highlight * 0.5, base)
+    return Image.fromarray(preview.astype(np.uint8), "RGB")
+
+
+def scale_shapes(shapes: List[Shape], from_size: Tuple[int, int], to_size: Tuple[int, int]) -> List[Shape]:
+    """
+    Scale shapes drawn on one image so that they cover the same relative regions on an image of another size.
+
+    Args:
+        shapes (List[Shape]): The shapes drawn on the reference image
+        from_size (Tuple[int, int]): The (width, height) of the reference image
+        to_size (Tuple[int, int]): The (width, height) of the target image
+
+    Returns:
+        List[Shape]: The scaled shapes
+    """
+    sx = to_size[0] / from_size[0]
+    sy = to_size[1] / from_size[1]
+
+    scaled = []
+    for shape in shapes:
+        if shape["type"] == "rectangle":
+            scaled.append({"type": "rectangle",
+                           "left": round(shape["left"] * sx),
+                           "top": round(shape["top"] * sy),
+                           "width": round(shape["width"] * sx),
+                           "height": round(shape["height"] * sy)})
+        elif shape["type"] == "polygon":
+            scaled.append({"type": "polygon",
+                           "points": [(x * sx, y * sy) for x, y in shape["points"]]})
+        elif shape["type"] == "brush":
+            scaled.append({"type": "brush",
+                           "points": [(x * sx, y * sy) for x, y in shape["points"]],
+                           "radius": shape.get("radius", 10) * min(sx, sy)})
+        else:
+            raise ValueError(f"Unsupported mask shape: {shape['type']}")
+    return scaled
@@ -0,0 +1,151 @@
+import bisect
+import difflib
+import functools
+import itertools
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Tuple
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+from constants import (CATEGORIES, STYLES, LIGHTING, CAMERA_ANGLES, COLORS, TEXTURES, MODIFIER_SEARCH_LIMIT,
+                       SYSTEM_PROMPTS)
+from scheduler import estimate_tokens
+
+
+MODIFIER_GROUPS = {"categories": CATEGORIES,
+                   "styles": STYLES,
+                   "lighting": LIGHTING,
+                   "camera_angles": CAMERA_ANGLES,
+                   "colors": COLORS,
+                   "textures": TEXTURES}
+
+
+class ModifierIndex:
+    """Prefix and fuzzy search over the prompt modifiers, and suggestions from the modifiers used together."""
+
+    def __init__(self, groups: Dict[str, List[str]]):
+        """
+        Args:
+            groups (Dict[str, List[str]]): The modifiers of each group, e.g. MODIFIER_GROUPS
+        """
+        # Sorted by lowercase modifier for the prefix search, a modifier may belong to several groups
+        self.entries = sorted((modifier.lower(), group, modifier)
+                              for group, modifiers in groups.items() for modifier in modifiers)
+        self.keys = [key for key, _, _ in self.entries]
+        self.modifiers = defaultdict(list)
+        for key, group, modifier in self.entries:
+            self.modifiers[key].append((group, modifier))
+        self.cooccurrences = defaultdict(Counter)
+
+    def prefix_search(self, prefix: str, limit: int = MODIFIER_SEARCH_LIMIT) -> List[Tuple[str, str]]:
+        """
+        Find the modifiers starting with a prefix.
+
+        Args:
+            prefix (str): The prefix, case insensitive
+            limit (int): The maximum number of results
+
+        Returns:
+            List[Tuple[str, str]]: The group and modifier of the matches, in alphabetical order
+        """
+        prefix = prefix.lower()
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_left(self.keys, prefix + "\uffff")
+        return [(group, modifier) for _, group, modifier in self.entries[start:min(end, start + limit)]]
+
+    def fuzzy_search(self, query: str, limit: int = MODIFIER_SEARCH_LIMIT) -> List[Tuple[str, str]]:
+        """
+        Find the modifiers close to a possibly misspelled query.
+
+        Args:
+            query (str): The query, case insensitive
+            limit (int): The maximum number of results
+
+        Returns:
+            List[Tuple[str, str]]: The group and modifier of the matches, closest first
+        """
+        matches = difflib.get_close_matches(query.lower(), self.modifiers.keys(), n=limit, cutoff=0.6)
+        return list(itertools.islice(itertools.chain.from_iterable(self.modifiers[key] for key in matches), limit))
+
+    def search(self, query: str, limit: int = MODIFIER_SEARCH_LIMIT) -> List[Tuple[str, str]]:
+        """
+        Find the modifiers starting with a query, completed with the fuzzy matches.
+
+        Args:
+            query (str): The query, case insensitive
+            limit (int): The maximum number of results
+
+        Returns:
+            List[Tuple[str, str]]: The group and modifier of the matches
+        """
+        results = self.prefix_search(query, limit)
+        for result in self.fuzzy_search(query, limit):
+            if len(results) >= limit:
+                break
+            if result not in results:
+                results.append(result)
+        return results
+
+    def find_modifiers(self, prompt: str) -> List[str]:
+        """
+        Find the modifiers of a prompt, which are appended to the scene description separated by commas.
+
+        Args:
+            prompt (str): The prompt
+
+        Returns:
+            List[str]: The lowercase modifiers found in the prompt
+        """
+        terms = {term.strip(" .").lower() for term in prompt.split(",")}
+        return sorted(term for term in terms if term in self.modifiers)
+
+    def mine_cooccurrences(self, prompts: Iterable[str]) -> None:
+        """
+        Count how often each pair of modifiers is used in the same prompt.
+
+        Args:
+            prompts (Iterable[str]): The prompts, e.g. of the saved generations
+        """
+        self.cooccurrences = defaultdict(Counter)
+        for prompt in prompts:
+            for a, b in itertools.combinations(self.find_modifiers(prompt), 2):
+                self.cooccurrences[a][b] += 1
+                self.cooccurrences[b][a] += 1
+
+    def suggest(self, selected: Iterable[str], limit: int = MODIFIER_SEARCH_LIMIT) -> List[Tuple[str, str]]:
+        """
+        Suggest the modifiers most often used with the selected ones.
+
+        Args:
+            selected (Iterable[str]): The selected modifiers
+            limit (int): The maximum number of suggestions
+
+        Returns:
+            List[Tuple[str, str]]: The group and modifier of the suggestions, most used first
+        """
+        selected = {modifier.lower() for modifier in selected}
+        counts = Counter()
+        for modifier in selected:
+            counts.update(self.cooccurrences.get(modifier, {}))
+        suggestions = (self.modifiers[key] for key, _ in counts.most_common() if key not in selected)
+        return list(itertools.islice(itertools.chain.from_iterable(suggestions), limit))
+
+
+@functools.lru_cache(maxsize=None)
+def system_prompt_tokens(mode: str) -> int:
+    """
+    Count the tokens of a system prompt, once per process.
+
+    Args:
+        mode (str): The chat mode
+
+    Returns:
+        int: The number of tokens, estimated when tiktoken is not installed
+    """
+    system_prompt = SYSTEM_PROMPTS.get(mode, "")
+    if tiktoken is not None:
+        return len(tiktoken.get_encoding("o200k_base").encode(system_prompt))
+    return estimate_tokens([{"content": system_prompt}])
@@ -0,0 +1,269 @@
+import itertools
+import random
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import openai
+
+from constants import API_BACKOFF_BASE, API_BACKOFF_MAX, API_MAX_CONCURRENCY, API_MAX_RETRIES
+
+
+PRIORITY_INTERACTIVE = 0  # Chat and single image requests, a user is waiting for them
+PRIORITY_BATCH = 10  # Batch inpaintings and variation jobs
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+NON_RETRYABLE_CODES = {"insufficient_quota"}  # 429 errors that waiting does not fix, e.g. the account is out of credits
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    """
+    Parse a rate limit reset duration header such as "1s", "6m0s" or "20ms".
+
+    Args:
+        value (Optional[str]): The header value
+
+    Returns:
+        Optional[float]: The duration in seconds, or None if the header is missing or invalid
+    """
+    if not value:
+        return None
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+
+def retry_after(error: openai.APIStatusError) -> float:
+    """
+    Get the delay requested by the "retry-after" headers of an error response.
+
+    Args:
+        error (openai.APIStatusError): The error
+
+    Returns:
+        float: The delay in seconds, 0 if the headers are missing
+    """
+    headers = error.response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        return float(headers.get("retry-after", 0))
+    except ValueError:
+        return 0.0
+
+
+def estimate_tokens(messages: List[Dict[str, Any]]) -> int:
+    """
+    Roughly estimate the number of prompt tokens of chat messages (about 4 characters per token).
+
+    Args:
+        messages (List[Dict[str, Any]]): The messages sent to the API
+
+    Returns:
+        int: The estimated number of tokens
+    """
+    characters = 0
+    for message in messages:
+        if isinstance(message["content"], list):
+            characters += sum(len(item.get("text", "")) for item in message["content"])
+        else:
+            characters += len(message["content"])
+    return characters // 4 + 1
+
+
+class ModelBudget:
+    """Remaining requests and tokens of one model, as reported by the rate limit headers."""
+
+    def __init__(self):
+        self.remaining_requests = None
+        self.remaining_tokens = None
+        self.requests_reset_at = 0.0
+        self.tokens_reset_at = 0.0
+        self.paused_until = 0.0
+
+    def update(self, headers) -> None:
+        """Update the budget from the headers of a response."""
+        now = time.monotonic()
+        if headers.get("x-ratelimit-remaining-requests") is not None:
+            self.remaining_requests = int(headers["x-ratelimit-remaining-requests"])
+            self.requests_reset_at = now + (parse_reset_duration(headers.get("x-ratelimit-reset-requests")) or 0)
+        if headers.get("x-ratelimit-remaining-tokens") is not None:
+            self.remaining_tokens = int(headers["x-ratelimit-remaining-tokens"])
+            self.tokens_reset_at = now + (parse_reset_duration(headers.get("x-ratelimit-reset-tokens")) or 0)
+
+    def pause(self, seconds: float) -> None:
+        """Hold every request to this model for some time, e.g. after a 429 response."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def wait_time(self, tokens: int) -> float:
+        """Seconds to wait before a request using `tokens` tokens fits in the budget."""
+        now = time.monotonic()
+        wait = self.paused_until - now
+        if self.remaining_requests is not None and self.remaining_requests <= 0:
+            wait = max(wait, self.requests_reset_at - now)
+        if self.remaining_tokens is not None and self.remaining_tokens < tokens:
+            wait = max(wait, self.tokens_reset_at - now)
+        return max(wait, 0.0)
+
+    def reserve(self, tokens: int) -> None:
+        """Account for a request until its response headers update the budget."""
+        if self.remaining_requests is not None:
+            self.remaining_requests -= 1
+        if self.remaining_tokens is not None:
+            self.remaining_tokens -= tokens
+
+    def snapshot(self) -> Dict[str, Any]:
+        """The budget as reported to the metrics."""
+        return {"remaining_requests": self.remaining_requests,
+                "remaining_tokens": self.remaining_tokens,
+                "paused_for": round(max(self.paused_until - time.monotonic(), 0.0), 1)}
+
+
+class RequestScheduler:
+    """
+    Schedules every OpenAI request of the process.
+
+    Requests wait in a priority queue until a concurrency slot is free and their model has
+    budget left, interactive requests going before batch ones. Rate limited and transient
+    failures are retried with jittered exponential backoff.
+    """
+
+    def __init__(self, max_concurrency: int, max_retries: int = API_MAX_RETRIES):
+        """
+        Args:
+            max_concurrency (int): The maximum number of requests waiting for their response headers
+            max_retries (int): The number of retries of a failed request
+        """
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.in_flight = 0
+        self.budgets = {}
+        self.stats = {"requests": 0, "retries": 0, "rate_limited": 0, "failures": 0,
+                      "total_wait": 0.0, "max_wait": 0.0}
+
+    def _budget(self, model: str) -> ModelBudget:
+        if model not in self.budgets:
+            self.budgets[model] = ModelBudget()
+        return self.budgets[model]
+
+    def _next_ticket(self) -> Optional[Tuple[int, int, str, int]]:
+        """The highest priority waiting request whose model has budget left. Must be called with the lock held."""
+        for ticket in sorted(self.waiting):
+            priority, sequence, model, tokens = ticket
+            if self._budget(model).wait_time(tokens) <= 0:
+                return ticket
+        return None
+
+    def _acquire(self, model: str, priority: int, tokens: int) -> None:
+        """Block until the request can be sent."""
+        enqueued = time.monotonic()
+        with self.condition:
+            ticket = (priority, next(self.sequence), model, tokens)
+            self.waiting.append(ticket)
+            while not (self.in_flight < self.max_concurrency and self._next_ticket() is ticket):
+                # Wake up when the budget of the model may have been reset
+                self.condition.wait(timeout=max(self._budget(model).wait_time(tokens), 0.1))
+            self.waiting.remove(ticket)
+            self.in_flight += 1
+            self._budget(model).reserve(tokens)
+
+            waited = time.monotonic() - enqueued
+            self.stats["requests"] += 1
+            self.stats["total_wait"] += waited
+            self.stats["max_wait"] = max(self.stats["max_wait"], waited)
+            self.condition.notify_all()
+
+    def _release(self, model: str, headers=None) -> None:
+        with self.condition:
+            self.in_flight -= 1
+            if headers is not None:
+                self._budget(model).update(headers)
+            self.condition.notify_all()
+
+    def call(self, model: str, request: Callable[[], Any], priority: int = PRIORITY_INTERACTIVE,
+             estimated_tokens: int = 0) -> Any:
+        """
+        Send a request when the scheduler allows it, retrying rate limited and transient failures,
+        but not the exhausted quota of the account.
+
+        Args:
+            model (str): The model of the request, whose rate limits apply
+            request (Callable[[], Any]): Sends the request using `with_raw_response`, so the headers can be read
+            priority (int): PRIORITY_INTERACTIVE or PRIORITY_BATCH
+            estimated_tokens (int): The estimated number of tokens of the request
+
+        Returns:
+            Any: The parsed response (a stream for streaming requests)
+        """
+        for attempt in range(self.max_retries + 1):
+            self._acquire(model, priority, estimated_tokens)
+            try:
+                raw_response = request()
+            except RETRYABLE_ERRORS as e:
+                self._release(model)
+                with self.condition:
+                    if attempt == self.max_retries or getattr(e, "code", None) in NON_RETRYABLE_CODES:
+                        self.stats["failures"] += 1
+                        raise
+                    self.stats["retries"] += 1
+                    delay = random.uniform(0, min(API_BACKOFF_MAX, API_BACKOFF_BASE * 2 ** attempt))
+                    if isinstance(e, openai.RateLimitError):
+                        self.stats["rate_limited"] += 1
+                        # Other requests to this model would be rate limited too, hold them as well
+                        self._budget(model).pause(max(delay, retry_after(e)))
+                        self.condition.notify_all()
+                        continue
+                time.sleep(delay)
+                continue
+            except Exception:
+                self._release(model)
+                with self.condition:
+                    self.stats["failures"] += 1
+                raise
+
+            self._release(model, raw_response.headers)
+            return raw_response.parse()
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Get the scheduler metrics.
+
+        Returns:
+            Dict[str, Any]: Queue depth, in-flight requests, wait times, retries and per-model budgets
+        """
+        with self.condition:
+            requests = self.stats["requests"]
+            return {"queue_depth": len(self.waiting),
+                    "queue_depth_interactive": sum(1 for t in self.waiting if t[0] == PRIORITY_INTERACTIVE),
+                    "queue_depth_batch": sum(1 for t in self.waiting if t[0] != PRIORITY_INTERACTIVE),
+                    "in_flight": self.in_flight,
+                    "requests": requests,
+                    "average_wait": self.stats["total_wait"] / requests if requests else 0.0,
+                    "max_wait": self.stats["max_wait"],
+                    "retries": self.stats["retries"],
+                    "rate_limited": self.stats["rate_limited"],
+                    "failures": self.stats["failures"],
+                    "budgets": {model: budget.snapshot() for model, budget in self.budgets.items()}}
+
+
+def get_scheduler() -> RequestScheduler:
+    """
+    Get the scheduler of the OpenAI requests, shared by all sessions and background workers of the process.
+
+    Returns:
+        RequestScheduler: The request scheduler
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler(max_concurrency=API_MAX_CONCURRENCY)
+        return _scheduler
@@ -0,0 +1,129 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import zlib
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, single process deployments only
+    fcntl = None
+
+from constants import LOCKS_DIR, LOCK_BUCKETS
+
+
+_held_locks = threading.local()
+
+
+@contextmanager
+def file_lock(name: str, bucketed: bool = True) -> Iterator[None]:
+    """
+    Hold an exclusive advisory lock shared by every thread and process using the data directory.
+    The lock is reentrant within a thread.
+
+    Record names (e.g. a thread ID) are hashed into a fixed number of lock files, so locking many
+    records does not create many files. Two records may share a lock, which is only slower.
+    Coarse locks that are held while locking records must not be bucketed, so they never alias one.
+
+    Args:
+        name (str): The name of the locked resource
+        bucketed (bool): Whether the name is hashed into the shared lock files
+    """
+    if fcntl is None:
+        yield
+        return
+
+    if bucketed:
+        lock_path = os.path.join(LOCKS_DIR, f"{zlib.crc32(name.encode()) % LOCK_BUCKETS}.lock")
+    else:
+        lock_path = os.path.join(LOCKS_DIR, f"{name}.lock")
+
+    held = _held_locks.__dict__.setdefault("paths", set())
+    if lock_path in held:
+        yield
+        return
+
+    os.makedirs(LOCKS_DIR, exist_ok=True)
+    with open(lock_path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        held.add(lock_path)
+        try:
+            yield
+        finally:
+            held.discard(lock_path)
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def atomic_write_bytes(file_path: str, data: bytes) -> None:
+    """
+    Write a file atomically: readers see either the previous content or the new one, never a partial write.
+
+    Args:
+        file_path (str): The path of the file
+        data (bytes): The content to write
+    """
+    directory = os.path.dirname(file_path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        remove_file(tmp_path)
+        raise
+
+
+def atomic_write_json(file_path: str, data: Dict[str, Any]) -> None:
+    """
+    Write a JSON file atomically.
+
+    Args:
+        file_path (str): The path of the file
+        data (Dict[str, Any]): The data to write
+    """
+    atomic_write_bytes(file_path, json.dumps(data, indent=4, ensure_ascii=False).encode("utf-8"))
+
+
+def read_json(file_path: str) -> Optional[Dict[str, Any]]:
+    """
+    Read a JSON file that another process may delete at any time.
+
+    Args:
+        file_path (str): The path of the file
+
+    Returns:
+        Optional[Dict[str, Any]]: The data, or None if the file does not exist anymore
+    """
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def remove_file(file_path: str) -> None:
+    """
+    Delete a file, doing nothing if it was already deleted.
+
+    Args:
+        file_path (str): The path of the file
+    """
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+
+
+def remove_tree(directory: str) -> None:
+    """
+    Delete a directory and its content, doing nothing if it was already deleted.
+
+    Args:
+        directory (str): The path of the directory
+    """
+    shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,207 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from datetime import date
+from typing import Dict, List, Mapping, Optional
+
+from constants import (PROJECT_DIR, TENANTS_DIR, TENANT_USAGE_DIR, DEFAULT_TENANT, TENANT_HEADER,
+                       TENANT_STORAGE_QUOTA_BYTES, TENANT_DAILY_REQUEST_QUOTA, TENANT_USAGE_TTL_SECONDS)
+from storage import atomic_write_json, file_lock, read_json
+
+
+# The data directories of a tenant, relative to its root
+TENANT_DATA_DIRS = {"threads": "thread_history",
+                    "uploaded_images": "uploaded_images",
+                    "generated_images": "generated_images",
+                    "inpainting_images": "inpainting_images",
+                    "attachments": "attachments",
+                    "image_archive": "image_archive"}
+
+_usages = {}
+_usages_lock = threading.Lock()
+
+
+class QuotaExceededError(Exception):
+    """Raised when a tenant is over its storage or request quota."""
+
+
+def tenant_id_from_headers(headers: Optional[Mapping[str, str]]) -> str:
+    """
+    Get the tenant of a session from the identity header set by the authenticating reverse proxy.
+
+    Args:
+        headers (Optional[Mapping[str, str]]): The headers of the session request
+
+    Returns:
+        str: The tenant ID, usable as a directory name. DEFAULT_TENANT if the header is missing.
+    """
+    identity = (headers or {}).get(TENANT_HEADER, "").strip().lower()
+    if not identity:
+        return DEFAULT_TENANT
+    if re.fullmatch(r"[a-z0-9][a-z0-9._@-]{0,63}", identity) and identity != DEFAULT_TENANT:
+        return identity
+    # Not a safe directory name, or a user named like the default tenant
+    return hashlib.sha256(identity.encode()).hexdigest()[:32]
+
+
+def tenant_root(tenant_id: str) -> str:
+    """
+    Get the root data directory of a tenant.
+
+    Args:
+        tenant_id (str): The tenant ID
+
+    Returns:
+        str: The directory holding the data directories of the tenant
+    """
+    if tenant_id == DEFAULT_TENANT:
+        return os.path.join(PROJECT_DIR, "data")
+    return os.path.join(TENANTS_DIR, tenant_id)
+
+
+def tenant_paths(tenant_id: str) -> Dict[str, str]:
+    """
+    Get the data directories of a tenant.
+
+    Args:
+        tenant_id (str): The tenant ID
+
+    Returns:
+        Dict[str, str]: The "threads", "uploaded_images", "generated_images", "inpainting_images",
+        "attachments" and "image_archive" directories
+    """
+    root = tenant_root(tenant_id)
+    return {key: os.path.join(root, name) for key, name in TENANT_DATA_DIRS.items()}
+
+
+def list_tenants() -> List[str]:
+    """
+    List the tenants having data, including the default one.
+
+    Returns:
+        List[str]: The tenant IDs
+    """
+    tenants = [DEFAULT_TENANT]
+    if os.path.isdir(TENANTS_DIR):
+        tenants += sorted(name for name in os.listdir(TENANTS_DIR) if not name.startswith("."))
+    return tenants
+
+
+def directory_size(directory: str) -> int:
+    """
+    Get the total size of the files of a directory, recursively.
+
+    Args:
+        directory (str): The directory
+
+    Returns:
+        int: The size in bytes, 0 if the directory does not exist
+    """
+    size = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                size += os.stat(os.path.join(root, name)).st_size
+            except FileNotFoundError:  # Deleted meanwhile
+                pass
+    return size
+
+
+class TenantUsage:
+    """
+    Storage and daily request counters of a tenant.
+
+    Quotas are checked against counters cached in memory and refreshed from disk every
+    TENANT_USAGE_TTL_SECONDS, so checks are cheap. Requests are recorded in a file shared by all
+    processes. The storage is measured by walking the tenant directories, at most once per refresh.
+    """
+
+    def __init__(self, tenant_id: str):
+        """
+        Args:
+            tenant_id (str): The tenant ID
+        """
+        self.tenant_id = tenant_id
+        self.storage_bytes = 0
+        self.requests = {"date": "", "count": 0}
+        self.refreshed = float("-inf")
+        self.lock = threading.Lock()
+
+    def _requests_path(self) -> str:
+        return os.path.join(TENANT_USAGE_DIR, f"{self.tenant_id}.json")
+
+    def _read_requests(self) -> Dict[str, object]:
+        requests = read_json(self._requests_path()) or {}
+        if requests.get("date") != date.today().isoformat():
+            return {"date": date.today().isoformat(), "count": 0}
+        return requests
+
+    def refresh(self, force: bool = False) -> None:
+        """Refresh the cached counters from disk, if they are older than TENANT_USAGE_TTL_SECONDS."""
+        with self.lock:
+            if not force and time.monotonic() - self.refreshed < TENANT_USAGE_TTL_SECONDS:
+                return
+            self.refreshed = time.monotonic()
+        # Measured outside of the lock, so the checks of other sessions do not wait for it
+        storage_bytes = sum(directory_size(directory) for directory in tenant_paths(self.tenant_id).values())
+        requests = self._read_requests()
+        with self.lock:
+            self.storage_bytes = storage_bytes
+            self.requests = requests
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the cached counters.
+
+        Returns:
+            Dict[str, int]: The storage used and the requests of the day, with their quotas (0 for none)
+        """
+        self.refresh()
+        with self.lock:
+            requests = self.requests["count"] if self.requests["date"] == date.today().isoformat() else 0
+            return {"storage_bytes": self.storage_bytes, "storage_quota": TENANT_STORAGE_QUOTA_BYTES,
+                    "requests": requests, "request_quota": TENANT_DAILY_REQUEST_QUOTA}
+
+    def consume(self, requests: int) -> None:
+        """
+        Check the quotas before sending requests to the API, and record the requests.
+
+        Args:
+            requests (int): The number of requests about to be sent
+
+        Raises:
+            QuotaExceededError: If the tenant is over its storage quota, or the requests would exceed its daily quota
+        """
+        stats = self.stats()
+        if stats["storage_quota"] and stats["storage_bytes"] >= stats["storage_quota"]:
+            raise QuotaExceededError(f"Storage quota exceeded ({stats['storage_bytes'] / 1e6:.0f} MB used of "
+                                     f"{stats['storage_quota'] / 1e6:.0f} MB). Delete some history to continue.")
+        if stats["request_quota"] and stats["requests"] + requests > stats["request_quota"]:
+            raise QuotaExceededError(f"Daily request quota exceeded ({stats['requests']} of "
+                                     f"{stats['request_quota']} requests used). Try again tomorrow.")
+
+        with file_lock(f"tenant_usage_{self.tenant_id}"):
+            counters = self._read_requests()
+            counters["count"] += requests
+            os.makedirs(TENANT_USAGE_DIR, exist_ok=True)
+            atomic_write_json(self._requests_path(), counters)
+        with self.lock:
+            self.requests = counters
+
+
+def get_tenant_usage(tenant_id: str) -> TenantUsage:
+    """
+    Get the usage counters of a tenant, shared by all sessions of the process.
+
+    Args:
+        tenant_id (str): The tenant ID
+
+    Returns:
+        TenantUsage: The usage counters
+    """
+    with _usages_lock:
+        if tenant_id not in _usages:
+            _usages[tenant_id] = TenantUsage(tenant_id)
+        return _usages[tenant_id]
@@ -0,0 +1,191 @@
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from constants import THREADS_DIR, THREAD_STORAGE_FORMAT, THREAD_COMPRESSION_THRESHOLD
+from storage import atomic_write_bytes, remove_file
+
+
+THREAD_STORAGE_FORMATS = ["json", "compact", "msgpack"]
+THREAD_EXTENSIONS = [".json", ".json.zst", ".msgpack", ".msgpack.zst"]
+
+
+def encode_thread(thread_data: Dict[str, Any], storage_format: str = THREAD_STORAGE_FORMAT,
+                  compression_threshold: int = THREAD_COMPRESSION_THRESHOLD) -> Tuple[bytes, str]:
+    """
+    Encode a thread in the given storage format.
+
+    Args:
+        thread_data (Dict[str, Any]): The thread data
+        storage_format (str): "json" (indented, the legacy format), "compact" (JSON without indentation) or "msgpack"
+        compression_threshold (int): Encoded threads larger than this many bytes are compressed with zstd, if installed
+
+    Returns:
+        Tuple[bytes, str]: The encoded thread and its file extension
+    """
+    if storage_format == "json":
+        return json.dumps(thread_data, indent=4, ensure_ascii=False).encode("utf-8"), ".json"
+
+    if storage_format == "compact":
+        if orjson is not None:
+            data = orjson.dumps(thread_data)
+        else:
+            data = json.dumps(thread_data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        extension = ".json"
+    elif storage_format == "msgpack":
+        if msgpack is None:
+            raise RuntimeError("The msgpack thread storage format requires the msgpack package")
+        data = msgpack.packb(thread_data, use_bin_type=True)
+        extension = ".msgpack"
+    else:
+        raise ValueError(f"Unsupported thread storage format: {storage_format}")
+
+    if zstandard is not None and len(data) > compression_threshold:
+        return zstandard.ZstdCompressor().compress(data), extension + ".zst"
+    return data, extension
+
+
+def decode_thread(data: bytes, extension: str) -> Dict[str, Any]:
+    """
+    Decode a thread stored with the given file extension.
+
+    Args:
+        data (bytes): The content of the thread file
+        extension (str): The file extension, one of THREAD_EXTENSIONS
+
+    Returns:
+        Dict[str, Any]: The thread data
+    """
+    if extension.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError("Reading compressed threads requires the zstandard package")
+        data = zstandard.ZstdDecompressor().decompress(data)
+        extension = extension[:-len(".zst")]
+
+    if extension == ".msgpack":
+        if msgpack is None:
+            raise RuntimeError("Reading msgpack threads requires the msgpack package")
+        return msgpack.unpackb(data, raw=False)
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def thread_extension(file_path: str) -> Optional[str]:
+    """
+    Get the thread extension of a file, if it is a thread file.
+
+    Args:
+        file_path (str): The path of the file
+
+    Returns:
+        Optional[str]: The extension, or None if the file is not a thread (e.g. a temporary file)
+    """
+    name = os.path.basename(file_path)
+    if name.startswith("."):
+        return None
+    # Longest first, so ".json.zst" is not mistaken for ".zst"
+    for extension in sorted(THREAD_EXTENSIONS, key=len, reverse=True):
+        if name.endswith(extension):
+            return extension
+    return None
+
+
+def list_thread_files(threads_dir: str = THREADS_DIR) -> List[str]:
+    """
+    List the thread files, in any storage format.
+
+    Args:
+        threads_dir (str): The directory of the threads
+
+    Returns:
+        List[str]: The paths of the thread files
+    """
+    return [os.path.join(threads_dir, name) for name in os.listdir(threads_dir)
+            if thread_extension(name) is not None]
+
+
+def read_thread_file(file_path: str) -> Optional[Dict[str, Any]]:
+    """
+    Read a thread file that another process may delete at any time.
+
+    Args:
+        file_path (str): The path of the thread file
+
+    Returns:
+        Optional[Dict[str, Any]]: The thread data, or None if the file does not exist anymore
+    """
+    try:
+        with open(file_path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    return decode_thread(data, thread_extension(file_path))
+
+
+def read_thread(thread_id: str, threads_dir: str = THREADS_DIR) -> Optional[Dict[str, Any]]:
+    """
+    Read a thread by ID, in any storage format.
+
+    Args:
+        thread_id (str): The ID of the thread
+        threads_dir (str): The directory of the threads
+
+    Returns:
+        Optional[Dict[str, Any]]: The thread data, or None if the thread does not exist
+    """
+    for extension in THREAD_EXTENSIONS:
+        thread_data = read_thread_file(os.path.join(threads_dir, f"{thread_id}{extension}"))
+        if thread_data is not None:
+            return thread_data
+    return None
+
+
+def write_thread(thread_data: Dict[str, Any], threads_dir: str = THREADS_DIR,
+                 storage_format: str = THREAD_STORAGE_FORMAT) -> str:
+    """
+    Write a thread in the configured storage format, removing its copies in other formats.
+    Callers must hold the lock of the thread.
+
+    Args:
+        thread_data (Dict[str, Any]): The thread data
+        threads_dir (str): The directory of the threads
+        storage_format (str): The storage format
+
+    Returns:
+        str: The path of the written file
+    """
+    data, extension = encode_thread(thread_data, storage_format)
+    file_path = os.path.join(threads_dir, f"{thread_data['id']}{extension}")
+    atomic_write_bytes(file_path, data)
+    for other_extension in THREAD_EXTENSIONS:
+        if other_extension != extension:
+            remove_file(os.path.join(threads_dir, f"{thread_data['id']}{other_extension}"))
+    return file_path
+
+
+def delete_thread_files(thread_id: str, threads_dir: str = THREADS_DIR) -> None:
+    """
+    Delete the files of a thread, in any storage format. Callers must hold the lock of the thread.
+
+    Args:
+        thread_id (str): The ID of the thread
+        threads_dir (str): The directory of the threads
+    """
+    for extension in THREAD_EXTENSIONS:
+        remove_file(os.path.join(threads_dir, f"{thread_id}{extension}"))
@@ -0,0 +1,236 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from glob import glob
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from constants import DEFAULT_TENANT, TIERING_WEBP_AFTER_DAYS, TIERING_ARCHIVE_AFTER_DAYS, TIERING_INTERVAL_SECONDS
+from storage import atomic_write_json, file_lock, read_json, remove_file, remove_tree
+from tenants import list_tenants, tenant_paths
+
+
+TIERING_LOCK = "image_tiering"
+ARCHIVE_LOCK = "image_archive"
+
+logger = logging.getLogger(__name__)
+
+
+def transcode_to_webp(image_path: str) -> str:
+    """
+    Transcode an image to lossless WebP next to the original, which is deleted.
+
+    Args:
+        image_path (str): The path of the image
+
+    Returns:
+        str: The path of the WebP image
+    """
+    if image_path.endswith(".webp"):
+        return image_path
+    webp_path = os.path.splitext(image_path)[0] + ".webp"
+    tmp_path = os.path.splitext(image_path)[0] + ".webp.tmp"
+    with Image.open(image_path) as image:
+        image.save(tmp_path, format="WEBP", lossless=True, method=4)
+    os.replace(tmp_path, webp_path)
+    return webp_path
+
+
+def transcode_record(file_path: str, path_keys: List[str]) -> bool:
+    """
+    Transcode the images of a generation or inpainting record to WebP and update the record.
+
+    Args:
+        file_path (str): The path of the record JSON file
+        path_keys (List[str]): The keys of the record holding an image path, or a list of image paths
+
+    Returns:
+        bool: True if images were transcoded
+    """
+    record_id = os.path.splitext(os.path.basename(file_path))[0]
+    with file_lock(record_id):
+        record = read_json(file_path)
+        if record is None or record.get("archive"):
+            return False
+
+        old_paths = []
+        for key in path_keys:
+            if isinstance(record[key], list):
+                old_paths += [p for p in record[key] if not p.endswith(".webp")]
+                record[key] = [transcode_to_webp(p) for p in record[key]]
+            elif not record[key].endswith(".webp"):
+                old_paths.append(record[key])
+                record[key] = transcode_to_webp(record[key])
+        if not old_paths:
+            return False
+
+        # The record points to the WebP images before the PNGs disappear
+        atomic_write_json(file_path, record)
+        for old_path in old_paths:
+            remove_file(old_path)
+    return True
+
+
+def _pack_paths(archive: Dict[str, Any]) -> Tuple[str, str]:
+    # The archives written before they were split by tenant are all in the directory of the default tenant
+    directory = tenant_paths(archive.get("tenant", DEFAULT_TENANT))["image_archive"]
+    return os.path.join(directory, f"{archive['pack']}.pack"), os.path.join(directory, f"{archive['pack']}.index.json")
+
+
+def archive_generation(file_path: str, tenant_id: str) -> bool:
+    """
+    Move the images of a generation into the pack file of its month, in the archive of its tenant,
+    and record their location.
+
+    The pack is an append-only concatenation of image files. Its index maps each generation ID to
+    the offset and length of its images, and the same entries are stored in the generation record.
+
+    Args:
+        file_path (str): The path of the generation JSON file
+        tenant_id (str): The tenant of the generation, whose storage counts the pack
+
+    Returns:
+        bool: True if the generation was archived
+    """
+    generation_id = os.path.splitext(os.path.basename(file_path))[0]
+    with file_lock(generation_id):
+        generation = read_json(file_path)
+        if generation is None or generation.get("archive"):
+            return False
+
+        archive = {"tenant": tenant_id, "pack": datetime.fromisoformat(generation["timestamp"]).strftime("%Y-%m")}
+        pack_path, index_path = _pack_paths(archive)
+        images = []
+        with file_lock(ARCHIVE_LOCK, bucketed=False):
+            os.makedirs(os.path.dirname(pack_path), exist_ok=True)
+            with open(pack_path, "ab") as pack:
+                for image_path in generation["image_paths"]:
+                    with open(image_path, "rb") as f:
+                        data = f.read()
+                    images.append({"name": os.path.basename(image_path), "offset": pack.tell(), "length": len(data)})
+                    pack.write(data)
+                pack.flush()
+                os.fsync(pack.fileno())
+
+            index = read_json(index_path) or {}
+            index[generation_id] = images
+            atomic_write_json(index_path, index)
+
+        generation["archive"] = {**archive, "images": images}
+        generation["image_paths"] = []
+        atomic_write_json(file_path, generation)
+        remove_tree(os.path.join(os.path.dirname(file_path), generation_id))
+    return True
+
+
+def read_archived_image(archive: Dict[str, Any], index: int) -> bytes:
+    """
+    Read an image of an archived generation from its pack file.
+
+    Args:
+        archive (Dict[str, Any]): The "archive" entry of the generation record
+        index (int): The index of the image in the generation
+
+    Returns:
+        bytes: The image bytes
+    """
+    image = archive["images"][index]
+    with open(_pack_paths(archive)[0], "rb") as pack:
+        pack.seek(image["offset"])
+        return pack.read(image["length"])
+
+
+def remove_from_archive(generation_id: str, archive: Dict[str, Any]) -> None:
+    """
+    Remove a deleted generation from the index of its pack. Its bytes stay in the pack file
+    until the last generation of the pack is deleted, which deletes the pack.
+
+    Args:
+        generation_id (str): The ID of the generation
+        archive (Dict[str, Any]): The "archive" entry of the generation record
+    """
+    pack_path, index_path = _pack_paths(archive)
+    with file_lock(ARCHIVE_LOCK, bucketed=False):
+        index = read_json(index_path)
+        if index is None or index.pop(generation_id, None) is None:
+            return
+        if index:
+            atomic_write_json(index_path, index)
+        else:
+            remove_file(pack_path)
+            remove_file(index_path)
+
+
+def run_tiering_pass(now: Optional[datetime] = None) -> Dict[str, int]:
+    """
+    Transcode the images older than TIERING_WEBP_AFTER_DAYS to WebP, and archive the generations
+    older than TIERING_ARCHIVE_AFTER_DAYS, of every tenant. Only one process runs a pass at a time.
+
+    Args:
+        now (Optional[datetime]): The current time, for tests
+
+    Returns:
+        Dict[str, int]: The number of transcoded and archived records
+    """
+    now = now or datetime.now()
+    webp_before = (now - timedelta(days=TIERING_WEBP_AFTER_DAYS)).isoformat()
+    archive_before = (now - timedelta(days=TIERING_ARCHIVE_AFTER_DAYS)).isoformat()
+    stats = {"transcoded": 0, "archived": 0}
+
+    with file_lock(TIERING_LOCK, bucketed=False):
+        generation_files = []
+        inpainting_files = []
+        for tenant_id in list_tenants():
+            paths = tenant_paths(tenant_id)
+            generation_files += [(tenant_id, file_path) for file_path in glob(os.path.join(paths["generated_images"], "*.json"))]
+            inpainting_files += glob(os.path.join(paths["inpainting_images"], "*.json"))
+
+        for tenant_id, file_path in generation_files:
+            # A broken record, e.g. with a missing image, is logged and retried on the next pass,
+            # without stopping the tiering of the others
+            try:
+                generation = read_json(file_path)
+                if generation is None or generation.get("archive"):
+                    continue
+                if generation["timestamp"] < archive_before:
+                    # Archived images are transcoded first, so packs only hold WebP
+                    transcode_record(file_path, ["image_paths"])
+                    stats["archived"] += archive_generation(file_path, tenant_id)
+                elif generation["timestamp"] < webp_before:
+                    stats["transcoded"] += transcode_record(file_path, ["image_paths"])
+            except Exception:
+                logger.exception("Image tiering failed for %s", file_path)
+
+        for file_path in inpainting_files:
+            try:
+                inpainting = read_json(file_path)
+                if inpainting is not None and inpainting["timestamp"] < webp_before:
+                    stats["transcoded"] += transcode_record(file_path, ["original_image_path", "inpainted_image_path"])
+            except Exception:
+                logger.exception("Image tiering failed for %s", file_path)
+
+    return stats
+
+
+def start_tiering_worker() -> threading.Thread:
+    """
+    Start the background thread running a tiering pass every TIERING_INTERVAL_SECONDS.
+
+    Returns:
+        threading.Thread: The worker thread
+    """
+    def work():
+        while True:
+            try:
+                run_tiering_pass()
+            except Exception:
+                # E.g. the lock or a tenant directory unavailable, the next pass retries
+                logger.exception("Image tiering pass failed")
+            time.sleep(TIERING_INTERVAL_SECONDS)
+
+    worker = threading.Thread(target=work, daemon=True)
+    worker.start()
+    return worker
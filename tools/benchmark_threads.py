@@ -0,0 +1,73 @@
+"""
+Compare the thread storage formats: save time, load time and disk footprint.
+
+Usage:
+    python tools/benchmark_threads.py --threads 10000
+"""
+import argparse
+import os
+import random
+import shutil
+import string
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from thread_store import THREAD_STORAGE_FORMATS, list_thread_files, read_thread_file, write_thread
+
+
+def random_text(rng: random.Random, words: int) -> str:
+    return " ".join("".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 10))) for _ in range(words))
+
+
+def make_threads(count: int, seed: int = 0) -> list:
+    """Build synthetic threads, mostly short with a few long ones, like a real history."""
+    rng = random.Random(seed)
+    threads = []
+    for _ in range(count):
+        turns = rng.choice([1, 2, 3, 5, 10, 40])
+        messages = []
+        for _ in range(turns):
+            messages.append({"role": "user", "content": random_text(rng, rng.randint(5, 60))})
+            messages.append({"role": "assistant", "content": random_text(rng, rng.randint(50, 600))})
+        threads.append({"id": str(uuid.uuid4()), "last_updated": datetime.now().isoformat(), "messages": messages})
+    return threads
+
+
+def benchmark(storage_format: str, threads: list) -> dict:
+    threads_dir = tempfile.mkdtemp(prefix=f"threads_{storage_format}_")
+    try:
+        start = time.perf_counter()
+        for thread_data in threads:
+            write_thread(thread_data, threads_dir, storage_format)
+        save_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        loaded = [read_thread_file(file_path) for file_path in list_thread_files(threads_dir)]
+        load_time = time.perf_counter() - start
+        assert len(loaded) == len(threads)
+
+        disk_bytes = sum(os.path.getsize(os.path.join(threads_dir, name)) for name in os.listdir(threads_dir))
+        return {"format": storage_format, "save": save_time, "load": load_time, "bytes": disk_bytes}
+    finally:
+        shutil.rmtree(threads_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=10000)
+    args = parser.parse_args()
+
+    threads = make_threads(args.threads)
+    print(f"{'format':<10}{'save (s)':>12}{'load (s)':>12}{'disk (MB)':>12}")
+    for storage_format in THREAD_STORAGE_FORMATS:
+        try:
+            result = benchmark(storage_format, threads)
+        except RuntimeError as e:
+            print(f"{storage_format:<10}  skipped: {e}")
+            continue
+        print(f"{result['format']:<10}{result['save']:>12.2f}{result['load']:>12.2f}{result['bytes'] / 1e6:>12.1f}")
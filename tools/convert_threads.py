@@ -0,0 +1,58 @@
+"""
+Convert the thread history of every tenant to another storage format.
+
+Usage:
+    python tools/convert_threads.py compact
+    python tools/convert_threads.py msgpack --threads-dir data/tenants/alice/thread_history  # A single directory
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from storage import file_lock
+from tenants import list_tenants, tenant_paths
+from thread_store import THREAD_STORAGE_FORMATS, list_thread_files, read_thread_file, write_thread
+
+
+def convert_threads(threads_dir: str, storage_format: str) -> int:
+    """
+    Rewrite every thread in the given storage format.
+
+    Args:
+        threads_dir (str): The directory of the threads
+        storage_format (str): The target storage format
+
+    Returns:
+        int: The number of converted threads
+    """
+    converted = 0
+    for file_path in list_thread_files(threads_dir):
+        thread_data = read_thread_file(file_path)
+        if thread_data is None:
+            continue
+        with file_lock(thread_data["id"]):
+            # Read again under the lock, the app may have updated the thread meanwhile
+            thread_data = read_thread_file(file_path)
+            if thread_data is None:
+                continue
+            write_thread(thread_data, threads_dir, storage_format)
+        converted += 1
+    return converted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("storage_format", choices=THREAD_STORAGE_FORMATS)
+    parser.add_argument("--threads-dir", help="Only convert this directory, instead of the threads of every tenant")
+    args = parser.parse_args()
+
+    if args.threads_dir:
+        threads_dirs = [args.threads_dir]
+    else:
+        threads_dirs = [tenant_paths(tenant_id)["threads"] for tenant_id in list_tenants()]
+    count = sum(convert_threads(threads_dir, args.storage_format)
+                for threads_dir in threads_dirs if os.path.isdir(threads_dir))
+    print(f"Converted {count} threads to {args.storage_format}")
+    print(f"Set THREAD_STORAGE_FORMAT={args.storage_format} so the app keeps writing this format")